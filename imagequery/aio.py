@@ -0,0 +1,170 @@
+"""
+Concurrent checking, rendering and saving of images
+
+ImageQuery blocks on storage I/O and on PIL while rendering. The functions in
+this module run this work in executors and return futures
+(concurrent.futures, available as "futures" backport for Python 2):
+ * storage I/O (checking the cache, building URLs) runs in the I/O executor
+ * rendering (decoding, operations, encoding) runs in the render executor
+
+Both default to thread pools (PIL releases the GIL while working on image
+data), their size is configured using IMAGEQUERY_ASYNC_IO_WORKERS and
+IMAGEQUERY_ASYNC_RENDER_WORKERS. Use configure() to pass your own executors.
+Steps are chained using callbacks, no worker waits for another one, so one
+executor may be used for both.
+
+The asynchronous variants of RawImageQuery methods are module functions
+taking the query:
+ * exists(query) for query._exists() ("aexists")
+ * url(query) for query.url() ("aurl")
+ * save(query, ...) for query.save(...) ("asave")
+
+Example (view):
+from imagequery import aio
+
+urls = aio.image_formats('thumbnail', [photo.image for photo in photos])
+
+asyncio code can wait for the futures without blocking the event loop:
+url = await asyncio.wrap_future(aio.image_format('thumbnail', photo.image))
+"""
+from functools import partial
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = ThreadPoolExecutor = None
+from imagequery import encoding, formats
+from imagequery.settings import ASYNC_IO_WORKERS, ASYNC_RENDER_WORKERS
+from imagequery.utils import get_imagequery
+
+_executors = {}
+
+
+def configure(io_executor=None, render_executor=None):
+    ''' replaces the default executors '''
+    if io_executor is not None:
+        _executors['io'] = io_executor
+    if render_executor is not None:
+        _executors['render'] = render_executor
+
+
+def _get_executor(name, workers):
+    if name not in _executors:
+        if ThreadPoolExecutor is None:
+            raise ImportError('imagequery.aio needs concurrent.futures (install "futures" on Python 2)')
+        _executors[name] = ThreadPoolExecutor(max_workers=workers)
+    return _executors[name]
+
+
+def get_io_executor():
+    return _get_executor('io', ASYNC_IO_WORKERS)
+
+
+def get_render_executor():
+    return _get_executor('render', ASYNC_RENDER_WORKERS)
+
+
+def run_io(func, *args, **kwargs):
+    return get_io_executor().submit(partial(func, *args, **kwargs))
+
+
+def run_render(func, *args, **kwargs):
+    return get_render_executor().submit(partial(func, *args, **kwargs))
+
+
+def _then(future, func):
+    '''
+    Returns a future of the result of the future returned by
+    func(future.result()), without blocking any thread while waiting
+    '''
+    result = Future()
+
+    def forward(future):
+        try:
+            result.set_result(future.result())
+        except Exception as e:
+            result.set_exception(e)
+
+    def done(future):
+        try:
+            next_future = func(future.result())
+        except Exception as e:
+            result.set_exception(e)
+            return
+        next_future.add_done_callback(forward)
+
+    future.add_done_callback(done)
+    return result
+
+
+def _fallback(future, exceptions, value):
+    ''' returns a future of the result of future, value if it raises one of exceptions '''
+    result = Future()
+
+    def done(future):
+        try:
+            result.set_result(future.result())
+        except exceptions:
+            result.set_result(value)
+        except Exception as e:
+            result.set_exception(e)
+
+    future.add_done_callback(done)
+    return result
+
+
+def _checked(query):
+    return getattr(query, '_evaluated', False) or query._exists()
+
+
+def _render_url(query):
+    if not query._evaluate(allow_fallback=True):
+        return query.storage.url(query.source)
+    return query._url()
+
+
+def exists(query):
+    ''' returns a future of RawImageQuery._exists() '''
+    return run_io(query._exists)
+
+
+def url(query):
+    ''' returns a future of RawImageQuery.url() '''
+    def next_step(exists):
+        if exists:
+            query._evaluated = True
+            return run_io(query._url)
+        # rendering happens in the render executor, so the number of
+        # concurrent renders is limited by its size
+        return run_render(_render_url, query)
+
+    return _then(run_io(_checked, query), next_step)
+
+
+def save(query, name=None, storage=None, **options):
+    ''' returns a future of RawImageQuery.save() '''
+    return run_render(query.save, name, storage, **options)
+
+
+def _format_query(format_name, image):
+    format_cls = formats.get(format_name)
+    return format_cls(get_imagequery(image))._execute()
+
+
+def image_format(format_name, image):
+    '''
+    Returns a future of the URL of the image in the given format, like the
+    image_format template tag does (including returning an empty string on
+    errors)
+    '''
+    future = _then(run_io(_format_query, format_name, image), url)
+    return _fallback(future,
+        (formats.FormatDoesNotExist, encoding.ProfileDoesNotExist, IOError, ValueError), '')
+
+
+def image_formats(format_name, images):
+    '''
+    renders the format for all images concurrently, returns the URLs (blocks,
+    don't call this from inside the executors)
+    '''
+    return [future.result() for future in [image_format(format_name, image) for image in images]]
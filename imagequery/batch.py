@@ -0,0 +1,163 @@
+"""
+Renders formats for many images at once, for example to warm the cache after
+deploying new formats.
+
+Example:
+from imagequery import batch
+
+result = batch.render_format('thumbnail', [obj.image for obj in MyModel.objects.all()])
+print result.summary()
+
+render_formats() renders multiple formats per image, decoding every source
+only once (see ImageQuery.render_many()).
+
+Rendering is done in a process pool (if available, see concurrent.futures)
+so the request threads don't need to do the heavy lifting. The workers are
+forked from the current process, so they know about all registered formats.
+"""
+import time
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+from django.db.models.fields.files import FieldFile
+from imagequery import formats
+from imagequery.settings import default_storage
+from imagequery.utils import resolve_lazy
+
+
+class BatchResult(object):
+    """ Collects the statistics of a batch run """
+
+    def __init__(self):
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = []
+        self.latencies = []
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, source, latency, error=None, count=1):
+        if error is None:
+            self.rendered += count
+            self.latencies.append(latency)
+        else:
+            self.failed.append((source, error))
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        ''' rendered images per second '''
+        if not self.elapsed:
+            return 0.0
+        return self.rendered / self.elapsed
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        index = int(round((len(latencies) - 1) * percent / 100.0))
+        return latencies[index]
+
+    def summary(self):
+        lines = [
+            'rendered: %d, skipped: %d, failed: %d' % (
+                self.rendered, self.skipped, len(self.failed)),
+            'elapsed: %.2fs, throughput: %.2f images/s' % (
+                self.elapsed, self.throughput),
+        ]
+        if self.latencies:
+            lines.append('latency: p50 %.3fs, p90 %.3fs, max %.3fs' % (
+                self.percentile(50), self.percentile(90), max(self.latencies)))
+        for source, error in self.failed:
+            lines.append('failed: %s (%s)' % (source, error))
+        return '\n'.join(lines)
+
+
+def _get_job(format_names, source, storage, cache_storage):
+    if isinstance(source, FieldFile):
+        # we use the field storage, like ImageQuery does
+        storage = source.storage
+        source = source.name
+    return (
+        tuple(format_names),
+        source,
+        resolve_lazy(storage),
+        resolve_lazy(cache_storage),
+    )
+
+
+def _get_query(job):
+    from imagequery.query import ImageQuery  # late import to avoid circular import
+
+    format_names, source, storage, cache_storage = job
+    return ImageQuery(source, storage=storage, cache_storage=cache_storage)
+
+
+def render_job(job):
+    '''
+    Renders a single job, returns (source, latency, error, count). Must be a
+    module level function to be usable with the process pool.
+    '''
+    started = time.time()
+    try:
+        _get_query(job).render_many(job[0], force=True)
+    except Exception as e:
+        return job[1], time.time() - started, '%s: %s' % (e.__class__.__name__, e), 0
+    return job[1], time.time() - started, None, len(job[0])
+
+
+def render_format(format_name, sources, workers=None, storage=default_storage,
+                  cache_storage=None, force=False):
+    '''
+    Renders the format for all sources (filenames or FieldFile's), skipping
+    images which already exist in the cache unless force is True.
+
+    workers defines the number of worker processes (defaults to the number
+    of CPUs), 0 renders everything in the current process.
+    '''
+    return render_formats([format_name], sources, workers, storage, cache_storage, force)
+
+
+def render_formats(format_names, sources, workers=None, storage=default_storage,
+                   cache_storage=None, force=False):
+    '''
+    Like render_format(), but renders multiple formats for every source. Each
+    source is only decoded once for all of its missing formats.
+    '''
+    # raises FormatDoesNotExist early
+    for format_name in format_names:
+        formats.get(format_name)
+    result = BatchResult()
+    jobs = []
+    for source in sources:
+        job = _get_job(format_names, source, storage, cache_storage)
+        missing = []
+        try:
+            query = _get_query(job)
+            for format_name in format_names:
+                if force or not formats.get(format_name)(query)._execute()._exists():
+                    missing.append(format_name)
+        except Exception as e:
+            result.add(job[1], 0, '%s: %s' % (e.__class__.__name__, e))
+            continue
+        result.skipped += len(format_names) - len(missing)
+        if missing:
+            jobs.append((tuple(missing),) + job[1:])
+    if jobs:
+        if ProcessPoolExecutor is None or workers == 0:
+            for job in jobs:
+                result.add(*render_job(job))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for job_result in executor.map(render_job, jobs):
+                    result.add(*job_result)
+    result.finish()
+    return result
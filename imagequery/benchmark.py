@@ -0,0 +1,298 @@
+"""
+Benchmarks for operations, ImageQuery and the template tags
+
+Use the imagequery_benchmark management command to run them:
+    python manage.py imagequery_benchmark --output results.json
+    python manage.py imagequery_benchmark --baseline results.json
+
+Every benchmark records:
+ * time: best wall time of all runs (seconds)
+ * mean: mean wall time of all runs (seconds)
+ * rss_delta: change of the resident set size of the process while running
+   the benchmark (KB, only if /proc is available). Memory freed again is
+   not included, use allocated for the peak.
+ * allocated: peak of memory allocated by Python while running the
+   benchmark once (bytes, only if tracemalloc is available)
+
+Results are stored as JSON and can be compared against a baseline, every
+benchmark getting slower than the given threshold counts as regression.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    from PIL import Image
+    from PIL import ImageEnhance
+    from PIL import ImageFilter
+except ImportError:
+    import Image
+    import ImageEnhance
+    import ImageFilter
+from django.core.files.storage import FileSystemStorage
+from imagequery import operations, formats
+
+SAMPLE_DIR = os.path.join(os.path.dirname(__file__), 'tests', 'sampleimages')
+FONT = os.path.join(os.path.dirname(__file__), 'tests', 'samplefonts', 'Vera.ttf')
+SIZES = (256, 1024, 2048)
+MODES = ('RGB', 'RGBA', 'P', 'L')
+
+
+def _rss():
+    ''' returns the current resident set size (KB), None if unknown '''
+    # ru_maxrss is the peak of the whole process and never decreases, so it
+    # cannot be used per benchmark
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def measure(func, repeat=5, setup=None):
+    '''
+    Runs func repeat times, setup (if given) is run before every run and not
+    measured. Returns the measured values as dict.
+    '''
+    times = []
+    rss_before = _rss()
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    result = {
+        'time': min(times),
+        'mean': sum(times) / len(times),
+    }
+    if rss_before is not None:
+        result['rss_delta'] = _rss() - rss_before
+    if tracemalloc is not None:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            result['allocated'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def sample_image(size, mode='RGB'):
+    ''' returns a photo like image of the given size '''
+    image = Image.open(os.path.join(SAMPLE_DIR, 'lynx_kitten.jpg'))
+    image = image.resize((size, size * image.size[1] // image.size[0]), Image.ANTIALIAS)
+    if mode == 'P':
+        return image.convert('P', palette=Image.ADAPTIVE)
+    return image.convert(mode)
+
+
+def overlay_image(size):
+    ''' returns a transparent image to be pasted on other images '''
+    image = Image.open(os.path.join(SAMPLE_DIR, 'tux_transparent.png')).convert('RGBA')
+    return image.resize((size, size), Image.ANTIALIAS)
+
+
+def operation_factories(image):
+    '''
+    Returns (name, operation) for all operations to be benchmarked on the
+    given image
+    '''
+    width, height = image.size
+    overlay = overlay_image(max(width // 4, 1))
+    other = image.transpose(Image.FLIP_LEFT_RIGHT)
+    mask = sample_image(width, 'L').resize(image.size)
+    return [
+        ('Enhance', operations.Enhance(ImageEnhance.Sharpness, 2.0)),
+        ('Resize', operations.Resize(width // 2, height // 2)),
+        ('Scale', operations.Scale(width // 4, height // 4)),
+        ('Invert', operations.Invert(True)),
+        ('Grayscale', operations.Grayscale()),
+        ('Flip', operations.Flip()),
+        ('Mirror', operations.Mirror()),
+        ('Blur', operations.Blur(3)),
+        ('BlurIterative', operations.Blur(3, method='iterative')),
+        ('BlurDownscaled', operations.Blur(radius=50)),
+        ('Filter', operations.Filter(ImageFilter.SMOOTH)),
+        ('Crop', operations.Crop(10, 10, width // 2, height // 2)),
+        ('Fit', operations.Fit(width // 3, height // 4)),
+        ('Blank', operations.Blank()),
+        ('Paste', operations.Paste(overlay, 'center', 'center')),
+        ('Background', operations.Background(overlay, 0, 0)),
+        ('Convert', operations.Convert('RGBA')),
+        ('GetChannel', operations.GetChannel('alpha')),
+        ('ApplyAlpha', operations.ApplyAlpha(overlay)),
+        ('Blend', operations.Blend(other, 0.5)),
+        ('Text', operations.Text('ImageQuery', 'center', 'center', FONT, 20)),
+        ('Composite', operations.Composite(other, mask)),
+        ('Offset', operations.Offset(10, 10)),
+        ('Padding', operations.Padding(10)),
+        ('Opacity', operations.Opacity(0.5)),
+        ('Clip', operations.Clip((0, 0), (width // 2, height // 2))),
+    ]
+
+
+def operation_benchmarks(sizes=SIZES, modes=MODES):
+    ''' yields (name, func, setup) for every operation, size and mode '''
+    for size in sizes:
+        for mode in modes:
+            image = sample_image(size, mode)
+            for name, operation in operation_factories(image):
+                def func(operation=operation, image=image):
+                    operation.execute(image, None)
+
+                yield 'operation.%s.%s.%d' % (name, mode, size), func, None
+
+
+def compositing_benchmarks(sizes=SIZES):
+    '''
+    yields benchmarks comparing Paste.composite() (region only) against
+    Paste.composite_channels() (whole image) for RGBA images
+    '''
+    for size in sizes:
+        image = sample_image(size, 'RGBA')
+        overlay = overlay_image(max(size // 4, 1))
+        operation = operations.Paste(overlay, 'center', 'center')
+        x = (image.size[0] - overlay.size[0]) // 2
+        y = (image.size[1] - overlay.size[1]) // 2
+        for method in ('composite', 'composite_channels'):
+            def func(func=getattr(operation, method), image=image, overlay=overlay):
+                func(image, overlay, x, y)
+
+            yield 'compositing.paste.%s.%d' % (method, size), func, None
+
+
+class BenchmarkFormat(formats.Format):
+    def execute(self, query):
+        return query.fit(200, 150).query_name('benchmark')
+
+
+class _Environment(object):
+    """ temporary storage containing sample images """
+
+    def __init__(self, count=1, size=2048):
+        self.directory = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.directory)
+        image = sample_image(size)
+        self.names = []
+        for i in range(count):
+            name = 'image_%d.jpg' % i
+            image.save(os.path.join(self.directory, name), 'JPEG', quality=90)
+            self.names.append(name)
+
+    def clear_cache(self):
+        from imagequery.lru import image_cache
+        from imagequery.manifest import get_manifest
+        from imagequery.settings import CACHE_DIR
+
+        shutil.rmtree(os.path.join(self.directory, CACHE_DIR), ignore_errors=True)
+        get_manifest().clear()
+        image_cache.clear()
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def query_benchmarks(environment):
+    ''' yields end-to-end benchmarks for ImageQuery(...).fit(...).url() '''
+    from imagequery.query import ImageQuery  # late import to avoid circular import
+
+    name = environment.names[0]
+
+    def func():
+        ImageQuery(name, storage=environment.storage).fit(200, 150).url()
+
+    yield 'query.fit.cold', func, environment.clear_cache
+    environment.clear_cache()
+    func()
+    yield 'query.fit.warm', func, None
+
+
+def template_benchmarks(environment):
+    ''' yields benchmarks for rendering the image_format tag for all images '''
+    from django import template
+    from imagequery.query import ImageQuery  # late import to avoid circular import
+
+    tpl = template.Template(
+        '{% load imagequery_tags %}{% for image in images %}'
+        '{% image_format "imagequery_benchmark" image %}{% endfor %}')
+
+    def func():
+        images = [ImageQuery(name, storage=environment.storage) for name in environment.names]
+        tpl.render(template.Context({'images': images}))
+
+    count = len(environment.names)
+    yield 'template.image_format.%d.cold' % count, func, environment.clear_cache
+    environment.clear_cache()
+    func()
+    yield 'template.image_format.%d.warm' % count, func, None
+
+
+def run(repeat=5, sizes=SIZES, modes=MODES, images=20, only=None, log=None):
+    '''
+    Runs all benchmarks (only those containing the string only if given),
+    returns the results as dict
+    '''
+    results = {}
+    registered_formats = dict(formats._formats)
+    formats.register('imagequery_benchmark', BenchmarkFormat)
+    query_environment = _Environment()
+    template_environment = _Environment(count=images, size=1024)
+    try:
+        benchmarks = [
+            operation_benchmarks(sizes, modes),
+            compositing_benchmarks(sizes),
+            query_benchmarks(query_environment),
+            template_benchmarks(template_environment),
+        ]
+        for generator in benchmarks:
+            for name, func, setup in generator:
+                if only and only not in name:
+                    continue
+                try:
+                    results[name] = measure(func, repeat, setup)
+                except Exception as e:
+                    # some operations do not support all modes
+                    results[name] = {'error': '%s: %s' % (e.__class__.__name__, e)}
+                if log is not None:
+                    log(name, results[name])
+    finally:
+        formats._formats = registered_formats
+        query_environment.cleanup()
+        template_environment.cleanup()
+    return results
+
+
+def save(results, path):
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Compares results against baseline, returns a list of
+    (name, baseline time, time, ratio) for all benchmarks at least
+    threshold (0.1 = 10%) slower than the baseline
+    '''
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or 'time' not in results[name] or 'time' not in baseline[name]:
+            continue
+        old, new = baseline[name]['time'], results[name]['time']
+        if old and new > old * (1 + threshold):
+            regressions.append((name, old, new, new / old))
+    return regressions
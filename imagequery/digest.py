@@ -0,0 +1,107 @@
+"""
+Content digests of source images
+
+With IMAGEQUERY_CONTENT_ADDRESSED enabled cached images are named by the
+digest of the source file contents instead of the source path, so identical
+uploads share one rendered image and renaming a source keeps its cache.
+
+Digests are computed once per source (streaming the file from its storage),
+kept in memory and stored as metadata of the manifest (if configured, see
+imagequery.manifest), so other processes don't need to read the file again.
+A changed modification time of the source invalidates the digest (see
+imagequery.utils.get_modified_time, remote storages report it using
+modified_time()). Digests of sources without modification time are not
+remembered, as overwritten files could not be noticed, these sources are
+read every time a query needs their digest.
+
+stats() reports how many sources share their digest with other sources.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from imagequery.manifest import get_manifest, get_key as get_manifest_key
+from imagequery.utils import get_storage_id
+
+# number of digests kept in memory
+MAX_DIGESTS = 10000
+CHUNK_SIZE = 64 * 1024
+
+_digests = OrderedDict()
+_lock = threading.Lock()
+
+
+def compute_digest(fh):
+    ''' returns the sha1 of the file contents '''
+    digest = hashlib.sha1()
+    while True:
+        chunk = fh.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_digest(storage, source, mtime=None):
+    '''
+    Returns the digest of source (in storage), mtime is the modification time
+    of the source if known
+    '''
+    if mtime is None:
+        fh = storage.open(source, 'rb')
+        try:
+            return compute_digest(fh)
+        finally:
+            fh.close()
+    key = (get_storage_id(storage), source)
+    with _lock:
+        entry = _digests.get(key)
+    if entry is not None and entry[1] == mtime:
+        return entry[0]
+    manifest_key = get_manifest_key(storage, source, None, None)
+    record = get_manifest().get_metadata('digest', manifest_key)
+    if record is not None and record[1] == mtime:
+        digest = record[0]
+    else:
+        fh = storage.open(source, 'rb')
+        try:
+            digest = compute_digest(fh)
+        finally:
+            fh.close()
+        get_manifest().set_metadata('digest', manifest_key, digest, mtime)
+    with _lock:
+        _digests.pop(key, None)
+        _digests[key] = (digest, mtime)
+        while len(_digests) > MAX_DIGESTS:
+            _digests.popitem(last=False)
+    return digest
+
+
+def image_digest(image):
+    ''' returns the md5 of the image data (for images without source) '''
+    try:
+        data = image.tobytes()
+    except AttributeError:  # PIL/older Pillow versions
+        data = image.tostring()
+    return hashlib.md5(data).hexdigest()
+
+
+def clear():
+    with _lock:
+        _digests.clear()
+
+
+def stats():
+    '''
+    Returns the number of known sources, the number of distinct digests and
+    the dedup ratio (fraction of sources sharing the cached images of other
+    sources)
+    '''
+    with _lock:
+        sources = len(_digests)
+        digests = len(set([digest for digest, mtime in _digests.values()]))
+    return {
+        'sources': sources,
+        'digests': digests,
+        'dedup_ratio': sources and float(sources - digests) / sources or 0.0,
+    }
@@ -0,0 +1,213 @@
+"""
+Encoder profiles
+
+A Profile bundles the settings used to save images: quality (JPEG, WebP and
+AVIF), progressive JPEG, optimize, chroma subsampling, PNG compress level,
+palette quantization (PNG and GIF) and lossless WebP. Settings not supported
+by the output format are ignored.
+
+With max_kb set the quality is chosen by binary search: the rendered image is
+encoded in memory until the highest quality (between min_quality and
+quality) fitting into max_kb kilobytes is found, so only the encoder runs
+again. Formats without quality setting are encoded once.
+
+Profiles are attached to queries (ImageQuery.encoder_profile()) or Formats
+(Format.profile). They are part of the chain hash (named queries get the
+digest of the profile appended), so changing a profile creates new cached
+images. Named profiles can be defined using
+IMAGEQUERY_ENCODER_PROFILES or register():
+
+IMAGEQUERY_ENCODER_PROFILES = {
+    'web': {'quality': 80, 'progressive': True, 'optimize': True},
+    'thumbnail': {'quality': 85, 'max_kb': 20},
+}
+
+class Thumbnail(formats.Format):
+    profile = 'thumbnail'
+
+    def execute(self, imagequery):
+        return imagequery.fit(200, 200).query_name('thumbnail')
+
+Encode time, attempts and bytes are reported per profile by the image_saved
+signal (see imagequery.stats), compare() encodes one image with multiple
+profiles to choose between them.
+"""
+import hashlib
+import time
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from imagequery.settings import ENCODER_PROFILES
+
+# formats supporting the quality option
+QUALITY_FORMATS = ('JPEG', 'WEBP', 'AVIF')
+# formats supporting palette images
+PALETTE_FORMATS = ('PNG', 'GIF')
+# quality to start the search with if the profile does not define one
+MAX_QUALITY = 90
+
+
+class ProfileDoesNotExist(Exception):
+    pass
+
+
+class Profile(object):
+    """
+    Encoder settings, see module documentation. subsampling is passed to
+    Pillow as is (like 0, 2 or '4:2:0'), colors is the size of the palette
+    used for PNG/GIF images.
+    """
+
+    def __init__(self, name=None, quality=None, progressive=False, optimize=False, subsampling=None,
+                 compress_level=None, colors=None, lossless=False, max_kb=None, min_quality=30):
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling
+        self.compress_level = compress_level
+        self.colors = colors
+        self.lossless = lossless
+        self.max_kb = max_kb
+        self.min_quality = min_quality
+        self.name = name or self.key()
+
+    def key(self):
+        ''' identifies the settings, used for the chain hash '''
+        parts = []
+        for attr in ('quality', 'progressive', 'optimize', 'subsampling', 'compress_level',
+                     'colors', 'lossless', 'max_kb', 'min_quality'):
+            parts.append('%s=%s' % (attr, getattr(self, attr)))
+        return ','.join(parts)
+
+    def digest(self):
+        ''' short hash of the settings, appended to query names '''
+        return hashlib.sha1(self.key().encode('utf-8')).hexdigest()[:8]
+
+    def __unicode__(self):
+        return u'<Profile %s>' % self.name
+
+    def __repr__(self):
+        return '<Profile %s>' % self.name
+
+    def options(self, format, quality=None):
+        ''' returns the options for Image.save() '''
+        if quality is None:
+            quality = self.quality
+        options = {}
+        if format in QUALITY_FORMATS and quality is not None:
+            options['quality'] = quality
+        if format == 'JPEG':
+            if self.progressive:
+                options['progressive'] = True
+            if self.subsampling is not None:
+                options['subsampling'] = self.subsampling
+        if format in ('JPEG', 'PNG', 'GIF') and self.optimize:
+            options['optimize'] = True
+        if format == 'PNG' and self.compress_level is not None:
+            options['compress_level'] = self.compress_level
+        if format == 'WEBP' and self.lossless:
+            options['lossless'] = True
+        return options
+
+    def prepare(self, image, format):
+        ''' returns the image to be encoded (quantized if colors is set) '''
+        if not self.colors or format not in PALETTE_FORMATS:
+            return image
+        if image.mode == 'P':
+            colors = image.getcolors(256)
+            if colors is not None and len(colors) <= self.colors:
+                return image
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        if image.mode == 'RGBA':
+            return image.quantize(self.colors, method=Image.FASTOCTREE)
+        return image.quantize(self.colors)
+
+    def encode(self, image, format, options=None, quality=None):
+        ''' returns the encoded image (bytes) '''
+        save_options = dict(options or {})
+        save_options.update(self.options(format, quality))
+        buf = BytesIO()
+        image.save(buf, format, **save_options)
+        return buf.getvalue()
+
+    def save(self, image, fh, format, options=None):
+        '''
+        Encodes image and writes it to fh, options are passed to Image.save()
+        (profile settings take precedence). Returns a dict containing the used
+        quality, the number of encoder runs (attempts), the bytes written and
+        the time spent encoding (duration).
+        '''
+        started = time.time()
+        image = self.prepare(image, format)
+        quality = self.quality
+        if quality is None and self.max_kb and format in QUALITY_FORMATS:
+            quality = MAX_QUALITY
+        attempts = 1
+        data = self.encode(image, format, options, quality)
+        if self.max_kb and format in QUALITY_FORMATS and len(data) > self.max_kb * 1024:
+            budget = self.max_kb * 1024
+            low, high = self.min_quality, quality - 1
+            # keep the first encoding if nothing fits (quality <= min_quality)
+            best = (quality, data)
+            while low <= high:
+                middle = (low + high) // 2
+                candidate = self.encode(image, format, options, middle)
+                attempts += 1
+                # the last run is min_quality if nothing fits, use its result
+                # as the smallest possible encoding
+                if len(candidate) <= budget or middle == self.min_quality:
+                    best = (middle, candidate)
+                if len(candidate) <= budget:
+                    low = middle + 1
+                else:
+                    high = middle - 1
+            quality, data = best
+        duration = time.time() - started
+        fh.write(data)
+        return {
+            'quality': quality,
+            'attempts': attempts,
+            'bytes': len(data),
+            'duration': duration,
+        }
+
+
+_profiles = {}
+
+
+def register(name, profile):
+    ''' registers a Profile (or a dict of Profile arguments) by name '''
+    if isinstance(profile, dict):
+        profile = Profile(name=name, **profile)
+    _profiles[name] = profile
+
+
+def get(value):
+    ''' returns the Profile, value may be a Profile or the name of a registered profile '''
+    if isinstance(value, Profile):
+        return value
+    try:
+        return _profiles[value]
+    except KeyError:
+        raise ProfileDoesNotExist(value)
+
+
+def compare(image, profiles, format='JPEG'):
+    '''
+    Encodes image using every given profile (Profiles or names), returns
+    (profile name, result of Profile.save()) for all of them
+    '''
+    results = []
+    for profile in profiles:
+        profile = get(profile)
+        results.append((profile.name, profile.save(image, BytesIO(), format)))
+    return results
+
+
+for _name, _profile in ENCODER_PROFILES.items():
+    register(_name, _profile)
@@ -16,6 +16,14 @@ def get(name):
         raise FormatDoesNotExist()
 
 
+def get_name(format):
+    ''' returns the name the format class is registered with, None if not registered '''
+    for name, registered in _formats.items():
+        if registered is format:
+            return name
+    return None
+
+
 class Format(object):
     """
     A Format represents a fixed image manipulation
@@ -39,6 +47,11 @@ class Format(object):
     formats.register('shiny', MyShinyNewFormat)
     Inside the template (outputs the url):
     {% load imagequery_tags %}{% image_format "shiny" obj.image %}
+
+    Set profile to save the images using an encoder profile (see
+    imagequery.encoding):
+    class MyShinyNewFormat(formats.Format):
+        profile = 'web'
     
     Note:
     When using Format's yourself (without the templatetags) you should be aware
@@ -49,6 +62,9 @@ class Format(object):
     the URL/path of the generated image.
     """
 
+    # encoder profile (Profile or name of a registered profile)
+    profile = None
+
     # we don't allow passing filenames here, as this would need us to
     # repeat big parts of the storage-logic
     def __init__(self, imagequery):
@@ -63,6 +79,10 @@ class Format(object):
             return self._executed
         except AttributeError:
             self._executed = self.execute(self._query)
+            if self.profile is not None:
+                self._executed = self._executed.encoder_profile(self.profile)
+            # used for statistics (see imagequery.stats)
+            self._executed.format_name = get_name(self.__class__) or self.__class__.__name__
             return self._executed
 
     def name(self):
@@ -0,0 +1,193 @@
+"""
+Render queue for lazy formats
+
+Without a queue the generate_lazy view renders the image while the browser
+waits for it. With IMAGEQUERY_RENDER_QUEUE set the view only enqueues a job
+and redirects to the source image (or IMAGEQUERY_LAZY_FORMAT_PLACEHOLDER)
+until a worker has rendered the image, then to the generated image.
+
+Queues:
+ * 'imagequery.jobs.LocalQueue' renders using background threads of the
+   current process (IMAGEQUERY_RENDER_QUEUE_WORKERS), jobs get lost when the
+   process exits
+ * 'imagequery.jobs.DatabaseQueue' stores the jobs in the database (needs
+   IMAGEQUERY_ALLOW_LAZY_FORMAT), run the imagequery_worker management command
+   to render them
+
+Other brokers may be used by implementing BaseQueue. Jobs are identified by
+their target (format, source and storages), enqueueing a job that is already
+pending does nothing.
+"""
+import hashlib
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:  # python 3
+    import queue
+from django.utils.encoding import smart_text
+from django.utils.importlib import import_module
+from imagequery import formats
+from imagequery.settings import RENDER_QUEUE, RENDER_QUEUE_WORKERS
+from imagequery.utils import get_storage_alias, get_storage_id
+
+logger = logging.getLogger('imagequery')
+
+
+def _storage_key(storage):
+    return get_storage_alias(storage) or get_storage_id(storage)
+
+
+def get_job_key(format_name, query):
+    '''
+    identifies the image the format creates for the query (format, source and
+    storage aliases), used for render jobs and lazy formats
+    '''
+    key = u'\n'.join([smart_text(x) for x in (
+        format_name,
+        _storage_key(query.storage),
+        query.source,
+        _storage_key(query.cache_storage),
+    )])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def render(format_name, query):
+    ''' renders the format for the query (if it does not exist yet) '''
+    format_cls = formats.get(format_name)
+    format_cls(query)._execute()._evaluate()
+
+
+class BaseQueue(object):
+    def enqueue(self, format_name, query):
+        ''' adds a job rendering the format for query, returns the job key '''
+        raise NotImplementedError()
+
+    def is_pending(self, key):
+        raise NotImplementedError()
+
+
+class LocalQueue(BaseQueue):
+    """ Renders the jobs in background threads of this process """
+
+    def __init__(self, workers=RENDER_QUEUE_WORKERS):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='imagequery-render-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            key, format_name, query = self._queue.get()
+            try:
+                render(format_name, query)
+            except Exception:
+                logger.exception('rendering %s for %s failed', format_name, query.source)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
+
+    def enqueue(self, format_name, query):
+        key = get_job_key(format_name, query)
+        with self._lock:
+            if key in self._pending:
+                return key
+            self._pending.add(key)
+            self._start()
+        self._queue.put((key, format_name, query))
+        return key
+
+    def is_pending(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def join(self):
+        ''' waits until all jobs are done '''
+        self._queue.join()
+
+
+class DatabaseQueue(BaseQueue):
+    """
+    Stores the jobs in the database (imagequery.models.RenderJob), process()
+    renders them (see the imagequery_worker management command)
+    """
+
+    def __init__(self):
+        try:
+            from imagequery.models import RenderJob
+        except ImportError:
+            from django.core.exceptions import ImproperlyConfigured
+            raise ImproperlyConfigured('You have to set "IMAGEQUERY_ALLOW_LAZY_FORMAT = True" in order to use '
+                                       'the database queue')
+        self.model = RenderJob
+
+    def enqueue(self, format_name, query):
+        from django.db import IntegrityError, transaction
+
+        key = get_job_key(format_name, query)
+        if self.model.objects.filter(key=key).exists():
+            return key
+        job = self.model(key=key, format=format_name)
+        job.query = query
+        try:
+            with transaction.atomic():
+                job.save(force_insert=True)
+        except IntegrityError:
+            # someone else added the job in the meantime
+            pass
+        return key
+
+    def is_pending(self, key):
+        return self.model.objects.filter(key=key, state__in=(self.model.PENDING, self.model.RUNNING)).exists()
+
+    def claim(self):
+        ''' returns the next pending job (marked as running), None if there is none '''
+        while True:
+            jobs = list(self.model.objects.filter(state=self.model.PENDING).order_by('created')[:10])
+            if not jobs:
+                return None
+            for job in jobs:
+                if self.model.objects.filter(pk=job.pk, state=self.model.PENDING).update(
+                        state=self.model.RUNNING, started=self.model.now()):
+                    return job
+
+    def process(self, limit=None):
+        ''' renders pending jobs, returns the number of processed jobs '''
+        self.model.objects.requeue_stale()
+        count = 0
+        while limit is None or count < limit:
+            job = self.claim()
+            if job is None:
+                break
+            count += 1
+            try:
+                render(job.format, job.query)
+            except Exception:
+                logger.exception('rendering %s for job %s failed', job.format, job.key)
+                job.fail()
+            else:
+                # finished jobs are not needed anymore
+                job.delete()
+        return count
+
+
+_queue = None
+
+
+def get_queue():
+    ''' returns the configured queue, None if IMAGEQUERY_RENDER_QUEUE is not set '''
+    global _queue
+    if _queue is None and RENDER_QUEUE:
+        module_name, class_name = RENDER_QUEUE.rsplit('.', 1)
+        _queue = getattr(import_module(module_name), class_name)()
+    return _queue
@@ -0,0 +1,206 @@
+"""
+Makes sure only one process renders the same image at a time
+
+When a popular image is missing in the cache every concurrent request would
+render it. With IMAGEQUERY_RENDER_LOCK set the first request takes a lock
+for the cache path, all others wait for it (at most IMAGEQUERY_LOCK_TIMEOUT
+seconds) and reuse the rendered image afterwards.
+
+Lock backends:
+ * 'file' uses file locks (fcntl) inside IMAGEQUERY_LOCK_DIR, only works if
+   all processes run on the same host
+ * 'cache' uses cache.add() of the Django cache (IMAGEQUERY_LOCK_CACHE),
+   works for shared deployments if the cache is shared (memcached, redis)
+ * 'auto' uses file locks for storages with local paths, the cache otherwise
+"""
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
+from django.utils.encoding import smart_text
+from imagequery.settings import RENDER_LOCK, LOCK_TIMEOUT, LOCK_EXPIRE, \
+    LOCK_DIR, LOCK_CACHE
+from imagequery.utils import get_cache, get_storage_id
+
+POLL_INTERVAL = 0.05
+
+_stats_lock = threading.Lock()
+_stats = {
+    'acquired': 0,
+    'contended': 0,
+    'timeouts': 0,
+    'wait_time': 0.0,
+}
+
+
+def get_stats():
+    '''
+    Returns the lock statistics of this process:
+     * acquired: number of locks acquired
+     * contended: number of locks already held by someone else
+     * timeouts: number of locks not acquired within the timeout
+     * wait_time: total seconds spent waiting for locks
+    '''
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+        _stats['wait_time'] = 0.0
+
+
+def _record(acquired, contended, wait_time):
+    with _stats_lock:
+        if acquired:
+            _stats['acquired'] += 1
+        else:
+            _stats['timeouts'] += 1
+        if contended:
+            _stats['contended'] += 1
+        _stats['wait_time'] += wait_time
+
+
+class FileLock(object):
+    '''
+    The lock file is removed on release. Processes which opened the file
+    before it got removed would lock the removed file, so acquire() checks
+    whether the locked file is still in place.
+    '''
+
+    def __init__(self, key):
+        self.path = os.path.join(LOCK_DIR, '%s.lock' % key)
+        self.fh = None
+
+    def acquire(self):
+        if not os.path.exists(LOCK_DIR):
+            try:
+                os.makedirs(LOCK_DIR)
+            except OSError:  # created concurrently
+                if not os.path.isdir(LOCK_DIR):
+                    raise
+        fh = open(self.path, 'a')
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            fh.close()
+            return False
+        try:
+            current = os.stat(self.path)
+        except OSError:  # removed by the previous holder
+            current = None
+        locked = os.fstat(fh.fileno())
+        if current is None or (current.st_dev, current.st_ino) != (locked.st_dev, locked.st_ino):
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            fh.close()
+            return False
+        self.fh = fh
+        return True
+
+    def release(self):
+        # remove the file while still holding the lock, see above
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        self.fh.close()
+        self.fh = None
+
+
+class CacheLock(object):
+    key_prefix = 'imagequery_lock_'
+
+    def __init__(self, key):
+        self.key = self.key_prefix + key
+        self.cache = get_cache(LOCK_CACHE)
+
+    def acquire(self):
+        # the lock expires, so crashed processes don't block the image forever
+        return self.cache.add(self.key, 1, LOCK_EXPIRE)
+
+    def release(self):
+        self.cache.delete(self.key)
+
+
+def get_lock(storage, name, backend=RENDER_LOCK):
+    ''' returns the lock for the given cache path, None if locking is disabled '''
+    if not backend:
+        return None
+    key = u'%s\n%s' % (get_storage_id(storage), smart_text(name))
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if backend == 'auto':
+        try:
+            storage.path(name)
+            backend = 'file'
+        except NotImplementedError:
+            backend = 'cache'
+    if backend == 'file' and fcntl is not None:
+        return FileLock(key)
+    return CacheLock(key)
+
+
+class LockResult(object):
+    def __init__(self, acquired, contended):
+        self.acquired = acquired
+        self.contended = contended
+
+
+@contextmanager
+def render_lock(storage, name, timeout=LOCK_TIMEOUT):
+    '''
+    Acquires the lock for the given cache path, waiting for timeout seconds.
+    Yields a LockResult, acquired is False if the lock could not be acquired,
+    contended is True if some other process did hold the lock (and thus
+    probably did render the image already).
+    '''
+    lock = get_lock(storage, name)
+    if lock is None:
+        yield LockResult(True, False)
+        return
+    started = time.time()
+    acquired = lock.acquire()
+    contended = not acquired
+    while not acquired and time.time() - started < timeout:
+        time.sleep(POLL_INTERVAL)
+        acquired = lock.acquire()
+    _record(acquired, contended, time.time() - started)
+    try:
+        yield LockResult(acquired, contended)
+    finally:
+        if acquired:
+            lock.release()
+
+
+@contextmanager
+def render_locks(targets, timeout=LOCK_TIMEOUT):
+    '''
+    Acquires the locks of multiple cache paths ((storage, name) pairs, see
+    render_lock()), always in the same order so processes locking
+    overlapping paths cannot deadlock. Yields the LockResults in the order
+    of targets.
+    '''
+    keys = [(get_storage_id(storage), smart_text(name)) for storage, name in targets]
+    # every path is locked once, even if it is passed multiple times
+    unique = {}
+    for key, target in zip(keys, targets):
+        unique.setdefault(key, target)
+    locked = {}
+    managers = []
+    try:
+        for key in sorted(unique):
+            manager = render_lock(unique[key][0], unique[key][1], timeout)
+            locked[key] = manager.__enter__()
+            managers.append(manager)
+        yield [locked[key] for key in keys]
+    finally:
+        for manager in reversed(managers):
+            manager.__exit__(None, None, None)
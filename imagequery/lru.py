@@ -0,0 +1,103 @@
+"""
+In-memory cache for decoded source images and intermediate results
+
+Rendering multiple formats of the same image would decode the source for
+every format. The image cache keeps decoded sources and the results of
+operation chains (keyed by source, modification time and query name) in
+memory, so all queries sharing the same source or the same leading
+operations can reuse them.
+
+The cache is bounded by IMAGEQUERY_MEMORY_CACHE_SIZE bytes (0 disables it),
+based on the pixel count and bands of each image. Least recently used images
+get evicted first, images bigger than IMAGEQUERY_MEMORY_CACHE_MAX_ITEM
+(fraction of the total size) are not cached at all, so one huge image
+cannot flush the whole cache.
+
+Cached images are shared by all queries using them, so they must never be
+modified in place: operations return new images (copy() before drawing or
+pasting) and raw() returns a copy.
+"""
+import threading
+from collections import OrderedDict
+
+from imagequery.settings import MEMORY_CACHE_SIZE, MEMORY_CACHE_MAX_ITEM
+
+# bytes per band, modes not listed here use one byte
+BAND_SIZES = {
+    'I': 4,
+    'F': 4,
+    'I;16': 2,
+    'I;16B': 2,
+    'I;16L': 2,
+}
+
+
+def image_size(image):
+    ''' returns the (approximate) number of bytes used by the image data '''
+    width, height = image.size
+    return width * height * len(image.getbands()) * BAND_SIZES.get(image.mode, 1)
+
+
+class ImageCache(object):
+    def __init__(self, max_size=MEMORY_CACHE_SIZE, max_item=MEMORY_CACHE_MAX_ITEM):
+        self.max_size = max_size
+        self.max_item_size = int(max_size * max_item)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                image, size = self._images.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move to the end (most recently used)
+            self._images[key] = (image, size)
+            self.hits += 1
+            return image
+
+    def set(self, key, image):
+        if not self.enabled:
+            return
+        size = image_size(image)
+        if size > self.max_item_size:
+            return
+        with self._lock:
+            if key in self._images:
+                self.size -= self._images.pop(key)[1]
+            self._images[key] = (image, size)
+            self.size += size
+            while self.size > self.max_size:
+                old_key, (old_image, old_size) = self._images.popitem(last=False)
+                self.size -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._images),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+image_cache = ImageCache()
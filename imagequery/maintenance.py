@@ -0,0 +1,368 @@
+"""
+Cache maintenance
+
+Generated images are never deleted on their own. Cleanup (used by the
+imagequery_cleanup management command) walks IMAGEQUERY_CACHE_DIR of the cache
+storage and deletes:
+ * orphans: images whose source does not exist anymore, optionally also
+   images whose chain hash is not produced by any registered Format
+ * images not used for max_age seconds
+ * the least recently (LRU) or least frequently (LFU) used images, until all
+   images fit into max_size bytes
+
+The walk is incremental: it stops after limit files and continues at the
+stored cursor on the next run. Cursor and the sizes of the visited images are
+kept in a SQLite database (IMAGEQUERY_CLEANUP_STATE). Eviction by size
+happens after a full pass, as it needs to know all images.
+
+Usage is recorded by the access log (IMAGEQUERY_ACCESS_LOG, path of a SQLite
+database), which counts every evaluation of a cached image and writes the
+counts every IMAGEQUERY_ACCESS_LOG_FLUSH seconds. Without access log the
+access (or modification) time of the files is used, if the storage knows it.
+
+Note that sources can only be found again if the cached image is named by
+its source path. In-memory images and content-addressed images (see
+imagequery.digest) are never considered orphans. Images of sources given by
+absolute path are named by the basename of the source only, these are
+deleted as orphans (and rendered again when used), so only enable orphan
+detection if all sources are stored in the source storage.
+"""
+import atexit
+import os
+import posixpath
+import re
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from imagequery.manifest import get_manifest, get_key as get_manifest_key
+from imagequery.settings import CACHE_DIR, ACCESS_LOG, ACCESS_LOG_FLUSH, CLEANUP_STATE
+from imagequery.utils import get_storage_id
+
+# names which cannot be mapped back to their source
+UNKNOWN_SOURCE_RE = re.compile(r'^([0-9a-f]{2}/[0-9a-f]{40}|[0-9a-f]{32}\.png)')
+
+
+def _connect(path, *statements):
+    import sqlite3
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    connection = sqlite3.connect(path, timeout=30)
+    for statement in statements:
+        connection.execute(statement)
+    return connection
+
+
+def _timestamp(value):
+    return time.mktime(value.timetuple())
+
+
+class AccessLog(object):
+    """ Counts how often and when cached images are used """
+
+    def __init__(self, path=ACCESS_LOG, flush_interval=ACCESS_LOG_FLUSH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = _connect(self.path,
+                'CREATE TABLE IF NOT EXISTS imagequery_access ('
+                'key TEXT PRIMARY KEY, accessed REAL, hits INTEGER)')
+            self._local.connection = connection
+        return connection
+
+    def _key(self, storage, name):
+        return u'%s:%s' % (get_storage_id(storage), name)
+
+    def record(self, storage, name):
+        now = time.time()
+        key = self._key(storage, name)
+        with self._lock:
+            hits = self._pending.get(key, (0, None))[0]
+            self._pending[key] = (hits + 1, now)
+            if now - self._flushed < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+        if not pending:
+            return
+        with self.connection:
+            for key, (hits, accessed) in pending.items():
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO imagequery_access (key, accessed, hits) VALUES (?, ?, 0)',
+                    [key, accessed])
+                self.connection.execute(
+                    'UPDATE imagequery_access SET accessed = ?, hits = hits + ? WHERE key = ?',
+                    [accessed, hits, key])
+
+    def get(self, storage, name):
+        ''' returns (last access time, hits), None if the image was never used '''
+        key = self._key(storage, name)
+        row = self.connection.execute(
+            'SELECT accessed, hits FROM imagequery_access WHERE key = ?', [key]).fetchone()
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            if row is None:
+                return pending[1], pending[0]
+            return pending[1], row[1] + pending[0]
+        return row
+
+    def delete(self, storage, name):
+        key = self._key(storage, name)
+        with self._lock:
+            self._pending.pop(key, None)
+        with self.connection:
+            self.connection.execute('DELETE FROM imagequery_access WHERE key = ?', [key])
+
+
+_access_log = None
+
+
+def get_access_log():
+    ''' returns the access log, None if IMAGEQUERY_ACCESS_LOG is not set '''
+    global _access_log
+    if _access_log is None and ACCESS_LOG:
+        _access_log = AccessLog()
+        atexit.register(_access_log.flush)
+    return _access_log
+
+
+def get_format_chains():
+    ''' returns the chain hashes (query names) of all registered formats '''
+    from imagequery import formats  # late import to avoid circular import
+    from imagequery.query import RawImageQuery
+
+    image = Image.new('RGB', (1, 1))
+    chains = set()
+    for format_cls in formats._formats.values():
+        chains.add(format_cls(RawImageQuery(image))._execute().query.name())
+    return chains
+
+
+def walk(storage, path, cursor=None):
+    '''
+    Yields the names of all files below path in sorted order (by path
+    components). Files up to cursor (tuple of path components) are skipped,
+    directories completely before the cursor are not listed at all.
+    '''
+    try:
+        directories, files = storage.listdir(path)
+    except OSError:
+        return
+    entries = [(name, True) for name in directories] + [(name, False) for name in files]
+    for name, is_directory in sorted(entries):
+        name = posixpath.join(path, name)
+        parts = tuple(name.split('/'))
+        if cursor is not None:
+            if is_directory and parts < cursor[:len(parts)]:
+                continue
+            if not is_directory and parts <= cursor:
+                continue
+        if is_directory:
+            for child in walk(storage, name, cursor):
+                yield child
+        else:
+            yield name
+
+
+class Cleanup(object):
+    """
+    Deletes cached images (see module documentation), policy is 'lru' or
+    'lfu'. Use run() to process the next limit files.
+    """
+
+    def __init__(self, cache_storage, storage=None, max_size=None, max_age=None, policy='lru',
+                 orphans=False, unknown_chains=False, limit=None, sleep=0, dry_run=False,
+                 state_path=CLEANUP_STATE, log=None):
+        assert policy in ('lru', 'lfu'), 'unknown policy %s' % policy
+        self.cache_storage = cache_storage
+        if storage is None:
+            storage = cache_storage
+        self.storage = storage
+        self.max_size = max_size
+        self.max_age = max_age
+        self.policy = policy
+        self.orphans = orphans
+        self.limit = limit
+        self.sleep = sleep
+        self.dry_run = dry_run
+        self.log = log
+        self.storage_id = get_storage_id(cache_storage)
+        self.connection = _connect(state_path,
+            'CREATE TABLE IF NOT EXISTS imagequery_cleanup_files ('
+            'storage TEXT, name TEXT, size INTEGER, accessed REAL, hits INTEGER, '
+            'PRIMARY KEY (storage, name))',
+            'CREATE TABLE IF NOT EXISTS imagequery_cleanup_cursor ('
+            'storage TEXT PRIMARY KEY, cursor TEXT)')
+        if unknown_chains:
+            self.chains = get_format_chains()
+        else:
+            self.chains = None
+        self.access_log = get_access_log()
+        self.stats = {'checked': 0, 'deleted': 0, 'freed': 0, 'finished': False}
+
+    def get_cursor(self):
+        row = self.connection.execute(
+            'SELECT cursor FROM imagequery_cleanup_cursor WHERE storage = ?', [self.storage_id]).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple(row[0].split('/'))
+
+    def set_cursor(self, name):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO imagequery_cleanup_cursor (storage, cursor) VALUES (?, ?)',
+            [self.storage_id, name])
+
+    def reset(self):
+        ''' forgets the cursor and the collected images, the next run starts a new pass '''
+        with self.connection:
+            self.connection.execute('DELETE FROM imagequery_cleanup_files WHERE storage = ?', [self.storage_id])
+            self.connection.execute('DELETE FROM imagequery_cleanup_cursor WHERE storage = ?', [self.storage_id])
+
+    def get_access(self, name):
+        ''' returns (last access time, hits) '''
+        if self.access_log is not None:
+            record = self.access_log.get(self.cache_storage, name)
+            if record is not None:
+                return record
+        for method in ('accessed_time', 'modified_time'):
+            try:
+                return _timestamp(getattr(self.cache_storage, method)(name)), 0
+            except (NotImplementedError, AttributeError, OSError):
+                pass
+        return None, 0
+
+    def source_missing(self, source):
+        if UNKNOWN_SOURCE_RE.match(source):
+            return False
+        # the extension of the format might have been appended to the source
+        for candidate in (source, os.path.splitext(source)[0]):
+            if candidate and self.storage.exists(candidate):
+                return False
+        return True
+
+    def check(self, name):
+        ''' returns the reason to delete the image, None to keep it '''
+        try:
+            chain, source = name[len(CACHE_DIR) + 1:].split('/', 1)
+        except ValueError:
+            return None
+        if self.chains is not None and chain not in self.chains:
+            return 'unknown chain'
+        if self.orphans and self.source_missing(source):
+            return 'orphan'
+        if self.max_age:
+            accessed, hits = self.get_access(name)
+            if accessed is not None and accessed < time.time() - self.max_age:
+                return 'expired'
+        return None
+
+    def delete(self, name, reason, size=None):
+        if size is None:
+            try:
+                size = self.cache_storage.size(name)
+            except (NotImplementedError, OSError):
+                size = 0
+        if self.log is not None:
+            self.log(name, reason, size)
+        self.stats['deleted'] += 1
+        self.stats['freed'] += size
+        if self.dry_run:
+            return
+        self.cache_storage.delete(name)
+        self.forget(name)
+
+    def forget(self, name):
+        ''' removes the image from the manifest and the access log '''
+        manifest = get_manifest()
+        manifest.delete_name(name)
+        chain, source = name[len(CACHE_DIR) + 1:].split('/', 1)
+        basename, ext = os.path.splitext(source)
+        if not Image.EXTENSION:
+            Image.init()
+        for candidate in (source, basename):
+            for format in (None, Image.EXTENSION.get(ext.lower())):
+                manifest.delete(get_manifest_key(self.cache_storage, candidate, chain, format))
+        if self.access_log is not None:
+            self.access_log.delete(self.cache_storage, name)
+
+    def remember(self, name):
+        ''' records the image for eviction by size '''
+        try:
+            size = self.cache_storage.size(name)
+        except (NotImplementedError, OSError):
+            return
+        accessed, hits = self.get_access(name)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO imagequery_cleanup_files (storage, name, size, accessed, hits) '
+            'VALUES (?, ?, ?, ?, ?)', [self.storage_id, name, size, accessed or 0, hits])
+
+    def evict(self):
+        ''' deletes images until max_size is reached, needs a full pass '''
+        total = self.connection.execute(
+            'SELECT SUM(size) FROM imagequery_cleanup_files WHERE storage = ?',
+            [self.storage_id]).fetchone()[0] or 0
+        if not self.max_size or total <= self.max_size:
+            return
+        if self.policy == 'lfu':
+            order = 'hits, accessed'
+        else:
+            order = 'accessed'
+        rows = self.connection.execute(
+            'SELECT name, size FROM imagequery_cleanup_files WHERE storage = ? '
+            'ORDER BY %s' % order, [self.storage_id]).fetchall()
+        for name, size in rows:
+            if total <= self.max_size:
+                break
+            self.delete(name, self.policy, size)
+            total -= size
+
+    def run(self):
+        '''
+        processes the next limit files, returns the statistics. Dry runs
+        don't change the stored state.
+        '''
+        cursor = self.get_cursor()
+        finished = True
+        for name in walk(self.cache_storage, CACHE_DIR, cursor):
+            if self.limit is not None and self.stats['checked'] >= self.limit:
+                finished = False
+                break
+            self.stats['checked'] += 1
+            reason = self.check(name)
+            if reason is None:
+                self.remember(name)
+            else:
+                self.delete(name, reason)
+            self.set_cursor(name)
+            if self.stats['checked'] % 100 == 0 and not self.dry_run:
+                self.connection.commit()
+            if self.sleep:
+                time.sleep(self.sleep)
+        if finished:
+            self.evict()
+        if self.dry_run:
+            self.connection.rollback()
+        elif finished:
+            self.reset()
+        else:
+            self.connection.commit()
+        self.stats['finished'] = finished
+        return self.stats
@@ -0,0 +1,56 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from imagequery import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Runs the ImageQuery benchmarks, optionally comparing them against a baseline'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='Store the results as JSON in this file'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='Compare the results against this JSON file'),
+        make_option('--threshold', dest='threshold', type='float', default=0.1,
+            help='Allowed slowdown compared to the baseline (0.1 = 10%%)'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='Number of runs per benchmark'),
+        make_option('--sizes', dest='sizes', default=None,
+            help='Comma separated image sizes for the operation benchmarks'),
+        make_option('--modes', dest='modes', default=None,
+            help='Comma separated image modes for the operation benchmarks'),
+        make_option('--images', dest='images', type='int', default=20,
+            help='Number of images rendered by the template benchmarks'),
+        make_option('--only', dest='only', default=None,
+            help='Only run benchmarks containing this string'),
+    )
+
+    def log(self, name, result):
+        if 'error' in result:
+            self.stdout.write('%-45s %s\n' % (name, result['error']))
+        else:
+            self.stdout.write('%-45s %10.4fs %10.4fs\n' % (name, result['time'], result['mean']))
+
+    def handle(self, *args, **options):
+        sizes, modes = benchmark.SIZES, benchmark.MODES
+        if options['sizes']:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        if options['modes']:
+            modes = options['modes'].split(',')
+        results = benchmark.run(
+            repeat=options['repeat'],
+            sizes=sizes,
+            modes=modes,
+            images=options['images'],
+            only=options['only'],
+            log=self.log,
+        )
+        if options['output']:
+            benchmark.save(results, options['output'])
+        if options['baseline']:
+            regressions = benchmark.compare(results, benchmark.load(options['baseline']),
+                options['threshold'])
+            for name, old, new, ratio in regressions:
+                self.stdout.write('REGRESSION %-34s %10.4fs -> %10.4fs (%.0f%%)\n' % (
+                    name, old, new, (ratio - 1) * 100))
+            if regressions:
+                raise CommandError('%d benchmarks got slower' % len(regressions))
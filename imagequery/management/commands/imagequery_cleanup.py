@@ -0,0 +1,80 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from imagequery.maintenance import Cleanup
+from imagequery.settings import default_storage, default_cache_storage
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    ''' parses sizes like 500M or 2G '''
+    value = value.strip().upper()
+    try:
+        if value and value[-1] in UNITS:
+            return int(float(value[:-1]) * UNITS[value[-1]])
+        return int(value)
+    except ValueError:
+        raise CommandError('invalid size %s' % value)
+
+
+class Command(BaseCommand):
+    help = 'Deletes orphaned, old and least used images from the cache (see imagequery.maintenance). ' \
+           'Runs with --limit continue where the last run stopped.'
+    option_list = BaseCommand.option_list + (
+        make_option('--max-size', dest='max_size', default=None,
+            help='Size budget of the cache (like 500M or 20G), applied after a full pass'),
+        make_option('--max-age', dest='max_age', type='float', default=None,
+            help='Delete images not used for this number of days'),
+        make_option('--policy', dest='policy', default='lru', choices=('lru', 'lfu'),
+            help='Evict least recently (lru) or least frequently (lfu) used images first'),
+        make_option('--orphans', dest='orphans', action='store_true', default=False,
+            help='Delete images whose source does not exist anymore'),
+        make_option('--unknown-chains', dest='unknown_chains', action='store_true', default=False,
+            help='Delete images not produced by any registered format'),
+        make_option('--limit', dest='limit', type='int', default=None,
+            help='Check at most this number of files, the next run continues after them'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+            help='Seconds to sleep after every file'),
+        make_option('--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Only list the images that would be deleted'),
+        make_option('--reset', dest='reset', action='store_true', default=False,
+            help='Start a new pass instead of continuing the last one'),
+        make_option('--lazy-formats', dest='lazy_formats', action='store_true', default=False,
+            help='Only delete old lazy formats and failed render jobs from the database'),
+    )
+
+    def cleanup_lazy_formats(self):
+        try:
+            from imagequery.models import LazyFormat
+        except ImportError:
+            raise CommandError('lazy formats are not enabled (IMAGEQUERY_ALLOW_LAZY_FORMAT)')
+        LazyFormat.objects.cleanup()
+
+    def handle(self, *args, **options):
+        if options['lazy_formats']:
+            self.cleanup_lazy_formats()
+            return
+        verbosity = int(options.get('verbosity', 1))
+        max_size = options['max_size']
+        if max_size is not None:
+            max_size = parse_size(max_size)
+        max_age = options['max_age']
+        if max_age is not None:
+            max_age = max_age * 86400
+
+        def log(name, reason, size):
+            if verbosity > 1 or options['dry_run']:
+                self.stdout.write('%s (%s, %d bytes)\n' % (name, reason, size))
+
+        cleanup = Cleanup(default_cache_storage or default_storage, storage=default_storage,
+            max_size=max_size, max_age=max_age, policy=options['policy'],
+            orphans=options['orphans'], unknown_chains=options['unknown_chains'],
+            limit=options['limit'], sleep=options['sleep'], dry_run=options['dry_run'], log=log)
+        if options['reset']:
+            cleanup.reset()
+        stats = cleanup.run()
+        self.stdout.write('checked=%(checked)d deleted=%(deleted)d freed=%(freed)d bytes' % stats)
+        if stats['finished']:
+            self.stdout.write(' (pass finished)\n')
+        else:
+            self.stdout.write(' (continue with the next run)\n')
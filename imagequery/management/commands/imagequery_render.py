@@ -0,0 +1,50 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from imagequery import batch, formats
+
+
+class Command(BaseCommand):
+    args = '<format>[,<format> ...] [<source> ...]'
+    help = 'Renders the given formats for all sources (or all images of a model field) ' \
+           'which are not cached yet'
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model', default=None,
+            help='Render all images of this model (app_label.ModelName), needs --field'),
+        make_option('--field', dest='field', default=None,
+            help='Name of the image field of --model'),
+        make_option('--workers', dest='workers', type='int', default=None,
+            help='Number of worker processes, defaults to the number of CPUs. 0 disables the process pool'),
+        make_option('--force', dest='force', action='store_true', default=False,
+            help='Render images even if they already exist'),
+    )
+
+    def get_sources(self, sources, model, field):
+        if not model:
+            return sources
+        from django.db.models import get_model
+
+        if not field:
+            raise CommandError('--model needs --field')
+        try:
+            app_label, model_name = model.split('.', 1)
+        except ValueError:
+            raise CommandError('--model must be given as app_label.ModelName')
+        model_cls = get_model(app_label, model_name)
+        if model_cls is None:
+            raise CommandError('model %s does not exist' % model)
+        files = (getattr(obj, field) for obj in model_cls._default_manager.all().iterator())
+        return list(sources) + [f for f in files if f]
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('you need to pass the format name')
+        format_names, sources = args[0].split(','), args[1:]
+        for format_name in format_names:
+            try:
+                formats.get(format_name)
+            except formats.FormatDoesNotExist:
+                raise CommandError('format %s is not registered' % format_name)
+        sources = self.get_sources(sources, options['model'], options['field'])
+        result = batch.render_formats(format_names, sources,
+            workers=options['workers'], force=options['force'])
+        self.stdout.write(result.summary() + '\n')
@@ -0,0 +1,38 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from imagequery.jobs import DatabaseQueue
+
+
+class Command(BaseCommand):
+    help = 'Renders the jobs of the database render queue (see imagequery.jobs), ' \
+           'removes old lazy formats periodically'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', dest='once', action='store_true', default=False,
+            help='Exit when no jobs are pending'),
+        make_option('--interval', dest='interval', type='float', default=1.0,
+            help='Seconds to wait for new jobs'),
+        make_option('--cleanup-interval', dest='cleanup_interval', type='float', default=3600,
+            help='Seconds between removing old lazy formats, 0 disables removing them'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            from imagequery.models import LazyFormat
+        except ImportError:
+            raise CommandError('lazy formats are not enabled (IMAGEQUERY_ALLOW_LAZY_FORMAT)')
+        queue = DatabaseQueue()
+        verbosity = int(options.get('verbosity', 1))
+        cleanup_interval = options['cleanup_interval']
+        last_cleanup = 0
+        while True:
+            if cleanup_interval and time.time() - last_cleanup >= cleanup_interval:
+                LazyFormat.objects.cleanup()
+                last_cleanup = time.time()
+            count = queue.process()
+            if count and verbosity > 1:
+                self.stdout.write('rendered %d jobs\n' % count)
+            if options['once']:
+                break
+            if not count:
+                time.sleep(options['interval'])
@@ -0,0 +1,255 @@
+"""
+Index of already generated images
+
+Checking whether a cached image exists needs multiple storage calls (exists,
+path and getmtime for both files). The manifest remembers every image that
+was generated or found in the cache, so warm renders don't need to touch the
+storage at all.
+
+Configure a backend using IMAGEQUERY_MANIFEST_BACKEND:
+ * 'imagequery.manifest.CacheManifest' uses the Django cache (see
+   IMAGEQUERY_MANIFEST_CACHE), useful if multiple servers share the images
+ * 'imagequery.manifest.SQLiteManifest' uses a local SQLite file (see
+   IMAGEQUERY_MANIFEST_PATH)
+
+Besides the records of generated images the manifest stores metadata of
+sources (like probe results, see imagequery.probe) using get_metadata() and
+set_metadata(), separated from the image records.
+
+Entries are keyed by (cache storage, source, query name, format) and get
+replaced whenever the image is rendered again. Records store the
+modification time of the source, records of changed sources count as
+missing. Storages providing neither local paths nor modification times
+cannot notice overwritten sources, use delete() or clear() in this case.
+delete_name() removes all records of a generated image (used when cached
+images are deleted, see imagequery.maintenance).
+"""
+import hashlib
+import os
+import threading
+import time
+
+from django.utils.encoding import smart_text
+from django.utils.importlib import import_module
+from imagequery.settings import MANIFEST_BACKEND, MANIFEST_CACHE, MANIFEST_PATH, \
+    MANIFEST_TIMEOUT
+from imagequery.utils import get_cache, get_storage_id
+
+
+def get_key(storage, source, name, format):
+    key = u'\n'.join([smart_text(x) for x in (get_storage_id(storage), source, name, format)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class BaseManifest(object):
+    """
+    Manifest backend, records are dicts containing the name of the generated
+    image ('name'), the modification time of the source ('mtime') and the time
+    the record was created ('created').
+    """
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        ''' returns a dict containing the records for all known keys '''
+        return {}
+
+    def set(self, key, record):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def delete_name(self, name):
+        ''' deletes all records of the generated image name, if supported '''
+        pass
+
+    def get_metadata(self, kind, key):
+        ''' returns (value, source mtime) of the metadata kind for key, None if unknown '''
+        return None
+
+    def set_metadata(self, kind, key, value, mtime):
+        pass
+
+    def clear(self):
+        pass
+
+
+class DummyManifest(BaseManifest):
+    """ Used if no manifest backend is configured, does nothing """
+    pass
+
+
+class CacheManifest(BaseManifest):
+    """ Stores the manifest using the Django cache """
+
+    key_prefix = 'imagequery_manifest_'
+    # stores the generation of the keys, changed by clear()
+    version_key = 'imagequery_manifest_version'
+
+    def __init__(self, alias=MANIFEST_CACHE, timeout=MANIFEST_TIMEOUT):
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def _prefix(self):
+        return '%s%s_' % (self.key_prefix, self.cache.get(self.version_key, 1))
+
+    def _name_key(self, prefix, name):
+        # lists the keys of the records of a generated image, for delete_name()
+        return '%sname_%s' % (prefix, hashlib.sha1(smart_text(name).encode('utf-8')).hexdigest())
+
+    def get_many(self, keys):
+        prefix = self._prefix()
+        cache_keys = dict((prefix + key, key) for key in keys)
+        records = self.cache.get_many(list(cache_keys.keys()))
+        return dict((cache_keys[cache_key], record) for cache_key, record in records.items())
+
+    def set(self, key, record):
+        prefix = self._prefix()
+        self.cache.set(prefix + key, record, self.timeout)
+        name_key = self._name_key(prefix, record['name'])
+        keys = self.cache.get(name_key) or []
+        if key not in keys:
+            keys = keys + [key]
+        # stored again to keep it as long as the record
+        self.cache.set(name_key, keys, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._prefix() + key)
+
+    def delete_name(self, name):
+        prefix = self._prefix()
+        name_key = self._name_key(prefix, name)
+        keys = self.cache.get(name_key) or []
+        self.cache.delete_many([prefix + key for key in keys] + [name_key])
+
+    def get_metadata(self, kind, key):
+        return self.cache.get('%smeta_%s_%s' % (self._prefix(), kind, key))
+
+    def set_metadata(self, kind, key, value, mtime):
+        self.cache.set('%smeta_%s_%s' % (self._prefix(), kind, key), (value, mtime), self.timeout)
+
+    def clear(self):
+        # the cache does not allow deleting only our keys, so we switch to
+        # new keys and let the old entries expire
+        try:
+            self.cache.incr(self.version_key)
+        except ValueError:  # no version stored yet (or expired with all old entries)
+            self.cache.set(self.version_key, 2, self.timeout)
+
+
+class SQLiteManifest(BaseManifest):
+    """ Stores the manifest inside a local SQLite database file """
+
+    # SQLite limits the number of query parameters
+    chunk_size = 500
+
+    def __init__(self, path=MANIFEST_PATH, timeout=MANIFEST_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        import sqlite3
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS imagequery_manifest ('
+                'key TEXT PRIMARY KEY, name TEXT, mtime REAL, created REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS imagequery_manifest_name ON imagequery_manifest (name)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS imagequery_metadata ('
+                'kind TEXT, key TEXT, value TEXT, mtime REAL, created REAL, PRIMARY KEY (kind, key))')
+            self._local.connection = connection
+        return connection
+
+    def _min_created(self):
+        if self.timeout:
+            return time.time() - self.timeout
+        return 0
+
+    def get_many(self, keys):
+        result = {}
+        keys = list(keys)
+        min_created = self._min_created()
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = keys[i:i + self.chunk_size]
+            cursor = self.connection.execute(
+                'SELECT key, name, mtime, created FROM imagequery_manifest '
+                'WHERE created >= ? AND key IN (%s)' % ', '.join(['?'] * len(chunk)),
+                [min_created] + chunk)
+            for key, name, mtime, created in cursor:
+                result[key] = {'name': name, 'mtime': mtime, 'created': created}
+        return result
+
+    def set(self, key, record):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO imagequery_manifest (key, name, mtime, created) '
+                'VALUES (?, ?, ?, ?)',
+                [key, record['name'], record.get('mtime'), record['created']])
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute('DELETE FROM imagequery_manifest WHERE key = ?', [key])
+
+    def delete_name(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM imagequery_manifest WHERE name = ?', [name])
+
+    def get_metadata(self, kind, key):
+        return self.connection.execute(
+            'SELECT value, mtime FROM imagequery_metadata WHERE kind = ? AND key = ? AND created >= ?',
+            [kind, key, self._min_created()]).fetchone()
+
+    def set_metadata(self, kind, key, value, mtime):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO imagequery_metadata (kind, key, value, mtime, created) '
+                'VALUES (?, ?, ?, ?, ?)', [kind, key, value, mtime, time.time()])
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM imagequery_manifest')
+            self.connection.execute('DELETE FROM imagequery_metadata')
+
+
+_manifest = None
+
+
+def get_manifest():
+    global _manifest
+    if _manifest is None:
+        if MANIFEST_BACKEND:
+            module_name, class_name = MANIFEST_BACKEND.rsplit('.', 1)
+            _manifest = getattr(import_module(module_name), class_name)()
+        else:
+            _manifest = DummyManifest()
+    return _manifest
+
+
+def bulk_exists(queries):
+    '''
+    Checks which of the given queries already have a generated image using
+    only one manifest lookup, returns a list of booleans. Records of changed
+    sources count as missing. Queries found in the
+    manifest don't need to check the storage again when calling url() and
+    friends.
+    '''
+    keys = [query._manifest_key() for query in queries]
+    records = get_manifest().get_many([key for key in keys if key])
+    result = []
+    for query, key in zip(queries, keys):
+        exists = query._valid_record(records.get(key))
+        if exists:
+            query._evaluated = True
+        result.append(exists)
+    return result
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+# Internal statistics (see imagequery.stats), not included in imagequery.urls.
+# Only include this where the public cannot reach it (like an internal host
+# scraped by Prometheus).
+from django.conf.urls import *
+
+urlpatterns = patterns('imagequery.views',
+    url(r'^metrics$', 'metrics', name='imagequery_metrics'),
+)
@@ -0,0 +1,30 @@
+import logging
+import threading
+
+from django.conf import settings
+from imagequery.stats import StatsCollector
+
+logger = logging.getLogger('imagequery')
+
+
+class StatsMiddleware(object):
+    """
+    Collects the ImageQuery statistics for every request, the summary is
+    logged (logger "imagequery", debug level) and added as X-ImageQuery-Stats
+    header if DEBUG is enabled.
+    """
+
+    def process_request(self, request):
+        request.imagequery_stats = StatsCollector(thread=threading.current_thread())
+        request.imagequery_stats.connect()
+
+    def process_response(self, request, response):
+        stats = getattr(request, 'imagequery_stats', None)
+        if stats is None:
+            return response
+        stats.disconnect()
+        summary = stats.summary()
+        logger.debug('%s %s', request.path, summary)
+        if settings.DEBUG:
+            response['X-ImageQuery-Stats'] = summary
+        return response
@@ -1,10 +1,14 @@
 # we need a models.py file to make the django test runner determine the tests
-from imagequery.settings import ALLOW_LAZY_FORMAT, LAZY_FORMAT_CLEANUP_TIME, AUTOLOAD_FORMATS
+from imagequery.settings import ALLOW_LAZY_FORMAT, LAZY_FORMAT_CLEANUP_TIME, AUTOLOAD_FORMATS, \
+    COLLECT_STATS, RENDER_JOB_TIMEOUT, RENDER_JOB_ATTEMPTS
 
 if ALLOW_LAZY_FORMAT:
+    import threading
+    import time
+    from collections import OrderedDict
     from django.db import models
-    from django.utils.functional import LazyObject
     from datetime import datetime, timedelta
+    from imagequery.utils import get_storage, get_storage_alias
 
     try:
         import cPickle as pickle
@@ -12,20 +16,86 @@ if ALLOW_LAZY_FORMAT:
         import pickle
 
 
-    def resolve_lazy(obj):
-        if isinstance(obj, LazyObject):
-            obj._setup()
-            return obj._wrapped
-        return obj
+    def dump_query(imagequery):
+        from imagequery.query import ImageQuery
+
+        if not isinstance(imagequery, ImageQuery):
+            raise TypeError('this only works for ImageQuery')
+        data = {'source': imagequery.source}
+        # storages are referenced by alias (see IMAGEQUERY_STORAGES)
+        for key in ('storage', 'cache_storage'):
+            alias = get_storage_alias(getattr(imagequery, key))
+            if alias is None:
+                raise ValueError('the %s of %s is not registered (see IMAGEQUERY_STORAGES)' % (
+                    key, imagequery.source))
+            data[key + '_alias'] = alias
+        return pickle.dumps(data)
+
+
+    def load_query(query_data):
+        from imagequery.query import ImageQuery
+
+        try:
+            data = pickle.loads(str(query_data))
+        except pickle.UnpicklingError:
+            raise RuntimeError('could not load data')
+        return ImageQuery(source=data['source'],
+            storage=get_storage(data['storage_alias']),
+            cache_storage=get_storage(data['cache_storage_alias']))
+
+
+    # keys of existing lazy formats, mapped to the time they get deleted by
+    # cleanup(), so get_for_query() doesn't need to ask the database again
+    MAX_KNOWN_KEYS = 10000
+    _known_keys = OrderedDict()
+    _known_keys_lock = threading.Lock()
 
 
     class LazyFormatManager(models.Manager):
         def cleanup(self):
             cleanup_time = datetime.now() - timedelta(seconds=LAZY_FORMAT_CLEANUP_TIME)
             self.filter(created__lt=cleanup_time).delete()
+            RenderJob.objects.filter(state=RenderJob.FAILED, created__lt=cleanup_time).delete()
+
+        def get_for_query(self, format, imagequery):
+            '''
+            Returns the key of the lazy format for the ImageQuery, creates the
+            lazy format if it does not exist yet. Raises ValueError if the
+            storages are not registered.
+            '''
+            from django.db import IntegrityError
+            from imagequery.jobs import get_job_key
+
+            key = get_job_key(format, imagequery)
+            with _known_keys_lock:
+                expires = _known_keys.get(key)
+            if expires is not None and expires > time.time():
+                return key
+            try:
+                lazy_format, created = self.get_or_create(key=key, defaults={
+                    'format': format,
+                    'query_data': dump_query(imagequery),
+                })
+            except IntegrityError:
+                # created by someone else in the meantime
+                return key
+            expires = time.mktime(lazy_format.created.timetuple()) + LAZY_FORMAT_CLEANUP_TIME
+            with _known_keys_lock:
+                _known_keys.pop(key, None)
+                _known_keys[key] = expires
+                while len(_known_keys) > MAX_KNOWN_KEYS:
+                    _known_keys.popitem(last=False)
+            return key
+
+        def get_url(self, format, imagequery):
+            from django.core.urlresolvers import reverse
+
+            return reverse('imagequery_generate_lazy', kwargs={'key': self.get_for_query(format, imagequery)})
 
 
     class LazyFormat(models.Model):
+        # identifies format, source and storages (see imagequery.jobs.get_job_key)
+        key = models.CharField(max_length=40, unique=True)
         format = models.CharField(max_length=100)
         query_data = models.TextField()
         created = models.DateTimeField(default=datetime.now)
@@ -33,35 +103,16 @@ if ALLOW_LAZY_FORMAT:
         objects = LazyFormatManager()
 
         def _set_query(self, imagequery):
-            from imagequery.query import ImageQuery
-
-            if not isinstance(imagequery, ImageQuery):
-                raise TypeError('this only works for ImageQuery')
-            data = {
-                'source': imagequery.source,
-                'storage': resolve_lazy(imagequery.storage),
-                'cache_storage': resolve_lazy(imagequery.cache_storage),
-            }
-            self.query_data = pickle.dumps(data)
+            self.query_data = dump_query(imagequery)
 
         def _get_query(self):
-            from imagequery.query import ImageQuery
-
-            try:
-                data = pickle.loads(str(self.query_data))
-            except pickle.UnpicklingError:
-                raise RuntimeError('could not load data')
-            return ImageQuery(
-                source=data['source'],
-                storage=data['storage'],
-                cache_storage=data['cache_storage'],
-            )
+            return load_query(self.query_data)
 
         query = property(_get_query, _set_query)
 
         @models.permalink
         def get_absolute_url(self):
-            return 'imagequery_generate_lazy', (), {'pk': self.pk}
+            return 'imagequery_generate_lazy', (), {'key': self.key}
 
         def generate_image_url(self):
             from imagequery import formats
@@ -69,6 +120,58 @@ if ALLOW_LAZY_FORMAT:
             format = formats.get(self.format)
             return format(self.query).url()
 
+
+    class RenderJobManager(models.Manager):
+        def requeue_stale(self):
+            ''' jobs running longer than IMAGEQUERY_RENDER_JOB_TIMEOUT belong to crashed workers '''
+            stale_time = datetime.now() - timedelta(seconds=RENDER_JOB_TIMEOUT)
+            self.filter(state=RenderJob.RUNNING, started__lt=stale_time).update(state=RenderJob.PENDING)
+
+
+    class RenderJob(models.Model):
+        """ Job of imagequery.jobs.DatabaseQueue, deleted when done """
+        PENDING = 'pending'
+        RUNNING = 'running'
+        FAILED = 'failed'
+        STATES = (
+            (PENDING, 'pending'),
+            (RUNNING, 'running'),
+            (FAILED, 'failed'),
+        )
+
+        key = models.CharField(max_length=40, unique=True)
+        format = models.CharField(max_length=100)
+        query_data = models.TextField()
+        state = models.CharField(max_length=10, choices=STATES, default=PENDING, db_index=True)
+        attempts = models.PositiveIntegerField(default=0)
+        created = models.DateTimeField(default=datetime.now)
+        started = models.DateTimeField(null=True, blank=True)
+
+        objects = RenderJobManager()
+
+        now = staticmethod(datetime.now)
+
+        def _set_query(self, imagequery):
+            self.query_data = dump_query(imagequery)
+
+        def _get_query(self):
+            return load_query(self.query_data)
+
+        query = property(_get_query, _set_query)
+
+        def fail(self):
+            self.attempts += 1
+            if self.attempts < RENDER_JOB_ATTEMPTS:
+                self.state = self.PENDING
+            else:
+                self.state = self.FAILED
+            self.save()
+
 if AUTOLOAD_FORMATS:
     import imagequery.autoload
 
+if COLLECT_STATS:
+    from imagequery.stats import collector
+
+    collector.connect()
+
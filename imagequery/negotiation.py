@@ -0,0 +1,107 @@
+"""
+Negotiation of output formats
+
+Browsers announce the image formats they support in the Accept header (like
+"image/avif,image/webp,*/*"). negotiate() returns the variant of a query
+using the most preferred format of IMAGEQUERY_NEGOTIATE_FORMATS accepted by
+the client, or the query itself if none is accepted. Only formats named
+explicitly count, wildcards like image/* are sent by clients not supporting
+WebP, too.
+
+Every variant is a separate cached image (the extension of the format is
+appended to the name, see ImageQuery.image_format()). If the requested
+variant is missing all variants are rendered at once, decoding the source
+and executing the operations only once (see RawImageQuery.render_many()),
+so the next client asking for another format finds its variant.
+
+Template (needs the request in the context):
+{% image_format "thumb" photo.image negotiate %}
+
+Pages using negotiated URLs depend on the Accept header, so make sure they
+are sent with "Vary: Accept" if they are cached.
+"""
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from imagequery.settings import NEGOTIATE_FORMATS
+
+MIMETYPES = {
+    'AVIF': 'image/avif',
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+}
+
+
+def parse_accept(header):
+    ''' returns the accepted mimetypes and their quality (dict) '''
+    accepted = {}
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        mimetype = params[0].strip().lower()
+        if not mimetype:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[mimetype] = quality
+    return accepted
+
+
+def is_supported(format):
+    ''' whether images can be saved in format '''
+    if format not in Image.SAVE:
+        Image.init()
+    return format in Image.SAVE
+
+
+def get_formats(formats=None):
+    ''' returns the negotiable formats, in order of preference '''
+    if formats is None:
+        formats = NEGOTIATE_FORMATS
+    return [format for format in formats if format in MIMETYPES and is_supported(format)]
+
+
+def best_format(accept, formats=None):
+    ''' returns the format to use for the Accept header, None to keep the format of the query '''
+    accepted = parse_accept(accept)
+    best = None
+    for format in get_formats(formats):
+        quality = accepted.get(MIMETYPES[format], 0)
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (format, quality)
+    if best is None:
+        return None
+    return best[0]
+
+
+def get_variants(query, formats=None):
+    ''' returns the query and its variants for all negotiable formats '''
+    variants = [query]
+    for format in get_formats(formats):
+        if format != query.query.format():
+            variants.append(query.image_format(format))
+    return variants
+
+
+def negotiate(query, accept, formats=None):
+    '''
+    Returns the (evaluated) variant of query to be used for the Accept
+    header, rendering all missing variants if necessary
+    '''
+    format = best_format(accept, formats)
+    if format is None or format == query.query.format():
+        return query
+    variants = get_variants(query, formats)
+    variant = [q for q in variants if q.query.format() == format][0]
+    if variant._exists():
+        return variant
+    rendered = query.render_many(variants)
+    return rendered[variants.index(variant)]
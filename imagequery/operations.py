@@ -1,4 +1,5 @@
 from django.utils.encoding import smart_text
+import math
 import os
 
 try:
@@ -7,15 +8,27 @@ try:
     from PIL import ImageOps
     from PIL import ImageFilter
     from PIL import ImageDraw
+    from PIL import ImageEnhance
 except ImportError:
     import Image
     import ImageChops
     import ImageOps
     import ImageFilter
     import ImageDraw
+    import ImageEnhance
+from imagequery import vectorized
+from imagequery.settings import BLUR_METHOD, BLUR_DOWNSCALE_RADIUS
 from imagequery.utils import get_image_object, get_font_object, get_coords
 
 
+def get_alpha(image):
+    ''' returns the alpha channel of an RGBA image '''
+    try:
+        return image.getchannel('A')
+    except AttributeError:  # PIL/older Pillow versions
+        return image.split()[3]
+
+
 class Operation(object):
     """
     Image Operation, like scaling
@@ -24,6 +37,11 @@ class Operation(object):
     args = ()
     args_defaults = {}
     attrs = {}
+    # operation does not change the image size
+    keeps_size = False
+    # operation works on every pixel independently, so it may be executed
+    # after downscaling the image
+    pixelwise = False
 
     def __init__(self, *args, **kwargs):
         allowed_args = list(self.args)
@@ -48,9 +66,26 @@ class Operation(object):
     def execute(self, image, query):
         return image
 
+    def output_size(self, size):
+        '''
+        Returns the size of the image the operation creates from an image of
+        the given size, None if this is not known without executing it.
+        '''
+        if self.keeps_size:
+            return size
+        return None
+
+    def draft_size(self, size):
+        '''
+        Returns the size the operation will reduce an image of the given size
+        to, if it is a downscaling operation. Used to decide whether the source
+        image may be decoded in draft mode (see PIL's Image.draft()).
+        '''
+        return None
+
 
 class DummyOperation(Operation):
-    pass
+    keeps_size = True
 
 
 class CommandOperation(Operation):
@@ -69,6 +104,12 @@ class CommandOperation(Operation):
 
 class Enhance(Operation):
     args = ('enhancer', 'factor')
+    keeps_size = True
+
+    @property
+    def pixelwise(self):
+        # sharpness uses the neighbour pixels
+        return self.enhancer is not ImageEnhance.Sharpness
 
     def execute(self, image, query):
         enhancer = self.enhancer(image)
@@ -83,19 +124,30 @@ class Resize(Operation):
         'filter': Image.ANTIALIAS,
     }
 
+    def _target_size(self, size):
+        x, y = self.x, self.y
+        if x is None and y is None:
+            x, y = size
+        elif x is None:
+            orig_x, orig_y = size
+            ratio = float(y) / float(orig_y)
+            x = int(orig_x * ratio)
+        elif y is None:
+            orig_x, orig_y = size
+            ratio = float(x) / float(orig_x)
+            y = int(orig_y * ratio)
+        return x, y
+
     def execute(self, image, query):
-        if self.x is None and self.y is None:
-            self.x, self.y = image.size
-        elif self.x is None:
-            orig_x, orig_y = image.size
-            ratio = float(self.y) / float(orig_y)
-            self.x = int(orig_x * ratio)
-        elif self.y is None:
-            orig_x, orig_y = image.size
-            ratio = float(self.x) / float(orig_x)
-            self.y = int(orig_y * ratio)
+        self.x, self.y = self._target_size(image.size)
         return image.resize((self.x, self.y), self.filter)
 
+    def output_size(self, size):
+        return self._target_size(size)
+
+    def draft_size(self, size):
+        return self._target_size(size)
+
 
 class Scale(Operation):
     args = ('x', 'y', 'filter')
@@ -108,11 +160,38 @@ class Scale(Operation):
         image.thumbnail((self.x, self.y), self.filter)
         return image
 
+    def output_size(self, size):
+        # same calculation as Image.thumbnail(), which never enlarges
+        x, y = int(self.x), int(self.y)
+        width, height = size
+        if x >= width and y >= height:
+            return size
+        aspect = float(width) / height
+
+        def round_aspect(number, key):
+            return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+        if float(x) / y >= aspect:
+            x = round_aspect(y * aspect, key=lambda n: abs(aspect - float(n) / y))
+        else:
+            y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - float(x) / n))
+        return int(x), int(y)
+
+    def draft_size(self, size):
+        ratio = min(float(self.x) / size[0], float(self.y) / size[1])
+        if ratio >= 1:
+            return None
+        return size[0] * ratio, size[1] * ratio
+
 
 class Invert(Operation):
     args = ('keep_alpha',)
+    keeps_size = True
+    pixelwise = True
 
     def execute(self, image, query):
+        if self.keep_alpha and vectorized.available:
+            return vectorized.invert(image)
         if self.keep_alpha:
             image = image.convert('RGBA')
             channels = list(image.split())
@@ -124,31 +203,95 @@ class Invert(Operation):
 
 
 class Grayscale(Operation):
+    keeps_size = True
+
     def execute(self, image, query):
         return ImageOps.grayscale(image)
 
 
 class Flip(Operation):
+    keeps_size = True
+
     def execute(self, image, query):
         return ImageOps.flip(image)
 
 
 class Mirror(Operation):
+    keeps_size = True
+
     def execute(self, image, query):
         return ImageOps.mirror(image)
 
 
 class Blur(Operation):
-    args = ('amount',)
+    """
+    Blurs the image in a single pass using the given radius (standard
+    deviation for method 'gaussian'). If no radius is given it is computed
+    from amount, so the result looks like applying ImageFilter.BLUR amount
+    times (which is what method 'iterative' still does).
+    """
+    args = ('amount', 'radius', 'method')
+    args_defaults = {'amount': 1, 'radius': None, 'method': None}
+    keeps_size = True
+    # variance (per axis) of the ImageFilter.BLUR kernel, variances add up
+    # when applying the filter multiple times
+    BLUR_VARIANCE = 2.75
+
+    def __init__(self, *args, **kwargs):
+        super(Blur, self).__init__(*args, **kwargs)
+        if self.method is None:
+            self.method = BLUR_METHOD
+        assert self.method in ('gaussian', 'box', 'iterative'), 'unknown blur method %s' % self.method
+
+    def get_radius(self):
+        if self.radius is not None:
+            return self.radius
+        radius = math.sqrt(self.BLUR_VARIANCE * self.amount)
+        if self.method == 'box':
+            # a box of width 2r+1 has the variance ((2r+1)^2 - 1) / 12
+            radius = (math.sqrt(12 * radius * radius + 1) - 1) / 2
+        return radius
+
+    def get_filter(self, radius):
+        if self.method == 'box':
+            return ImageFilter.BoxBlur(radius)
+        return ImageFilter.GaussianBlur(radius)
+
+    def is_available(self):
+        # old PIL versions only provide ImageFilter.BLUR
+        if self.method == 'box':
+            return hasattr(ImageFilter, 'BoxBlur')
+        return self.method == 'gaussian' and hasattr(ImageFilter, 'GaussianBlur')
 
     def execute(self, image, query):
-        for i in xrange(0, self.amount):
-            image = image.filter(ImageFilter.BLUR)
-        return image
+        if not self.is_available():
+            for i in xrange(0, self.amount):
+                image = image.filter(ImageFilter.BLUR)
+            return image
+        radius = self.get_radius()
+        if radius <= 0:
+            return image
+        if BLUR_DOWNSCALE_RADIUS and radius > BLUR_DOWNSCALE_RADIUS:
+            return self.execute_downscaled(image, radius)
+        return image.filter(self.get_filter(radius))
+
+    def execute_downscaled(self, image, radius):
+        '''
+        Big radii remove all details anyway, so the image is blurred in a
+        smaller size (using a radius of at most BLUR_DOWNSCALE_RADIUS) and
+        scaled back up. This reduces the number of pixels to filter by the
+        square of the factor.
+        '''
+        factor = int(math.ceil(radius / float(BLUR_DOWNSCALE_RADIUS)))
+        width, height = image.size
+        small = image.resize((max(width // factor, 1), max(height // factor, 1)), Image.BILINEAR)
+        small = small.filter(self.get_filter(radius * small.size[0] / float(width)))
+        return small.resize((width, height), Image.BICUBIC)
 
 
 class Filter(Operation):
     args = ('filter',)
+    keeps_size = True
 
     def execute(self, image, query):
         return image.filter(self.filter)
@@ -166,6 +309,9 @@ class Crop(Operation):
         )
         return image.crop(box)
 
+    def output_size(self, size):
+        return self.w, self.h
+
 
 class Fit(Operation):
     args = ('x', 'y', 'centering', 'method')
@@ -177,6 +323,15 @@ class Fit(Operation):
     def execute(self, image, query):
         return ImageOps.fit(image, (self.x, self.y), self.method, centering=self.centering)
 
+    def output_size(self, size):
+        return self.x, self.y
+
+    def draft_size(self, size):
+        # fit crops to the target ratio, so the side with the smallest
+        # reduction defines the needed resolution
+        ratio = max(float(self.x) / size[0], float(self.y) / size[1])
+        return size[0] * ratio, size[1] * ratio
+
 
 class Blank(Operation):
     args = ('x', 'y', 'color', 'mode')
@@ -198,52 +353,90 @@ class Blank(Operation):
         else:
             return Image.new(self.mode, (x, y))
 
+    def output_size(self, size):
+        x, y = self.x, self.y
+        if x is None:
+            x = size[0]
+        if y is None:
+            y = size[1]
+        return x, y
+
 
 class Paste(Operation):
     args = ('image', 'x', 'y', 'storage')
+    keeps_size = True
 
     def execute(self, image, query):
         athor = get_image_object(self.image, self.storage)
-        x2, y2 = athor.size
         x1 = get_coords(image.size[0], athor.size[0], self.x)
         y1 = get_coords(image.size[1], athor.size[1], self.y)
+        if athor.mode == 'RGBA' and image.mode == 'RGBA':
+            return self.composite(image, athor, x1, y1)
         box = (
             x1,
             y1,
-            x1 + x2,
-            y1 + y2,
+            x1 + athor.size[0],
+            y1 + athor.size[1],
         )
         # Note that if you paste an "RGBA" image, the alpha band is ignored.
         # You can work around this by using the same image as both source image and mask.
         image = image.copy()
         if athor.mode == 'RGBA':
-            if image.mode == 'RGBA':
-                channels = image.split()
-                alpha = channels[3]
-                image = Image.merge('RGB', channels[0:3])
-                athor_channels = athor.split()
-                athor_alpha = athor_channels[3]
-                athor = Image.merge('RGB', athor_channels[0:3])
-                image.paste(athor, box, mask=athor_alpha)
-                # merge alpha
-                athor_image_alpha = Image.new('L', image.size, color=0)
-                athor_image_alpha.paste(athor_alpha, box)
-                new_alpha = ImageChops.add(alpha, athor_image_alpha)
-                image = Image.merge('RGBA', image.split() + (new_alpha,))
-            else:
-                image.paste(athor, box, mask=athor)
+            image.paste(athor, box, mask=athor)
         else:
             image.paste(athor, box)
         return image
 
+    def composite(self, image, athor, x, y):
+        '''
+        Pastes athor on image (both RGBA): colors get blended using the alpha
+        of athor, the alpha channels are added. Only the overlapping region
+        gets processed, the image is only copied once.
+        '''
+        width, height = image.size
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + athor.size[0], width)
+        bottom = min(y + athor.size[1], height)
+        image = image.copy()
+        if left >= right or top >= bottom:
+            return image
+        athor = athor.crop((left - x, top - y, right - x, bottom - y))
+        region = image.crop((left, top, right, bottom))
+        alpha = ImageChops.add(get_alpha(region), get_alpha(athor))
+        region.paste(athor, (0, 0), mask=athor)
+        region.putalpha(alpha)
+        image.paste(region, (left, top))
+        return image
+
+    def composite_channels(self, image, athor, x, y):
+        '''
+        Same as composite(), but works on separate channels of the whole
+        image. This was used before composite() existed and is kept for
+        comparison (see imagequery.benchmark).
+        '''
+        box = (x, y, x + athor.size[0], y + athor.size[1])
+        channels = image.split()
+        alpha = channels[3]
+        image = Image.merge('RGB', channels[0:3])
+        athor_channels = athor.split()
+        athor_alpha = athor_channels[3]
+        athor = Image.merge('RGB', athor_channels[0:3])
+        image.paste(athor, box, mask=athor_alpha)
+        # merge alpha
+        athor_image_alpha = Image.new('L', image.size, color=0)
+        athor_image_alpha.paste(athor_alpha, box)
+        new_alpha = ImageChops.add(alpha, athor_image_alpha)
+        return Image.merge('RGBA', image.split() + (new_alpha,))
+
 
 class Background(Operation):
     args = ('image', 'x', 'y', 'storage')
+    keeps_size = True
 
     def execute(self, image, query):
         background = Image.new('RGBA', image.size, color=(0, 0, 0, 0))
         athor = get_image_object(self.image, self.storage)
-        x2, y2 = image.size
+        x2, y2 = athor.size
         x1 = get_coords(image.size[0], athor.size[0], self.x)
         y1 = get_coords(image.size[1], athor.size[1], self.y)
         box = (
@@ -262,6 +455,7 @@ class Convert(Operation):
     args_defaults = {
         'matrix': None,
     }
+    keeps_size = True
 
     def execute(self, image, query):
         if self.matrix:
@@ -278,8 +472,11 @@ class GetChannel(Operation):
         'blue': 2,
         'alpha': 3,
     }
+    keeps_size = True
 
     def execute(self, image, query):
+        if vectorized.available:
+            return vectorized.get_channel(image, self.channel_map[self.channel])
         image = image.convert('RGBA')
         alpha = image.split()[self.channel_map[self.channel]]
         return Image.merge('RGBA', (alpha, alpha, alpha, alpha))
@@ -290,11 +487,13 @@ class ApplyAlpha(GetChannel):
 
     def execute(self, image, query):
         # TODO: Use putalpha(band)?
-        image = image.convert('RGBA')
         alphamap = get_image_object(self.alphamap).convert('RGBA')
-        data = image.split()[self.channel_map['red']:self.channel_map['alpha']]
         alpha = alphamap.split()[self.channel_map['alpha']]
         alpha = alpha.resize(image.size, Image.ANTIALIAS)
+        if vectorized.available:
+            return vectorized.apply_alpha(image, alpha)
+        image = image.convert('RGBA')
+        data = image.split()[self.channel_map['red']:self.channel_map['alpha']]
         return Image.merge('RGBA', data + (alpha,))
 
 
@@ -303,6 +502,7 @@ class Blend(Operation):
     channel_map = {
         'alpha': 0.5,
     }
+    keeps_size = True
 
     def execute(self, image, query):
         athor = get_image_object(self.image, self.storage)
@@ -315,6 +515,7 @@ class Text(Operation):
         'size': None,
         'fill': None,
     }
+    keeps_size = True
 
     def execute(self, image, query):
         from imagequery import ImageQuery  # late import to avoid circular import
@@ -346,6 +547,7 @@ class TextImage(Operation):
 
 class FontDefaults(Operation):
     args = ('font', 'size', 'fill')
+    keeps_size = True
 
     @property
     def attrs(self):
@@ -358,6 +560,7 @@ class FontDefaults(Operation):
 
 class Composite(Operation):
     args = ('image', 'mask', 'storage')
+    keeps_size = True
 
     def execute(self, image, query):
         athor = get_image_object(self.image, self.storage)
@@ -367,6 +570,7 @@ class Composite(Operation):
 
 class Offset(Operation):
     args = ('x', 'y')
+    keeps_size = True
 
     def execute(self, image, query):
         return ImageChops.offset(image, self.x, self.y)
@@ -375,29 +579,39 @@ class Offset(Operation):
 class Padding(Operation):
     args = ('left', 'top', 'right', 'bottom', 'color')
 
-    def execute(self, image, query):
+    def _paddings(self):
         left, top, right, bottom = self.left, self.top, self.right, self.bottom
-        color = self.color
         if top is None:
             top = left
         if right is None:
             right = left
         if bottom is None:
             bottom = top
+        return left, top, right, bottom
+
+    def execute(self, image, query):
+        left, top, right, bottom = self._paddings()
+        color = self.color
         if color is None:
             color = (0, 0, 0, 0)
-        new_width = left + right + image.size[0]
-        new_height = top + bottom + image.size[1]
+        new_width, new_height = self.output_size(image.size)
         new = Image.new('RGBA', (new_width, new_height), color=color)
         new.paste(image, (left, top))
         return new
 
+    def output_size(self, size):
+        left, top, right, bottom = self._paddings()
+        return left + right + size[0], top + bottom + size[1]
+
 
 class Opacity(Operation):
     args = ('opacity',)
+    keeps_size = True
 
     def execute(self, image, query):
         opacity = int(self.opacity * 255)
+        if vectorized.available:
+            return vectorized.opacity(image, opacity)
         background = Image.new('RGBA', image.size, color=(0, 0, 0, 0))
         mask = Image.new('RGBA', image.size, color=(0, 0, 0, opacity))
         box = (0, 0) + image.size
@@ -412,14 +626,21 @@ class Clip(Operation):
         'end': None,
     }
 
-    def execute(self, image, query):
+    def _box(self, size):
         start = self.start
         if start is None:
             start = (0, 0)
         end = self.end
         if end is None:
-            end = image.size
-        new = image.crop(self.start + self.end)
+            end = size
+        return tuple(start) + tuple(end)
+
+    def execute(self, image, query):
+        new = image.crop(self._box(image.size))
         new.load()  # crop is a lazy operation, see docs
         return new
 
+    def output_size(self, size):
+        box = self._box(size)
+        return box[2] - box[0], box[3] - box[1]
+
@@ -0,0 +1,167 @@
+"""
+Rewrites the operations of a query before they get executed
+
+The optimizer works on a list of (operation, item) pairs, as returned by
+QueryItem.plan(). It never changes the QueryItem chain itself, so
+QueryItem.name() - and thus the cache paths - stay the same regardless
+whether the optimizer is used or not.
+
+Optimizations done:
+ * no-ops get removed (Resize/Scale to the same size, Crop of the full
+   image, Flip/Mirror applied twice)
+ * pixelwise operations (like Invert) get moved behind downscaling
+   operations, so they need to touch less pixels (not for palette and
+   bilevel images, PIL resizes them using NEAREST)
+ * consecutive Resize/Scale/Fit operations get merged into one resample,
+   unless they downscale below the final size first (upscaling the result
+   afterwards differs a lot from a single resample)
+"""
+from imagequery import operations
+
+GEOMETRIC = (operations.Resize, operations.Scale, operations.Fit)
+SELF_INVERSE = (operations.Flip, operations.Mirror)
+# modes PIL resizes using NEAREST, whatever filter is passed
+NEAREST_MODES = ('P', '1')
+# each pass reduces the number of steps or moves an operation further to the
+# end, but we don't want to risk endless loops anyway
+MAX_PASSES = 10
+
+
+def _sizes(steps, size):
+    ''' returns the input size of every step (None if unknown) '''
+    sizes = []
+    for operation, item in steps:
+        sizes.append(size)
+        if size is not None:
+            size = operation.output_size(size)
+    sizes.append(size)
+    return sizes
+
+
+def _is_downscale(operation, size):
+    if size is None or not isinstance(operation, GEOMETRIC):
+        return False
+    new_size = operation.output_size(size)
+    return new_size[0] * new_size[1] < size[0] * size[1]
+
+
+def _same_ratio(size1, size2):
+    # allow rounding errors of one pixel
+    return abs(size1[0] * size2[1] - size1[1] * size2[0]) <= \
+        max(size1[0], size1[1], size2[0], size2[1])
+
+
+def drop_noops(steps, size):
+    sizes = _sizes(steps, size)
+    result = []
+    i = 0
+    while i < len(steps):
+        operation, item = steps[i]
+        size = sizes[i]
+        if i + 1 < len(steps) and isinstance(operation, SELF_INVERSE) and \
+                type(steps[i + 1][0]) is type(operation):
+            i = i + 2
+            continue
+        if size is not None and \
+                isinstance(operation, (operations.Resize, operations.Scale)) and \
+                tuple(operation.output_size(size)) == tuple(size):
+            i = i + 1
+            continue
+        if size is not None and isinstance(operation, operations.Crop) and \
+                (operation.x, operation.y, operation.w, operation.h) == (0, 0) + tuple(size):
+            i = i + 1
+            continue
+        result.append(steps[i])
+        i = i + 1
+    return result
+
+
+def _modes(steps, mode):
+    ''' returns the input mode of every step (None if unknown) '''
+    modes = []
+    for operation, item in steps:
+        modes.append(mode)
+        if isinstance(operation, operations.Convert):
+            mode = operation.mode
+    return modes
+
+
+def move_pixelwise(steps, size, mode=None):
+    sizes = _sizes(steps, size)
+    modes = _modes(steps, mode)
+    steps = list(steps)
+    for i in range(len(steps) - 1):
+        if modes[i] is None or modes[i] in NEAREST_MODES:
+            continue
+        if steps[i][0].pixelwise and _is_downscale(steps[i + 1][0], sizes[i]):
+            steps[i], steps[i + 1] = steps[i + 1], steps[i]
+            # size after the swap is the size after downscaling
+            sizes[i + 1] = steps[i][0].output_size(sizes[i])
+    return steps
+
+
+def _merge(run, size):
+    ''' merges a run of geometric operations into one, if possible '''
+    if len(run) < 2:
+        return run
+    sizes = _sizes(run, size)
+    final_size = sizes[-1]
+    if final_size is None:
+        return run
+    for intermediate in sizes[1:-1]:
+        if intermediate is None or intermediate[0] < final_size[0] or intermediate[1] < final_size[1]:
+            return run
+    last_operation, last_item = run[-1]
+    fits = [i for i, (operation, item) in enumerate(run)
+            if isinstance(operation, operations.Fit)]
+    if not fits:
+        filter = last_operation.filter
+        return [(operations.Resize(final_size[0], final_size[1], filter), last_item)]
+    # Fit crops the image to the target ratio, so all other operations need
+    # to keep the ratio for the fit being the same when done on the
+    # original image
+    fit = run[fits[-1]][0]
+    for i, (operation, item) in enumerate(run):
+        if i != fits[-1] and not _same_ratio(sizes[i], sizes[i + 1]):
+            return run
+    if isinstance(last_operation, operations.Fit):
+        filter = last_operation.method
+    else:
+        filter = last_operation.filter
+    return [(operations.Fit(final_size[0], final_size[1], fit.centering, filter), last_item)]
+
+
+def merge_geometric(steps, size):
+    sizes = _sizes(steps, size)
+    result = []
+    run, run_size = [], None
+    for i, step in enumerate(steps):
+        if isinstance(step[0], GEOMETRIC) and sizes[i] is not None:
+            if not run:
+                run_size = sizes[i]
+            run.append(step)
+            continue
+        if run:
+            result.extend(_merge(run, run_size))
+            run = []
+        result.append(step)
+    if run:
+        result.extend(_merge(run, run_size))
+    return result
+
+
+def optimize(steps, size=None, mode=None):
+    '''
+    Returns the optimized list of (operation, item) pairs for an image of the
+    given size and mode. Size/mode dependent optimizations are skipped if
+    they are None.
+    '''
+    steps = list(steps)
+    for i in range(MAX_PASSES):
+        previous = steps
+        steps = drop_noops(steps, size)
+        steps = move_pixelwise(steps, size, mode)
+        steps = merge_geometric(steps, size)
+        if steps == previous:
+            break
+    return steps
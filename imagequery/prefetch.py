@@ -0,0 +1,142 @@
+"""
+Prefetching formats for lists of images
+
+Rendering {% image_format %} inside a loop checks (and possibly renders) one
+image after the other. prefetch_formats() checks all formats of all images
+using one manifest lookup (see imagequery.manifest.bulk_exists), renders the
+missing ones (decoding every source only once, see
+RawImageQuery.render_many()) and remembers the resulting URLs. The
+image_format tag uses these URLs if the prefetched images are available as
+context variable "imagequery_prefetched".
+
+Template:
+{% load imagequery_tags %}
+{% prefetch_image_formats photos "thumb" "large" field "image" %}
+{% for photo in photos %}{% image_format "thumb" photo.image %}{% endfor %}
+
+Python (view):
+context['imagequery_prefetched'] = prefetch_formats(
+    [photo.image for photo in photos], ['thumb', 'large'])
+"""
+import logging
+
+from django.core.files.base import File
+from django.db.models.fields.files import FieldFile
+from django.utils.encoding import smart_text
+from imagequery import formats
+from imagequery.manifest import bulk_exists
+from imagequery.settings import default_storage
+from imagequery.utils import get_imagequery, get_storage_id
+
+CONTEXT_NAME = 'imagequery_prefetched'
+
+logger = logging.getLogger('imagequery')
+
+
+def get_image_key(value):
+    ''' identifies images passed to the image_format tag, None if not possible '''
+    from imagequery.query import RawImageQuery  # late import to avoid circular import
+
+    if isinstance(value, RawImageQuery):
+        if not value.source:
+            return None
+        return get_storage_id(value.storage), value.source, value.query.name()
+    if isinstance(value, FieldFile):
+        return get_storage_id(value.storage), value.name, None
+    if isinstance(value, File):
+        return get_storage_id(default_storage), value.name, None
+    if not value:
+        return None
+    return get_storage_id(default_storage), smart_text(value), None
+
+
+class Prefetched(object):
+    """ URLs of prefetched formats """
+
+    def __init__(self):
+        self.urls = {}
+
+    def add(self, format_name, image, url):
+        key = get_image_key(image)
+        if key is not None:
+            self.urls[(format_name, key)] = url
+
+    def get(self, format_name, image):
+        ''' returns the URL, None if the format was not prefetched for the image '''
+        key = get_image_key(image)
+        if key is None:
+            return None
+        return self.urls.get((format_name, key))
+
+    def update(self, other):
+        self.urls.update(other.urls)
+
+
+def _render(imagequery, queries):
+    try:
+        return imagequery.render_many(queries)
+    except (IOError, ValueError):  # broken source
+        logger.warning('rendering formats for %s failed', imagequery.source, exc_info=True)
+        return None
+
+
+def prefetch_formats(images, format_names, workers=1):
+    '''
+    Makes sure all formats exist for all images, returns a Prefetched
+    instance containing the URLs. Missing images are rendered using workers
+    threads (if concurrent.futures is available). Images that cannot be opened
+    or decoded get an empty URL, like the image_format tag returns. Other
+    errors are raised.
+    '''
+    format_classes = [formats.get(format_name) for format_name in format_names]
+    prefetched = Prefetched()
+    entries = []
+    seen = set()
+    for image in images:
+        key = get_image_key(image)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        try:
+            imagequery = get_imagequery(image)
+        except IOError:  # handle missing files
+            for format_name in format_names:
+                prefetched.add(format_name, image, '')
+            continue
+        queries = [format_cls(imagequery)._execute() for format_cls in format_classes]
+        entries.append((image, imagequery, queries))
+    exists = iter(bulk_exists([query for image, imagequery, queries in entries for query in queries]))
+    missing = []
+    for image, imagequery, queries in entries:
+        pending = [query for query in queries if not next(exists)]
+        if pending:
+            missing.append((imagequery, pending))
+    rendered = {}
+    if workers > 1 and len(missing) > 1:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            workers = 1
+    if workers > 1 and len(missing) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda args: _render(*args), missing)
+            for (imagequery, pending), result in zip(missing, results):
+                rendered[id(imagequery)] = result
+    else:
+        for imagequery, pending in missing:
+            rendered[id(imagequery)] = _render(imagequery, pending)
+    for image, imagequery, queries in entries:
+        result = iter(rendered.get(id(imagequery)) or ())
+        for format_name, query in zip(format_names, queries):
+            if getattr(query, '_evaluated', False):
+                url = query._url()
+            else:
+                # render_many() returns evaluated clones of the pending queries
+                rendered_query = next(result, None)
+                if rendered_query is None:  # rendering failed
+                    url = ''
+                else:
+                    url = rendered_query._url()
+            prefetched.add(format_name, image, url)
+    return prefetched
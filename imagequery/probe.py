@@ -0,0 +1,107 @@
+"""
+Image metadata read from the file header
+
+probe() returns format, mode, size, EXIF orientation and frame count of an
+image without decoding its pixels. Results are cached per (storage, name,
+modification time), in memory and as metadata of the manifest (if
+configured, see imagequery.manifest), so listing metadata of large galleries
+neither decodes nor reopens the images. The modification time of remote
+sources is reported by their storage (see
+imagequery.utils.get_modified_time), sources without modification time are
+probed every time, overwritten files could not be noticed otherwise.
+"""
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from imagequery.manifest import get_manifest, get_key as get_manifest_key
+from imagequery.utils import get_storage_id
+
+# number of probes kept in memory
+MAX_PROBES = 10000
+# EXIF tag containing the orientation
+ORIENTATION = 0x0112
+
+_probes = OrderedDict()
+_lock = threading.Lock()
+
+
+def probe_image(image):
+    ''' returns the metadata of an opened (not necessarily loaded) image '''
+    orientation = 1
+    try:
+        exif = image._getexif()
+    except Exception:  # not supported by the format or broken EXIF data
+        exif = None
+    if exif:
+        orientation = exif.get(ORIENTATION, 1)
+    return {
+        'format': image.format,
+        'mode': image.mode,
+        'size': image.size,
+        'orientation': orientation,
+        'frames': getattr(image, 'n_frames', 1),
+    }
+
+
+def encode(info):
+    ''' returns the compact record stored in the manifest '''
+    return '%s|%s|%dx%d|%d|%d' % (info['format'] or '', info['mode'], info['size'][0], info['size'][1],
+        info['orientation'], info['frames'])
+
+
+def decode(value):
+    format, mode, size, orientation, frames = value.split('|')
+    width, height = size.split('x')
+    return {
+        'format': format or None,
+        'mode': mode,
+        'size': (int(width), int(height)),
+        'orientation': int(orientation),
+        'frames': int(frames),
+    }
+
+
+def _probe_file(storage, name, fh=None):
+    if fh is None:
+        fh = storage.open(name, 'rb')
+    try:
+        return probe_image(Image.open(fh))
+    finally:
+        fh.close()
+
+
+def probe(storage, name, mtime=None, fh=None):
+    '''
+    Returns the metadata of the image name in storage (dict containing format,
+    mode, size, orientation and frames), mtime is the modification time of the
+    file if known. fh may be an already opened file of the image.
+    '''
+    if mtime is None:
+        return _probe_file(storage, name, fh)
+    key = (get_storage_id(storage), name)
+    with _lock:
+        entry = _probes.get(key)
+    if entry is not None and entry[1] == mtime:
+        return entry[0]
+    manifest_key = get_manifest_key(storage, name, None, None)
+    record = get_manifest().get_metadata('probe', manifest_key)
+    if record is not None and record[1] == mtime:
+        info = decode(record[0])
+    else:
+        info = _probe_file(storage, name, fh)
+        get_manifest().set_metadata('probe', manifest_key, encode(info), mtime)
+    with _lock:
+        _probes.pop(key, None)
+        _probes[key] = (info, mtime)
+        while len(_probes) > MAX_PROBES:
+            _probes.popitem(last=False)
+    return info
+
+
+def clear():
+    with _lock:
+        _probes.clear()
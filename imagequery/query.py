@@ -1,4 +1,6 @@
+import math
 import os
+import time
 import weakref
 
 try:
@@ -12,12 +14,17 @@ except ImportError:
     import ImageEnhance
     import ImageDraw
 from django.utils.encoding import smart_text
-from django.core.files.base import File, ContentFile
+from django.core.files.base import File
 from django.db.models.fields.files import FieldFile
-from imagequery import operations
-from imagequery.settings import CACHE_DIR, DEFAULT_OPTIONS, default_storage, \
-    default_cache_storage
-from imagequery.utils import get_image_object, get_font_object, get_coords
+from imagequery import digest, encoding, operations, optimizer, probe, signals
+from imagequery.locking import render_lock, render_locks
+from imagequery.lru import image_cache
+from imagequery.maintenance import get_access_log
+from imagequery.manifest import get_manifest, get_key as get_manifest_key
+from imagequery.settings import CACHE_DIR, DEFAULT_OPTIONS, DRAFT_FACTOR, \
+    OPTIMIZE_OPERATIONS, LOCK_FALLBACK, CONTENT_ADDRESSED, default_storage, default_cache_storage
+from imagequery.utils import get_image_object, get_font_object, get_coords, \
+    get_storage_id, get_modified_time, save_file
 
 # stores rendered images
 # keys are hashes of image operations
@@ -32,6 +39,24 @@ def _get_image_registry(item):
     return _IMAGE_REGISTRY.get(item, None)
 
 
+def _execute_operation(operation, image, item):
+    if not signals.operation_executed.receivers:
+        return operation.execute(image, item)
+    started = time.time()
+    result = operation.execute(image, item)
+    signals.operation_executed.send(
+        sender=operation.__class__,
+        operation=operation,
+        query_item=item,
+        input_size=image.size,
+        input_mode=image.mode,
+        output_size=result.size,
+        output_mode=result.mode,
+        duration=time.time() - started,
+    )
+    return result
+
+
 class QueryItem(object):
     """
     An ImageQuery consists of multiple QueryItem's
@@ -44,6 +69,7 @@ class QueryItem(object):
         self._evaluated_image = None
         self._name = None
         self._format = None
+        self._profile = None
         self.operation = operation
 
     def _get_previous(self):
@@ -67,15 +93,47 @@ class QueryItem(object):
     def __unicode__(self):
         return u', '.join([unicode(x.operation) for x in self])
 
-    def execute(self, image):
+    def plan(self, size=None, mode=None):
+        '''
+        Returns the (operation, item) pairs needed to create the image,
+        optimized if IMAGEQUERY_OPTIMIZE_OPERATIONS is set.
+        '''
+        steps = [(item.operation, item) for item in self if item.operation is not None]
+        if OPTIMIZE_OPERATIONS:
+            steps = optimizer.optimize(steps, size, mode)
+        return steps
+
+    def execute(self, image, cache_key=None):
+        '''
+        Executes all operations on image. cache_key identifies the source
+        image (see RawImageQuery._cache_key()), if passed the results are
+        stored in the in-memory image cache to be reused by other queries
+        starting with the same operations.
+        '''
         evaluated_image = _get_image_registry(self)
-        if evaluated_image is None:
+        if evaluated_image is not None:
+            return evaluated_image
+        item_key = None
+        if cache_key is not None and self.has_operations():
+            # operations might change their attributes while executing, so
+            # we need to calculate the key first
+            item_key = cache_key + (self.name(),)
+            evaluated_image = image_cache.get(item_key)
+            if evaluated_image is not None:
+                _set_image_registry(self, evaluated_image)
+                return evaluated_image
+        if OPTIMIZE_OPERATIONS:
+            for operation, item in self.plan(image.size, image.mode):
+                image = _execute_operation(operation, image, item)
+        else:
             if self._previous is not None:
-                image = self._previous.execute(image)
+                image = self._previous.execute(image, cache_key)
             if self.operation is not None:
-                image = self.operation.execute(image, self)
-            evaluated_image = image
-            _set_image_registry(self, evaluated_image)
+                image = _execute_operation(self.operation, image, self)
+        evaluated_image = image
+        _set_image_registry(self, evaluated_image)
+        if item_key is not None:
+            image_cache.set(item_key, evaluated_image)
         return evaluated_image
 
     def get_attrs(self):
@@ -97,6 +155,18 @@ class QueryItem(object):
             item = item._previous
         return None
 
+    def profile(self, value=None):
+        ''' the encoder profile (see imagequery.encoding) '''
+        if value:
+            self._profile = value
+            return value
+        item = self
+        while item:
+            if item._profile:
+                return item._profile
+            item = item._previous
+        return None
+
     def name(self, value=None):
         import hashlib
 
@@ -109,6 +179,9 @@ class QueryItem(object):
         altered = False
         item = self
         while item:
+            if item._profile:
+                val.update(item._profile.key().encode('utf-8'))
+                altered = True
             if item._name:  # stop on first named operation
                 val.update(item._name)
                 altered = True
@@ -129,12 +202,39 @@ class QueryItem(object):
         return first
 
     def has_operations(self):
-        if self.operation:
+        if self.operation or self._profile:
             return True
         if self._previous:
             return self._previous.has_operations()
         return False
 
+    def output_size(self, size):
+        '''
+        Returns the size of the image created from an image of the given
+        size, None if any operation cannot tell without executing it
+        '''
+        for operation, item in self.plan(size):
+            size = operation.output_size(size)
+            if size is None:
+                return None
+        return size
+
+    def draft_size(self, size, factor=1):
+        '''
+        Returns the size an image of the given size may be decoded with, if
+        the first operation downscales the image. factor defines how much
+        bigger than the downscaled image the decoded image must be.
+        '''
+        for operation, item in self.plan(size):
+            target = operation.draft_size(size)
+            if target is None:
+                return None
+            return (
+                int(math.ceil(target[0] * factor)),
+                int(math.ceil(target[1] * factor)),
+            )
+        return None
+
 
 class RawImageQuery(object):
     """ Base class for raw handling of images, needs an loaded PIL image """
@@ -156,11 +256,20 @@ class RawImageQuery(object):
             return os.path.basename(self.source)
         else:
             # the image was not loaded from source. create some name
-            import hashlib
-
-            md5 = hashlib.md5()
-            md5.update(self.image.tostring())
-            return '%s.png' % md5.hexdigest()
+            # (hashing the image data is expensive, so remember it)
+            image = self.image
+            cached = getattr(self, '_image_digest', None)
+            if cached is None or cached[0] is not image:
+                cached = self._image_digest = (image, digest.image_digest(image))
+            return '%s.png' % cached[1]
+
+    def _source_digest(self):
+        ''' digest of the source contents, see imagequery.digest '''
+        try:
+            return self._digest
+        except AttributeError:
+            self._digest = digest.get_digest(self.storage, self.source, self._source_mtime())
+            return self._digest
 
     def _format_extension(self, format):
         try:
@@ -185,7 +294,11 @@ class RawImageQuery(object):
             format = self.query.format()
             # TODO: Support windows?
             # TODO: Remove support for absolute path?
-            if not self.source or self.source.startswith('/'):
+            if self.source and CONTENT_ADDRESSED:
+                source_digest = self._source_digest()
+                name = os.path.join(source_digest[:2],
+                    source_digest + os.path.splitext(self.source)[1])
+            elif not self.source or self.source.startswith('/'):
                 name = self._basename()
             else:
                 name = self.source
@@ -214,9 +327,73 @@ class RawImageQuery(object):
         else:
             return self.storage.url(self._name())
 
+    def _manifest_key(self):
+        if self.source and self.query.has_operations():
+            return get_manifest_key(self.cache_storage, self.source,
+                self.query.name(), self.query.format())
+        return None
+
+    def _source_mtime(self):
+        try:
+            return self._mtime
+        except AttributeError:
+            self._mtime = get_modified_time(self.storage, self.source)
+            return self._mtime
+
+    def _cache_key(self):
+        '''
+        Identifies the source image for the in-memory image cache, None if
+        the source cannot be identified safely
+        '''
+        if not self.source:
+            return None
+        mtime = self._source_mtime()
+        if mtime is None:
+            return None
+        return (
+            get_storage_id(self.storage),
+            self.source,
+            mtime,
+            getattr(self, '_draft_size', None),
+        )
+
+    def _manifest_record(self):
+        return {
+            'name': self._name(),
+            'mtime': self._source_mtime(),
+            'created': time.time(),
+        }
+
     def _exists(self):
+        if not signals.existence_checked.receivers:
+            return self._lookup_exists()
+        started = time.time()
+        exists = self._lookup_exists()
+        signals.existence_checked.send(sender=self.__class__, query=self,
+            exists=exists, duration=time.time() - started)
+        return exists
+
+    def _valid_record(self, record):
+        ''' whether the manifest record was created for the current source '''
+        return record is not None and record.get('mtime') == self._source_mtime()
+
+    def _lookup_exists(self):
+        if getattr(self, '_evaluated', False):
+            return True
+        key = self._manifest_key()
+        if key and self._valid_record(get_manifest().get(key)):
+            return True
+        exists = self._exists_in_storage()
+        if exists and key:
+            get_manifest().set(key, self._manifest_record())
+        return exists
+
+    def _exists_in_storage(self):
         if self.source and \
                 self.cache_storage.exists(self._name()):
+            if CONTENT_ADDRESSED:
+                # the name already depends on the contents of the source
+                return True
             # TODO: Really support local paths this way?
             try:
                 source_path = self.storage.path(self.source)
@@ -232,7 +409,10 @@ class RawImageQuery(object):
         return False
 
     def _apply_operations(self, image):
-        image = self.query.execute(image)
+        if image_cache.enabled:
+            image = self.query.execute(image, self._cache_key())
+        else:
+            image = self.query.execute(image)
         return image
 
     def _create_raw(self, allow_reopen=True):
@@ -273,6 +453,8 @@ class RawImageQuery(object):
             'XBM': ('1'),
             'PDF': ('RGB', 'CMYK', 'P', '1'),
             'TIFF': ('RGBA', 'RGB', 'CMYK', 'P', '1'),
+            'WEBP': ('RGBA', 'RGB'),
+            'AVIF': ('RGBA', 'RGB'),
         }
         if format and format in MODES:
             if image.mode not in MODES[format]:
@@ -286,33 +468,58 @@ class RawImageQuery(object):
         Recreate image. Does not check whether the image already exists.
         '''
         if self.query:
+            manifest_key = None
             if name is None:
-                name = self._path()
+                name = self._name()
+                # we are (re)creating the cached image
+                manifest_key = self._manifest_key()
+                manifest_record = self._manifest_record()
             name = smart_text(name)
             image = self._create_raw(allow_reopen=False)
+            # the format of the query wins, the image might be the (reopened)
+            # source if all operations were optimized away
             format = self.query.format()
-            if image.format:
-                format = image.format
-            elif not format:
-                format = self.image.format
+            if not format:
+                format = image.format or self._source_format()
             if not format:
                 if not Image.EXTENSION:
                     Image.init()
                 format = Image.EXTENSION[os.path.splitext(name)[1].lower()]
-            if not self.cache_storage.exists(name):
-                self.cache_storage.save(name, ContentFile(''))
             if DEFAULT_OPTIONS:
                 save_options = DEFAULT_OPTIONS.copy()
             else:
                 save_options = {}
             save_options.update(options)
+            profile = self.query.profile()
             # options may raise errors
             # TODO: Check this
             image = self._convert_image_mode(image, format)
-            try:
-                image.save(self.cache_storage.open(name, 'wb'), format, **save_options)
-            except TypeError:
-                image.save(self.cache_storage.open(name, 'wb'), format)
+
+            written = []
+            encoded = []
+
+            def write(fh):
+                if profile is not None:
+                    # errors are not hidden here, the profile was chosen explicitly
+                    encoded.append(profile.save(image, fh, format, save_options))
+                else:
+                    try:
+                        image.save(fh, format, **save_options)
+                    except TypeError:
+                        fh.seek(0)
+                        fh.truncate()
+                        image.save(fh, format)
+                written.append(fh.tell())
+
+            started = time.time()
+            save_file(self.cache_storage, name, write)
+            if signals.image_saved.receivers:
+                signals.image_saved.send(sender=self.__class__, query=self, name=name,
+                    format=format, size=image.size, mode=image.mode,
+                    bytes=written[-1], profile=profile and profile.name,
+                    encoding=encoded and encoded[-1] or None, duration=time.time() - started)
+            if manifest_key:
+                get_manifest().set(manifest_key, manifest_record)
 
     def _clone(self):
         import copy
@@ -324,11 +531,115 @@ class RawImageQuery(object):
         # )
         clone = copy.copy(self)
         clone.query = copy.copy(self.query)
+        clone._evaluated = False
         return clone
 
-    def _evaluate(self):
+    def _evaluate(self, allow_fallback=False):
+        '''
+        Creates the image if necessary. Returns False if the image was not
+        created because someone else is rendering it and allow_fallback is
+        True (see IMAGEQUERY_LOCK_FALLBACK).
+        '''
+        if getattr(self, '_evaluated', False):
+            return True
         if not self._exists():
-            self._create()
+            with render_lock(self.cache_storage, self._name()) as lock:
+                if not lock.acquired and allow_fallback and self.source and \
+                        LOCK_FALLBACK == 'source':
+                    return False
+                # someone else might have created the image while we waited
+                # or between our check and taking the lock
+                if not self._exists():
+                    self._create()
+        self._evaluated = True
+        access_log = get_access_log()
+        if access_log is not None and self.query.has_operations():
+            access_log.record(self.cache_storage, self._name())
+        return True
+
+    def _get_source_image(self, queries):
+        ''' returns the source image, suitable for all given queries '''
+        return self.image
+
+    def _shares_source(self, query):
+        if type(query) is not type(self):
+            return False
+        if not self.source:
+            return query.image is self.image
+        return query.source == self.source and query.storage is self.storage
+
+    def render_many(self, targets, force=False):
+        '''
+        Renders multiple formats or chains based on this query, decoding the
+        source only once. Operations shared by multiple targets (same
+        leading operations, after optimizing if IMAGEQUERY_OPTIMIZE_OPERATIONS
+        is set) are only executed once.
+
+        targets may contain registered format names, Format classes or
+        ImageQuery's based on this query. Returns the list of resulting
+        queries (already evaluated), in the same order.
+        '''
+        from imagequery import formats  # late import to avoid circular import
+
+        queries = []
+        for target in targets:
+            if isinstance(target, RawImageQuery):
+                query = target._clone()
+            else:
+                if not isinstance(target, type):
+                    target = formats.get(target)
+                query = target(self)._execute()._clone()
+            queries.append(query)
+        pending = [query for query in queries if force or not query._exists()]
+        with render_locks([(query.cache_storage, query._name()) for query in pending]):
+            if not force:
+                # someone else might have created the images while we waited
+                pending = [query for query in pending if not query._exists()]
+            shared = [query for query in pending if self._shares_source(query)]
+            if shared:
+                image = self._get_source_image(shared)
+                draft_size = getattr(self, '_draft_size', None)
+                for query in shared:
+                    query.image = image
+                    query._draft_size = draft_size
+                self._execute_many(image, shared)
+            for query in pending:
+                query._create()
+                query._evaluated = True
+        return queries
+
+    def _execute_many(self, image, queries):
+        """
+        Executes the operations of all queries, like a prefix tree: results of
+        leading operations used by multiple queries are only calculated once.
+        The (optimized) plans are compared, see QueryItem.plan().
+        """
+        chains = []
+        usage = {}
+        for query in queries:
+            # keys must be calculated before executing anything, operations
+            # might change their attributes
+            steps = query.query.plan(image.size, image.mode)
+            keys = []
+            for operation, item in steps:
+                keys.append((keys[-1] if keys else ()) + (smart_text(operation),))
+                usage[keys[-1]] = usage.get(keys[-1], 0) + 1
+            chains.append((query, steps, keys))
+        results = {}
+        for query, steps, keys in chains:
+            result = image
+            start = 0
+            for i in range(len(keys) - 1, -1, -1):
+                if keys[i] in results:
+                    result = results[keys[i]]
+                    start = i + 1
+                    break
+            for i in range(start, len(steps)):
+                operation, item = steps[i]
+                result = _execute_operation(operation, result, item)
+                if usage[keys[i]] > 1:
+                    results[keys[i]] = result
+            _set_image_registry(query.query, result)
 
     def _append(self, operation):
         query = QueryItem(operation)
@@ -399,9 +710,14 @@ class RawImageQuery(object):
         '''
         return self.enhance(ImageEnhance.Sharpness, amount)
 
-    def blur(self, amount=1):
-        #return self.sharpness(1-(amount-1))
-        return self.append(operations.Blur(amount))
+    def blur(self, amount=1, radius=None, method=None):
+        '''
+        amount: strength compatible to older versions (ImageFilter.BLUR
+            applied amount times)
+        radius: blur radius, overrides amount
+        method: 'gaussian', 'box' or 'iterative' (see IMAGEQUERY_BLUR_METHOD)
+        '''
+        return self.append(operations.Blur(amount, radius, method))
 
     def filter(self, image_filter):
         return self.append(operations.Filter(image_filter))
@@ -468,6 +784,20 @@ class RawImageQuery(object):
         q.query.name(value)
         return q
 
+    def encoder_profile(self, value):
+        '''
+        Saves the image using the given encoder profile (Profile or name of
+        a registered profile, see imagequery.encoding)
+        '''
+        profile = encoding.get(value)
+        q = self._clone()
+        q = q._append(None)
+        q.query.profile(profile)
+        if self.query._name:
+            # keep the name of named queries readable
+            q.query.name('%s-%s' % (self.query._name, profile.digest()))
+        return q
+
     def image_format(self, value):
         value = value.upper()
         if not Image.EXTENSION:
@@ -533,7 +863,8 @@ class RawImageQuery(object):
     # methods which does not return a new ImageQuery instance
 
     def mimetype(self):
-        format = self.raw().format
+        # the format the image is (or will be) saved in
+        format = self.query.format() or self._source_format()
         try:
             if not Image.MIME:
                 Image.init()
@@ -542,20 +873,46 @@ class RawImageQuery(object):
             return None
 
     def width(self):
-        return self.raw().size[0]
+        return self.size()[0]
 
     x = width
 
     def height(self):
-        return self.raw().size[1]
+        return self.size()[1]
 
     y = height
 
     def size(self):
-        return self.raw().size
+        # calculated from the size of the source if possible, so the image
+        # does not need to be rendered
+        size = self.query.output_size(self._source_size())
+        if size is None:
+            size = self.raw().size
+        return size
+
+    def _source_size(self):
+        ''' returns the size of the image the operations are executed on '''
+        return self.image.size
+
+    def _source_format(self):
+        return self.image.format
+
+    def metadata(self):
+        '''
+        Returns format, mode, size, EXIF orientation and number of frames of
+        the source image (see imagequery.probe)
+        '''
+        return probe.probe_image(self.image)
 
     def raw(self, allow_reopen=True):
-        return self._create_raw(allow_reopen=allow_reopen)
+        if allow_reopen and self._exists():
+            return self._create_raw()
+        image = self._create_raw(allow_reopen=False)
+        if image_cache.enabled:
+            # the image is shared with the image cache (and other queries),
+            # callers may modify the returned image
+            image = image.copy()
+        return image
 
     def name(self):
         self._evaluate()
@@ -566,7 +923,8 @@ class RawImageQuery(object):
         return self._path()
 
     def url(self):
-        self._evaluate()
+        if not self._evaluate(allow_fallback=True):
+            return self.storage.url(self.source)
         return self._url()
 
 
@@ -610,10 +968,11 @@ class ImageQuery(RawImageQuery):
             else:
                 cache_storage = default_cache_storage
         self.cache_storage = cache_storage
+        # the source file is opened when it is needed (see _get_fh), so
+        # queries of already existing images don't touch the source at all
         if isinstance(source, File):
             self.source = source.name
-            source.open('rb')
-            self.fh = source
+            self._file = source
             if isinstance(source, FieldFile):
                 # we use the field storage, regardless what the constructor
                 # get as param, just to be safe
@@ -621,19 +980,137 @@ class ImageQuery(RawImageQuery):
         else:
             # assume that image is a filename
             self.source = smart_text(source)
-            self.fh = storage.open(self.source, 'rb')
+            self._file = None
         self.query = QueryItem()
 
+    def _get_fh(self):
+        try:
+            return self._fh
+        except AttributeError:
+            if self._file is not None:
+                self._file.open('rb')
+                self._fh = self._file
+            else:
+                self._fh = self.storage.open(self.source, 'rb')
+            return self._fh
+
+    def _set_fh(self, fh):
+        self._fh = fh
+
+    fh = property(_get_fh, _set_fh)
+
+    def _source_size(self):
+        if '_image' in self.__dict__:
+            return self._image.size
+        return self._drafted_size(self._probe()['size'])
+
+    def _drafted_size(self, size):
+        '''
+        Returns the size the source will be decoded with (see _draft), PIL
+        reduces JPEG images by 1/2, 1/4 or 1/8
+        '''
+        draft_size = self._draft_size_for(size, [self.query])
+        if draft_size is None or self._probe()['format'] != 'JPEG':
+            return size
+        scale = min(size[0] // draft_size[0], size[1] // draft_size[1])
+        for factor in (8, 4, 2, 1):
+            if scale >= factor:
+                break
+        return (size[0] + factor - 1) // factor, (size[1] + factor - 1) // factor
+
+    def _clone(self):
+        clone = super(ImageQuery, self)._clone()
+        # clones open the source file themselves
+        clone.__dict__.pop('_fh', None)
+        return clone
+
+    def _close(self):
+        ''' closes the source file, it gets opened again if needed '''
+        fh = self.__dict__.pop('_fh', None)
+        if fh is not None:
+            fh.close()
+
+    def _probe(self):
+        '''
+        Returns the metadata of the source, only reading the header of the
+        file (see imagequery.probe)
+        '''
+        try:
+            return self._probed
+        except AttributeError:
+            self._probed = probe.probe(self.storage, self.source, self._source_mtime())
+            return self._probed
+
+    def _source_format(self):
+        return self._probe()['format']
+
+    def metadata(self):
+        return self._probe()
+
     def _get_image(self):
         try:
             return self._image
         except AttributeError:
-            self.fh.open('rb')  # reset file access
-            self._image = Image.open(self.fh)
+            self._image = self._open_image([self.query])
             return self._image
 
+    def _open_image(self, queries):
+        '''
+        Opens the source image, it might be drafted to the size needed by
+        all given queries (QueryItem's)
+        '''
+        if image_cache.enabled:
+            cache_key = self._cache_key()
+        else:
+            cache_key = None
+        if cache_key is not None:
+            # the draft size is part of the key, so we need the header
+            self._draft_size = self._draft_size_for(self._probe()['size'], queries)
+            cache_key = self._cache_key()
+            cached = image_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        try:
+            self.fh.open('rb')  # reset file access
+            image = Image.open(self.fh)
+            self._draft(image, queries)
+            # decode everything now, so the file can be closed
+            image.load()
+        finally:
+            self._close()
+        if cache_key is not None:
+            image_cache.set(cache_key, image)
+        return image
+
+    def _draft(self, image, queries):
+        '''
+        Let PIL decode the image in reduced size (if supported by the image
+        format) when the operations downscale it anyway
+        '''
+        size = self._draft_size_for(image.size, queries)
+        if size is not None:
+            image.draft(image.mode, size)
+            self._draft_size = size
+
+    def _draft_size_for(self, image_size, queries):
+        ''' returns the size to draft the image to, None if not possible '''
+        if not DRAFT_FACTOR:
+            return None
+        sizes = [query.draft_size(image_size, DRAFT_FACTOR) for query in queries]
+        if not sizes or None in sizes:
+            return None
+        size = (max([x for x, y in sizes]), max([y for x, y in sizes]))
+        if size[0] < image_size[0] and size[1] < image_size[1]:
+            return size
+        return None
+
     def _set_image(self, image):
         self._image = image
 
+    def _get_source_image(self, queries):
+        if not hasattr(self, '_image'):
+            self._image = self._open_image([query.query for query in queries])
+        return self._image
+
     image = property(_get_image, _set_image)
 
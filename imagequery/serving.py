@@ -0,0 +1,179 @@
+"""
+Serving formats by signed URLs
+
+get_url() returns an URL of the serve view (see imagequery.urls) for a
+registered format and a source image, without checking or rendering
+anything. The URL contains the format name, the alias of the source storage
+(see imagequery.utils.get_storage_alias) and the source path, signed using
+SECRET_KEY so nobody can request other formats or sources. The view renders
+the image if it does not exist yet and streams it:
+
+ * ETag and Last-Modified are taken from the manifest record (the time the
+   image was rendered) or the modification time of the cached file,
+   conditional requests get "304 Not Modified". Both are omitted if the
+   storage knows neither.
+ * the URL contains the modification time of the source (if the storage
+   provides it), so changed sources get new URLs. Only requests for the
+   current version may be cached for IMAGEQUERY_SERVE_MAX_AGE seconds,
+   all others for IMAGEQUERY_SERVE_UNVERSIONED_MAX_AGE seconds (sources of
+   remote storages, outdated URLs)
+ * IMAGEQUERY_SERVE_SENDFILE = 'x-sendfile' or 'x-accel-redirect' lets the
+   web server send the file (the latter needs
+   IMAGEQUERY_SERVE_SENDFILE_PREFIX, the internal location of the cache
+   storage), otherwise the file is streamed by Django
+ * with IMAGEQUERY_SERVE_NEGOTIATE the format is negotiated using the Accept
+   header (see imagequery.negotiation, responses contain "Vary: Accept")
+
+Template:
+{% image_format "thumb" photo.image signed %}
+"""
+import hashlib
+import os
+import time
+
+from django.core import signing
+from django.http import HttpResponse
+try:
+    from django.http import FileResponse
+except ImportError:  # Django < 1.8
+    from django.http import StreamingHttpResponse as FileResponse
+from django.core.urlresolvers import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date, parse_http_date_safe
+from imagequery.manifest import get_manifest
+from imagequery.settings import SERVE_MAX_AGE, SERVE_UNVERSIONED_MAX_AGE, SERVE_SENDFILE, \
+    SERVE_SENDFILE_PREFIX
+from imagequery.utils import get_imagequery, get_storage_alias
+
+SALT = 'imagequery.serving'
+
+
+def _value(format_name, storage_alias, source):
+    return u'%s|%s|%s' % (format_name, storage_alias, source)
+
+
+def get_signature(format_name, storage_alias, source):
+    return signing.Signer(salt=SALT).signature(_value(format_name, storage_alias, source))
+
+
+def check_signature(signature, format_name, storage_alias, source):
+    return constant_time_compare(signature, get_signature(format_name, storage_alias, source))
+
+
+def get_url(format_name, image):
+    '''
+    Returns the signed URL serving the format of image (path, field file or
+    ImageQuery without operations). The source must be stored in a registered
+    storage, absolute paths are made relative to the storage location.
+    '''
+    imagequery = get_imagequery(image)
+    if not imagequery.source or imagequery.query.has_operations():
+        raise ValueError('only sources without operations can be served')
+    storage_alias = get_storage_alias(imagequery.storage)
+    if storage_alias is None:
+        raise ValueError('the storage of %s is not registered' % imagequery.source)
+    source = imagequery.source
+    if source.startswith('/'):
+        # web servers merge the slashes of ".../signature//absolute/path"
+        source = _relative_source(imagequery.storage, source)
+    url = reverse('imagequery_serve', kwargs={
+        'format_name': format_name,
+        'storage_alias': storage_alias,
+        'signature': get_signature(format_name, storage_alias, source),
+        'source': source,
+    })
+    mtime = imagequery._source_mtime()
+    if mtime is not None:
+        url = '%s?v=%d' % (url, mtime)
+    return url
+
+
+def _relative_source(storage, source):
+    try:
+        location = storage.path('')
+    except NotImplementedError:
+        location = None
+    if location is not None:
+        location = os.path.join(os.path.abspath(location), '')
+        if os.path.abspath(source).startswith(location):
+            return os.path.abspath(source)[len(location):]
+    raise ValueError('%s is not stored inside the storage location' % source)
+
+
+def is_current(request, query):
+    ''' whether the request asks for the current version of the source '''
+    mtime = query._source_mtime()
+    return mtime is not None and request.GET.get('v') == '%d' % mtime
+
+
+def get_validators(query):
+    '''
+    returns ETag and Last-Modified (timestamp) of the rendered image, None if
+    unknown
+    '''
+    name = query._name()
+    created = None
+    key = query._manifest_key()
+    if key is not None:
+        record = get_manifest().get(key)
+        if query._valid_record(record) and record.get('name') == name:
+            created = record.get('created')
+    if created is None:
+        try:
+            created = time.mktime(query.cache_storage.modified_time(name).timetuple())
+        except (NotImplementedError, AttributeError, OSError):
+            return None, None
+    etag = '"%s"' % hashlib.sha1((u'%s:%d' % (name, created)).encode('utf-8')).hexdigest()
+    return etag, int(created)
+
+
+def not_modified(request, etag, last_modified):
+    ''' whether the client already has the image (conditional request) '''
+    if etag is None:
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        for value in if_none_match.split(','):
+            value = value.strip()
+            if value.startswith('W/'):
+                value = value[2:]
+            if value in ('*', etag):
+                return True
+        # If-Modified-Since is ignored if If-None-Match is present
+        return False
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return since is not None and last_modified <= since
+
+
+def file_response(query):
+    ''' returns the response sending the rendered image '''
+    name = query._name()
+    content_type = query.mimetype() or 'application/octet-stream'
+    if SERVE_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = query.cache_storage.path(name)
+        return response
+    if SERVE_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = os.path.join(SERVE_SENDFILE_PREFIX, name)
+        return response
+    fh = query.cache_storage.open(name, 'rb')
+    response = FileResponse(fh, content_type=content_type)
+    if not response.has_header('Content-Length'):
+        try:
+            response['Content-Length'] = str(query.cache_storage.size(name))
+        except (NotImplementedError, OSError):
+            pass
+    return response
+
+
+def set_validators(response, etag, last_modified, current=True):
+    ''' sets the caching headers, current tells whether the URL contains the current version '''
+    if etag is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+    if current:
+        response['Cache-Control'] = 'public, max-age=%d' % SERVE_MAX_AGE
+    else:
+        response['Cache-Control'] = 'public, max-age=%d' % SERVE_UNVERSIONED_MAX_AGE
+    return response
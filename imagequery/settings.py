@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from django.conf import settings
 from django.core.files.storage import default_storage as _default_storage, \
     get_storage_class
@@ -6,10 +9,41 @@ CACHE_DIR = getattr(settings, 'IMAGEQUERY_CACHE_DIR', 'cache')
 # can be used to define quality
 # IMAGEQUERY_DEFAULT_OPTIONS = {'quality': 92}
 DEFAULT_OPTIONS = getattr(settings, 'IMAGEQUERY_DEFAULT_OPTIONS', None)
+# named encoder profiles (see imagequery.encoding)
+# IMAGEQUERY_ENCODER_PROFILES = {'web': {'quality': 80, 'progressive': True}}
+ENCODER_PROFILES = getattr(settings, 'IMAGEQUERY_ENCODER_PROFILES', {})
+# formats offered to clients announcing support in their Accept header, in
+# order of preference (see imagequery.negotiation)
+# IMAGEQUERY_NEGOTIATE_FORMATS = ('AVIF', 'WEBP')
+NEGOTIATE_FORMATS = getattr(settings, 'IMAGEQUERY_NEGOTIATE_FORMATS', ('WEBP',))
+# allows decoding sources in reduced size (JPEG only) if the first operation
+# downscales the image. The source is decoded with at least DRAFT_FACTOR times
+# the target size, higher values mean less difference to the full decode.
+# None disables draft mode.
+# IMAGEQUERY_DRAFT_FACTOR = 2
+DRAFT_FACTOR = getattr(settings, 'IMAGEQUERY_DRAFT_FACTOR', None)
+# rewrite the operations before executing them (see imagequery.optimizer),
+# results may differ slightly from executing every single operation
+OPTIMIZE_OPERATIONS = getattr(settings, 'IMAGEQUERY_OPTIMIZE_OPERATIONS', False)
+# how Blur works: 'gaussian' (single pass gaussian blur), 'box' (single pass
+# box blur) or 'iterative' (applies ImageFilter.BLUR amount times, slow)
+BLUR_METHOD = getattr(settings, 'IMAGEQUERY_BLUR_METHOD', 'gaussian')
+# blurs with a bigger radius are done on a downscaled copy of the image,
+# which is scaled back up afterwards. None disables downscaling.
+BLUR_DOWNSCALE_RADIUS = getattr(settings, 'IMAGEQUERY_BLUR_DOWNSCALE_RADIUS', 20)
+# name cached images by the digest of the source contents instead of the
+# source path (see imagequery.digest), identical sources share their cached
+# images
+CONTENT_ADDRESSED = getattr(settings, 'IMAGEQUERY_CONTENT_ADDRESSED', False)
 # storage options
 DEFAULT_STORAGE = getattr(settings, 'IMAGEQUERY_DEFAULT_STORAGE', None)
 DEFAULT_CACHE_STORAGE = getattr(settings, 'IMAGEQUERY_DEFAULT_CACHE_STORAGE', None)
 
+# storages referenced by alias (for example by lazy formats), the default
+# storage is registered as 'default'
+# IMAGEQUERY_STORAGES = {'thumbnails': 'myproject.storages.thumbnail_storage'}
+STORAGES = getattr(settings, 'IMAGEQUERY_STORAGES', {})
+
 if DEFAULT_STORAGE:
     default_storage = get_storage_class(DEFAULT_STORAGE)
 else:
@@ -20,9 +54,85 @@ else:
     # we use the image storage if default_cache_storage is None
     default_cache_storage = None
 
+# index of generated images (see imagequery.manifest), allows checking whether
+# an image exists without touching the storage
+# IMAGEQUERY_MANIFEST_BACKEND = 'imagequery.manifest.CacheManifest'
+MANIFEST_BACKEND = getattr(settings, 'IMAGEQUERY_MANIFEST_BACKEND', None)
+MANIFEST_CACHE = getattr(settings, 'IMAGEQUERY_MANIFEST_CACHE', 'default')
+MANIFEST_PATH = getattr(settings, 'IMAGEQUERY_MANIFEST_PATH', 'imagequery_manifest.sqlite')
+MANIFEST_TIMEOUT = getattr(settings, 'IMAGEQUERY_MANIFEST_TIMEOUT', 604800)  # 7 days
+
+# records every use of a cached image in this SQLite database, used to evict
+# the least recently/frequently used images (see imagequery.maintenance)
+# IMAGEQUERY_ACCESS_LOG = '/var/lib/imagequery/access.sqlite'
+ACCESS_LOG = getattr(settings, 'IMAGEQUERY_ACCESS_LOG', None)
+# seconds between writes of the access log
+ACCESS_LOG_FLUSH = getattr(settings, 'IMAGEQUERY_ACCESS_LOG_FLUSH', 60)
+# state of the imagequery_cleanup command (cursor of incremental runs)
+CLEANUP_STATE = getattr(settings, 'IMAGEQUERY_CLEANUP_STATE',
+    os.path.join(tempfile.gettempdir(), 'imagequery_cleanup.sqlite'))
+
+# only render an image once if multiple requests need it at the same time
+# (see imagequery.locking), one of None, 'file', 'cache' or 'auto'
+RENDER_LOCK = getattr(settings, 'IMAGEQUERY_RENDER_LOCK', None)
+# seconds to wait for a lock held by someone else
+LOCK_TIMEOUT = getattr(settings, 'IMAGEQUERY_LOCK_TIMEOUT', 10)
+# seconds after which cache locks expire (crashed processes)
+LOCK_EXPIRE = getattr(settings, 'IMAGEQUERY_LOCK_EXPIRE', 60)
+LOCK_DIR = getattr(settings, 'IMAGEQUERY_LOCK_DIR',
+    os.path.join(tempfile.gettempdir(), 'imagequery_locks'))
+LOCK_CACHE = getattr(settings, 'IMAGEQUERY_LOCK_CACHE', 'default')
+# what url() returns if the lock could not be acquired: 'render' renders the
+# image anyway, 'source' returns the URL of the source image
+LOCK_FALLBACK = getattr(settings, 'IMAGEQUERY_LOCK_FALLBACK', 'render')
+
+# bytes of decoded images (sources and intermediate results) kept in memory
+# per process (see imagequery.lru), 0 disables the cache
+# IMAGEQUERY_MEMORY_CACHE_SIZE = 256 * 1024 * 1024
+MEMORY_CACHE_SIZE = getattr(settings, 'IMAGEQUERY_MEMORY_CACHE_SIZE', 0)
+# images using more than this fraction of the cache are not cached
+MEMORY_CACHE_MAX_ITEM = getattr(settings, 'IMAGEQUERY_MEMORY_CACHE_MAX_ITEM', 0.25)
+
+# thread pool sizes used by imagequery.aio
+ASYNC_IO_WORKERS = getattr(settings, 'IMAGEQUERY_ASYNC_IO_WORKERS', 16)
+ASYNC_RENDER_WORKERS = getattr(settings, 'IMAGEQUERY_ASYNC_RENDER_WORKERS', 4)
+
+# use NumPy for some operations if it is installed (see imagequery.vectorized)
+USE_NUMPY = getattr(settings, 'IMAGEQUERY_USE_NUMPY', True)
+
+# collect statistics for the whole process (see imagequery.stats)
+COLLECT_STATS = getattr(settings, 'IMAGEQUERY_COLLECT_STATS', False)
+
 ALLOW_LAZY_FORMAT = getattr(settings, 'IMAGEQUERY_ALLOW_LAZY_FORMAT', False)
 LAZY_FORMAT_DEFAULT = getattr(settings, 'IMAGEQUERY_LAZY_FORMAT_DEFAULT', False)
 LAZY_FORMAT_CLEANUP_TIME = getattr(settings, 'IMAGEQUERY_LAZY_FORMAT_CLEANUP_TIME', 86400)  # one day
+# URL the lazy view redirects to while the image is waiting in the render
+# queue, None redirects to the source image
+LAZY_FORMAT_PLACEHOLDER = getattr(settings, 'IMAGEQUERY_LAZY_FORMAT_PLACEHOLDER', None)
+# renders lazy formats in the background (see imagequery.jobs), None renders
+# them inside the request
+# IMAGEQUERY_RENDER_QUEUE = 'imagequery.jobs.DatabaseQueue'
+RENDER_QUEUE = getattr(settings, 'IMAGEQUERY_RENDER_QUEUE', None)
+# threads of imagequery.jobs.LocalQueue
+RENDER_QUEUE_WORKERS = getattr(settings, 'IMAGEQUERY_RENDER_QUEUE_WORKERS', 2)
+# seconds after which running jobs of crashed workers are run again
+RENDER_JOB_TIMEOUT = getattr(settings, 'IMAGEQUERY_RENDER_JOB_TIMEOUT', 600)
+# failed jobs are retried until they failed this often
+RENDER_JOB_ATTEMPTS = getattr(settings, 'IMAGEQUERY_RENDER_JOB_ATTEMPTS', 3)
+
+# seconds clients and CDNs may cache images sent by the serve view (see
+# imagequery.serving), if the URL contains the current version of the source
+SERVE_MAX_AGE = getattr(settings, 'IMAGEQUERY_SERVE_MAX_AGE', 31536000)  # one year
+# the same for URLs without (current) version, like sources of remote
+# storages not knowing modification times
+SERVE_UNVERSIONED_MAX_AGE = getattr(settings, 'IMAGEQUERY_SERVE_UNVERSIONED_MAX_AGE', 300)
+# let the web server send the files: None, 'x-sendfile' or 'x-accel-redirect'
+SERVE_SENDFILE = getattr(settings, 'IMAGEQUERY_SERVE_SENDFILE', None)
+# internal location of the cache storage (x-accel-redirect only)
+# IMAGEQUERY_SERVE_SENDFILE_PREFIX = '/protected/media/'
+SERVE_SENDFILE_PREFIX = getattr(settings, 'IMAGEQUERY_SERVE_SENDFILE_PREFIX', '/')
+# negotiate the format using the Accept header (see imagequery.negotiation)
+SERVE_NEGOTIATE = getattr(settings, 'IMAGEQUERY_SERVE_NEGOTIATE', False)
 
 AUTOLOAD_FORMATS = getattr(settings, 'IMAGEQUERY_AUTOLOAD_FORMATS', False)
 
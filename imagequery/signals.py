@@ -0,0 +1,28 @@
+"""
+Signals sent while working on images, can be used for profiling (see
+imagequery.stats for a collector using them)
+
+All signals provide a duration argument (seconds). Timing is only done if
+the signal has receivers.
+"""
+from django.dispatch import Signal
+
+# sender: operation class
+# args: operation, query_item, input_size, input_mode, output_size, output_mode
+operation_executed = Signal(providing_args=['operation', 'query_item', 'input_size',
+    'input_mode', 'output_size', 'output_mode', 'duration'])
+
+# sender: None
+# args: image (the loaded image)
+image_loaded = Signal(providing_args=['image', 'duration'])
+
+# sender: query class
+# args: query, exists
+existence_checked = Signal(providing_args=['query', 'exists', 'duration'])
+
+# sender: query class
+# args: query, name, format, size (output size), mode, bytes (bytes written),
+# profile (name of the encoder profile or None), encoding (result of
+# imagequery.encoding.Profile.save() or None)
+image_saved = Signal(providing_args=['query', 'name', 'format', 'size', 'mode',
+    'bytes', 'profile', 'encoding', 'duration'])
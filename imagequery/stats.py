@@ -0,0 +1,209 @@
+"""
+Collects statistics using the signals from imagequery.signals
+
+With IMAGEQUERY_COLLECT_STATS enabled the global collector aggregates the
+statistics of the current process, use collector.prometheus() (or the
+imagequery_metrics view) to export them in the Prometheus text format. The
+view is not protected, so its URL is defined in imagequery.metrics_urls
+instead of imagequery.urls. Include it only where the public cannot reach
+it.
+
+StatsMiddleware collects the statistics per request, see
+imagequery.middleware.
+"""
+import threading
+
+from imagequery import signals
+
+
+class StatsCollector(object):
+    """
+    Aggregates timings per operation, per format (the name of the Format
+    that created the query, '-' for queries not created by formats) and per
+    encoder profile
+
+    If thread is given only events from this thread are recorded.
+    """
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.formats = {}
+            self.profiles = {}
+            self.loads = {'count': 0, 'time': 0.0}
+
+    def connect(self):
+        signals.operation_executed.connect(self.operation_executed, weak=False)
+        signals.image_loaded.connect(self.image_loaded, weak=False)
+        signals.existence_checked.connect(self.existence_checked, weak=False)
+        signals.image_saved.connect(self.image_saved, weak=False)
+
+    def disconnect(self):
+        signals.operation_executed.disconnect(self.operation_executed)
+        signals.image_loaded.disconnect(self.image_loaded)
+        signals.existence_checked.disconnect(self.existence_checked)
+        signals.image_saved.disconnect(self.image_saved)
+
+    def _ignore(self):
+        return self.thread is not None and self.thread is not threading.current_thread()
+
+    def _format(self, query):
+        name = getattr(query, 'format_name', None) or '-'
+        if name not in self.formats:
+            self.formats[name] = {
+                'exists_checks': 0,
+                'exists_hits': 0,
+                'exists_time': 0.0,
+                'saves': 0,
+                'save_time': 0.0,
+                'bytes': 0,
+            }
+        return self.formats[name]
+
+    def operation_executed(self, sender, operation, input_size, output_size, duration, **kwargs):
+        if self._ignore():
+            return
+        with self._lock:
+            name = sender.__name__
+            if name not in self.operations:
+                self.operations[name] = {'count': 0, 'time': 0.0, 'input_pixels': 0, 'output_pixels': 0}
+            stats = self.operations[name]
+            stats['count'] += 1
+            stats['time'] += duration
+            stats['input_pixels'] += input_size[0] * input_size[1]
+            stats['output_pixels'] += output_size[0] * output_size[1]
+
+    def image_loaded(self, sender, image, duration, **kwargs):
+        if self._ignore():
+            return
+        with self._lock:
+            self.loads['count'] += 1
+            self.loads['time'] += duration
+
+    def existence_checked(self, sender, query, exists, duration, **kwargs):
+        if self._ignore():
+            return
+        with self._lock:
+            stats = self._format(query)
+            stats['exists_checks'] += 1
+            stats['exists_time'] += duration
+            if exists:
+                stats['exists_hits'] += 1
+
+    def image_saved(self, sender, query, bytes, duration, profile=None, encoding=None, **kwargs):
+        if self._ignore():
+            return
+        with self._lock:
+            stats = self._format(query)
+            stats['saves'] += 1
+            stats['save_time'] += duration
+            stats['bytes'] += bytes
+            if profile is not None and encoding is not None:
+                if profile not in self.profiles:
+                    self.profiles[profile] = {'encodes': 0, 'attempts': 0, 'encode_time': 0.0, 'bytes': 0}
+                stats = self.profiles[profile]
+                stats['encodes'] += 1
+                stats['attempts'] += encoding['attempts']
+                stats['encode_time'] += encoding['duration']
+                stats['bytes'] += encoding['bytes']
+
+    def total_time(self):
+        with self._lock:
+            return sum([stats['time'] for stats in self.operations.values()]) + \
+                sum([stats['exists_time'] + stats['save_time'] for stats in self.formats.values()]) + \
+                self.loads['time']
+
+    def summary(self):
+        ''' short summary, used by StatsMiddleware '''
+        with self._lock:
+            operations = sum([stats['count'] for stats in self.operations.values()])
+            operation_time = sum([stats['time'] for stats in self.operations.values()])
+            checks = sum([stats['exists_checks'] for stats in self.formats.values()])
+            saves = sum([stats['saves'] for stats in self.formats.values()])
+            save_time = sum([stats['save_time'] for stats in self.formats.values()])
+            written = sum([stats['bytes'] for stats in self.formats.values()])
+        return 'operations=%d (%.3fs) exists_checks=%d saves=%d (%.3fs, %d bytes)' % (
+            operations, operation_time, checks, saves, save_time, written)
+
+    def prometheus(self):
+        ''' returns the statistics in the Prometheus text format '''
+        from imagequery import digest, locking  # late import to avoid circular import
+        from imagequery.lru import image_cache
+
+        lines = []
+
+        def metric(name, help, values, type='counter'):
+            lines.append('# HELP imagequery_%s %s' % (name, help))
+            lines.append('# TYPE imagequery_%s %s' % (name, type))
+            for labels, value in values:
+                if labels:
+                    label_text = ','.join(['%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels)])
+                    lines.append('imagequery_%s{%s} %s' % (name, label_text, value))
+                else:
+                    lines.append('imagequery_%s %s' % (name, value))
+
+        with self._lock:
+            operations = sorted(self.operations.items())
+            formats = sorted(self.formats.items())
+            profiles = sorted(self.profiles.items())
+            loads = dict(self.loads)
+        metric('operations_total', 'Number of executed operations',
+            [({'operation': name}, stats['count']) for name, stats in operations])
+        metric('operation_seconds_total', 'Time spent executing operations',
+            [({'operation': name}, stats['time']) for name, stats in operations])
+        metric('operation_input_pixels_total', 'Pixels passed into operations',
+            [({'operation': name}, stats['input_pixels']) for name, stats in operations])
+        metric('exists_checks_total', 'Number of cache existence checks',
+            [({'format': name}, stats['exists_checks']) for name, stats in formats])
+        metric('exists_hits_total', 'Number of cache existence checks finding the image',
+            [({'format': name}, stats['exists_hits']) for name, stats in formats])
+        metric('exists_seconds_total', 'Time spent checking the cache',
+            [({'format': name}, stats['exists_time']) for name, stats in formats])
+        metric('saves_total', 'Number of saved images',
+            [({'format': name}, stats['saves']) for name, stats in formats])
+        metric('save_seconds_total', 'Time spent encoding and writing images',
+            [({'format': name}, stats['save_time']) for name, stats in formats])
+        metric('saved_bytes_total', 'Bytes written for saved images',
+            [({'format': name}, stats['bytes']) for name, stats in formats])
+        metric('profile_encodes_total', 'Number of images encoded per encoder profile',
+            [({'profile': name}, stats['encodes']) for name, stats in profiles])
+        metric('profile_encoder_runs_total', 'Encoder runs per encoder profile (size-targeted quality search)',
+            [({'profile': name}, stats['attempts']) for name, stats in profiles])
+        metric('profile_encode_seconds_total', 'Time spent encoding per encoder profile',
+            [({'profile': name}, stats['encode_time']) for name, stats in profiles])
+        metric('profile_bytes_total', 'Bytes of images encoded per encoder profile',
+            [({'profile': name}, stats['bytes']) for name, stats in profiles])
+        metric('loads_total', 'Number of images loaded', [(None, loads['count'])])
+        metric('load_seconds_total', 'Time spent loading images', [(None, loads['time'])])
+        lock_stats = locking.get_stats()
+        metric('lock_acquired_total', 'Number of acquired render locks', [(None, lock_stats['acquired'])])
+        metric('lock_contended_total', 'Number of render locks held by others', [(None, lock_stats['contended'])])
+        metric('lock_timeouts_total', 'Number of render locks not acquired in time', [(None, lock_stats['timeouts'])])
+        metric('lock_wait_seconds_total', 'Time spent waiting for render locks', [(None, lock_stats['wait_time'])])
+        cache_stats = image_cache.stats()
+        metric('memory_cache_hits_total', 'Hits of the in-memory image cache', [(None, cache_stats['hits'])])
+        metric('memory_cache_misses_total', 'Misses of the in-memory image cache', [(None, cache_stats['misses'])])
+        metric('memory_cache_evictions_total', 'Images evicted from the in-memory image cache',
+            [(None, cache_stats['evictions'])])
+        metric('memory_cache_bytes', 'Bytes used by the in-memory image cache', [(None, cache_stats['size'])],
+            type='gauge')
+        digest_stats = digest.stats()
+        metric('content_sources', 'Sources with known content digest', [(None, digest_stats['sources'])],
+            type='gauge')
+        metric('content_digests', 'Distinct content digests of the sources', [(None, digest_stats['digests'])],
+            type='gauge')
+        metric('content_dedup_ratio', 'Fraction of sources sharing cached images with other sources',
+            [(None, digest_stats['dedup_ratio'])], type='gauge')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+collector = StatsCollector()
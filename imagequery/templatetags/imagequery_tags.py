@@ -1,5 +1,6 @@
 from django import template
-from imagequery import ImageQuery, formats
+from imagequery import ImageQuery, encoding, formats, negotiation, serving
+from imagequery.prefetch import CONTEXT_NAME as PREFETCH_CONTEXT_NAME, Prefetched, prefetch_formats
 from imagequery.utils import get_imagequery
 from django.db.models.fields.files import ImageFieldFile
 from django.utils.encoding import smart_unicode
@@ -39,9 +40,10 @@ def imagequerify(func):
     def newfunc(image, attr):
         try:
             image = get_imagequery(image)
+            # the source is opened when needed, missing files raise here
+            return func(image, attr)
         except IOError:
             return ''
-        return func(image, attr)
 
     return newfunc
 
@@ -93,10 +95,12 @@ query_name = imagequery_filter('query_name')
 
 
 class ImageFormatNode(template.Node):
-    def __init__(self, format, image, name, allow_lazy=None):
+    def __init__(self, format, image, name, allow_lazy=None, negotiate=False, signed=False):
         self.format = format
         self.image = image
         self.name = name
+        self.negotiate = negotiate
+        self.signed = signed
         if allow_lazy is None:
             self.allow_lazy = LAZY_FORMAT_DEFAULT and ALLOW_LAZY_FORMAT
         else:
@@ -108,6 +112,21 @@ class ImageFormatNode(template.Node):
             image = self.image.resolve(context)
         except template.VariableDoesNotExist:
             return ''
+        if self.signed and not self.name:
+            try:
+                formats.get(formatname)
+                return serving.get_url(formatname, image)
+            except (formats.FormatDoesNotExist, ValueError):
+                return ''
+        accept = None
+        if self.negotiate and not self.name and 'request' in context:
+            accept = context['request'].META.get('HTTP_ACCEPT')
+        if not self.name and not accept:
+            prefetched = context.get(PREFETCH_CONTEXT_NAME)
+            if prefetched is not None:
+                url = prefetched.get(formatname, image)
+                if url is not None:
+                    return url
         try:
             format_cls = formats.get(formatname)
         except formats.FormatDoesNotExist:
@@ -117,18 +136,24 @@ class ImageFormatNode(template.Node):
         except IOError:  # handle missing files
             return ''
         format = format_cls(imagequery)
-        if self.allow_lazy and not self.name and not format._execute()._exists():
+        try:
+            query = format._execute()
+        except encoding.ProfileDoesNotExist:  # Format.profile is not registered
+            return ''
+        if self.allow_lazy and not self.name and not query._exists():
             from imagequery.models import LazyFormat
 
-            lazy_format = LazyFormat(format=formatname)
-            lazy_format.query = imagequery
-            lazy_format.save()
-            return lazy_format.get_absolute_url()
+            try:
+                return LazyFormat.objects.get_url(formatname, imagequery)
+            except ValueError:  # storage without alias, render it now
+                pass
         if self.name:
             context[self.name] = format
             return ''
         else:
             try:
+                if accept:
+                    return negotiation.negotiate(query, accept).url()
                 return format.url()
             except:
                 return ''
@@ -148,6 +173,15 @@ def image_format(parser, token):
     {% image_format "some_format" foo.image as var %}
     {% image_format "some_format" foo.image lazy %}
     {% image_format "some_format" foo.image nolazy %}
+    {% image_format "some_format" foo.image negotiate %}
+
+    {% image_format "some_format" foo.image signed %}
+
+    "negotiate" returns the URL of the best format for the Accept header of
+    the request (like WebP, see imagequery.negotiation), the request must be
+    available in the context.
+    "signed" returns the URL of the serve view rendering the image when
+    requested (see imagequery.serving), nothing is checked or rendered here.
     
     This tag does not support storage by design. If you want to use different
     storage engines here you have to:
@@ -159,12 +193,14 @@ def image_format(parser, token):
     bits = token.split_contents()
     tag_name = bits[0]
     values = bits[1:]
-    if len(values) not in (2, 3, 4):
-        raise template.TemplateSyntaxError(u'%r tag needs two, three or four parameters.' % tag_name)
+    if len(values) not in (2, 3, 4, 5):
+        raise template.TemplateSyntaxError(u'%r tag needs two to five parameters.' % tag_name)
     format = parser.compile_filter(values[0])
     image = parser.compile_filter(values[1])
     name = None
     allow_lazy = None
+    negotiate = False
+    signed = False
     i = 2
     while i < len(values):
         if values[i] == 'as':
@@ -175,8 +211,70 @@ def image_format(parser, token):
             i = i + 1
         elif values[i] == 'nolazy':
             allow_lazy = False
-            i = i + 2
+            i = i + 1
+        elif values[i] == 'negotiate':
+            negotiate = True
+            i = i + 1
+        elif values[i] == 'signed':
+            signed = True
+            i = i + 1
         else:
-            raise template.TemplateSyntaxError(u'%r tag: parameter must be "as" or "lazy"/"nolazy"' % tag_name)
-    return ImageFormatNode(format, image, name, allow_lazy)
+            raise template.TemplateSyntaxError(
+                u'%r tag: parameter must be "as", "lazy"/"nolazy", "negotiate" or "signed"' % tag_name)
+    return ImageFormatNode(format, image, name, allow_lazy, negotiate, signed)
+
 
+class PrefetchImageFormatsNode(template.Node):
+    def __init__(self, images, format_names, field):
+        self.images = images
+        self.format_names = format_names
+        self.field = field
+
+    def render(self, context):
+        try:
+            images = self.images.resolve(context)
+            format_names = [format_name.resolve(context) for format_name in self.format_names]
+        except template.VariableDoesNotExist:
+            return ''
+        if self.field:
+            images = [getattr(obj, self.field) for obj in images]
+        try:
+            prefetched = prefetch_formats(images, format_names)
+        except (formats.FormatDoesNotExist, encoding.ProfileDoesNotExist):
+            return ''
+        previous = context.get(PREFETCH_CONTEXT_NAME)
+        if previous is not None:
+            merged = Prefetched()
+            merged.update(previous)
+            merged.update(prefetched)
+            prefetched = merged
+        context[PREFETCH_CONTEXT_NAME] = prefetched
+        return ''
+
+
+@register.tag
+def prefetch_image_formats(parser, token):
+    """
+    Makes sure the given formats exist for all images of a list, the
+    image_format tag then only needs to look up the URLs (see
+    imagequery.prefetch). Use "field" if the list contains objects having an
+    image field.
+
+    Examples:
+    {% prefetch_image_formats images "thumb" "large" %}
+    {% prefetch_image_formats objects "thumb" field "image" %}
+    """
+    bits = token.split_contents()
+    tag_name = bits[0]
+    values = bits[1:]
+    field = None
+    if len(values) >= 2 and values[-2] == 'field':
+        field = values[-1]
+        if field[0] == field[-1] and field[0] in ('"', "'"):
+            field = field[1:-1]
+        values = values[:-2]
+    if len(values) < 2:
+        raise template.TemplateSyntaxError(u'%r tag needs a list of images and at least one format.' % tag_name)
+    images = parser.compile_filter(values[0])
+    format_names = [parser.compile_filter(value) for value in values[1:]]
+    return PrefetchImageFormatsNode(images, format_names, field)
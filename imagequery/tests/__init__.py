@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import datetime
 import os
 import shutil
 
@@ -8,6 +9,7 @@ except ImportError:
     import Image
 from django.test import TestCase
 from django.conf import settings
+from django.core.files.base import File
 from django.core.files.storage import FileSystemStorage
 from django.db import models
 from imagequery.query import ImageQuery, RawImageQuery, NewImageQuery
@@ -22,6 +24,44 @@ class ImageModel(models.Model):
         return self.name
 
 
+class RemoteStorage(FileSystemStorage):
+    """ storage without local paths (like remote storages), counts opened files """
+
+    def __init__(self, *args, **kwargs):
+        super(RemoteStorage, self).__init__(*args, **kwargs)
+        self.opened = 0
+
+    def path(self, name):
+        raise NotImplementedError()
+
+    def _local_path(self, name):
+        return super(RemoteStorage, self).path(name)
+
+    def _open(self, name, mode='rb'):
+        self.opened += 1
+        return File(open(self._local_path(name), mode))
+
+    def exists(self, name):
+        return os.path.exists(self._local_path(name))
+
+    def _save(self, name, content):
+        path = self._local_path(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fh:
+            for chunk in content.chunks():
+                fh.write(chunk)
+        return name
+
+    def delete(self, name):
+        os.remove(self._local_path(name))
+
+    def modified_time(self, name):
+        return datetime.datetime.fromtimestamp(os.path.getmtime(self._local_path(name)))
+
+    get_modified_time = modified_time
+
+
 class TestFormat(formats.Format):
     def execute(self, qs):
         return qs.grayscale().query_name('test_format')
@@ -46,8 +86,11 @@ class ImageQueryTest(TestCase):
         formats.register('test', TestFormat)
 
     def tearDown(self):
+        from imagequery import utils
+
         shutil.rmtree(self.tmp_dir)
         formats._formats = self.registered_formats
+        utils._get_storages().pop('test_tmp', None)
 
     def sample(self, path):
         return os.path.join(self.sample_dir, path)
@@ -64,6 +107,12 @@ class ImageQueryTest(TestCase):
         f2hash.update(Image.open(im2).tostring())
         return f1hash.hexdigest() == f2hash.hexdigest()
 
+    def difference(self, im1, im2):
+        from PIL import ImageChops, ImageStat
+
+        diff = ImageChops.difference(im1.convert('RGB'), im2.convert('RGB'))
+        return max(ImageStat.Stat(diff).rms)
+
     def test_load_simple_filename(self):
         iq = ImageQuery(self.sample('django_colors.jpg'))
         iq.grayscale().save(self.tmp('test.jpg'))
@@ -142,6 +191,418 @@ class ImageQueryTest(TestCase):
         self.assertEqual(dj.mimetype(), 'image/jpeg')
         self.assertEqual(tux.mimetype(), 'image/png')
 
+    def test_draft_decoding(self):
+        from imagequery import query
+
+        full = ImageQuery(self.sample('lynx_kitten.jpg')).scale(100, 100).raw()
+        draft_factor = query.DRAFT_FACTOR
+        query.DRAFT_FACTOR = 2
+        try:
+            iq = ImageQuery(self.sample('lynx_kitten.jpg')).scale(100, 100)
+            drafted = iq.raw()
+            self.assertEqual(iq.image.size, (400, 267))
+        finally:
+            query.DRAFT_FACTOR = draft_factor
+        self.assertEqual(full.size, drafted.size)
+        self.assert_(self.difference(full, drafted) < 5)
+
+    def test_optimized_operations(self):
+        from imagequery import query, optimizer, operations
+
+        def chain():
+            lynx = ImageQuery(self.sample('lynx_kitten.jpg'))
+            return lynx.invert().resize(400).scale(100, 100).flip().flip()
+
+        iq = chain()
+        name = iq._name()
+        steps = optimizer.optimize(iq.query.plan(), iq.image.size, iq.image.mode)
+        self.assertEqual([type(op) for op, item in steps], [operations.Resize, operations.Invert])
+        # PIL resizes palette images using NEAREST, the order matters
+        steps = optimizer.optimize(iq.query.plan(), iq.image.size, 'P')
+        self.assertEqual([type(op) for op, item in steps], [operations.Invert, operations.Resize])
+        # downscaling followed by upscaling is not merged
+        steps = optimizer.optimize(chain().scale(50, 50).resize(400).query.plan(), iq.image.size, 'RGB')
+        self.assertEqual(len([op for op, item in steps if isinstance(op, optimizer.GEOMETRIC)]), 2)
+        full = iq.raw(allow_reopen=False)
+        optimize_operations = query.OPTIMIZE_OPERATIONS
+        query.OPTIMIZE_OPERATIONS = True
+        try:
+            optimized_iq = chain()
+            optimized = optimized_iq.raw(allow_reopen=False)
+            # all operations are optimized away, the format must still be used
+            png = ImageQuery(self.sample('lynx_kitten.jpg')).flip().flip().image_format('PNG')
+            self.assertEqual(Image.open(png.path()).format, 'PNG')
+        finally:
+            query.OPTIMIZE_OPERATIONS = optimize_operations
+        self.assertEqual(name, optimized_iq._name())
+        self.assertEqual(full.size, optimized.size)
+        self.assert_(self.difference(full, optimized) < 5)
+
+    def test_manifest(self):
+        import time
+        from imagequery import manifest
+
+        previous_manifest = manifest._manifest
+        manifest._manifest = manifest.SQLiteManifest(self.tmp('manifest.sqlite'))
+        try:
+            iq = ImageQuery(self.sample('django_colors.jpg')).grayscale()
+            self.assert_(not iq._exists())
+            iq.path()
+            self.assert_(manifest.get_manifest().get(iq._manifest_key()))
+            iq = ImageQuery(self.sample('django_colors.jpg')).grayscale()
+            self.assertEqual(manifest.bulk_exists([iq, iq.invert()]), [True, False])
+            # records of overwritten sources are not used
+            mtime = int(time.time()) + 10
+            os.utime(self.sample('django_colors.jpg'), (mtime, mtime))
+            iq = ImageQuery(self.sample('django_colors.jpg')).grayscale()
+            self.assert_(not iq._exists())
+            self.assertEqual(manifest.bulk_exists([iq]), [False])
+            iq.path()
+            self.assertEqual(manifest.get_manifest().get(iq._manifest_key())['mtime'], mtime)
+        finally:
+            manifest._manifest = previous_manifest
+
+    def test_content_addressed(self):
+        from imagequery import digest, query
+
+        shutil.copy(self.sample('django_colors.jpg'), self.sample('django_colors_copy.jpg'))
+        digest.clear()
+        content_addressed = query.CONTENT_ADDRESSED
+        query.CONTENT_ADDRESSED = True
+        try:
+            iq = ImageQuery(self.sample('django_colors.jpg')).grayscale()
+            copy = ImageQuery(self.sample('django_colors_copy.jpg')).grayscale()
+            self.assertEqual(iq._name(), copy._name())
+            self.assertNotEqual(iq._name(), ImageQuery(self.sample('lynx_kitten.jpg')).grayscale()._name())
+            self.assertEqual(digest.stats()['digests'], 2)
+            self.assert_(digest.stats()['dedup_ratio'] > 0)
+            iq.path()
+            self.assert_(copy._exists())
+            # digests of remote sources are remembered using their modification time
+            remote = RemoteStorage(location=self.sample_dir)
+            name = ImageQuery('django_colors.jpg', storage=remote).grayscale()._name()
+            self.assertEqual(ImageQuery('django_colors.jpg', storage=remote).grayscale()._name(), name)
+            self.assertEqual(remote.opened, 1)
+        finally:
+            query.CONTENT_ADDRESSED = content_addressed
+
+    def test_cleanup(self):
+        from imagequery.maintenance import Cleanup
+
+        for name in ('keep.jpg', 'gone.jpg'):
+            shutil.copyfile(self.sample('django_colors.jpg'), os.path.join(self.tmpstorage_dir, name))
+        keep = ImageQuery('keep.jpg', storage=self.tmpstorage).grayscale()
+        gone = ImageQuery('gone.jpg', storage=self.tmpstorage).grayscale()
+        keep.path(), gone.path()
+        os.remove(os.path.join(self.tmpstorage_dir, 'gone.jpg'))
+        state = self.tmp('cleanup.sqlite')
+        # files are visited in sorted order, gone.jpg first
+        stats = Cleanup(self.tmpstorage, orphans=True, limit=1, state_path=state).run()
+        self.assertEqual((stats['checked'], stats['deleted'], stats['finished']), (1, 1, False))
+        stats = Cleanup(self.tmpstorage, orphans=True, state_path=state).run()
+        self.assertEqual((stats['checked'], stats['deleted'], stats['finished']), (1, 0, True))
+        self.assert_(self.tmpstorage.exists(keep._name()))
+        self.assert_(not self.tmpstorage.exists(gone._name()))
+        # size budget
+        stats = Cleanup(self.tmpstorage, max_size=1, state_path=state).run()
+        self.assertEqual(stats['deleted'], 1)
+        self.assert_(not self.tmpstorage.exists(keep._name()))
+        # records of deleted images are removed from the manifest
+        from imagequery import manifest
+
+        previous_manifest = manifest._manifest
+        manifest._manifest = manifest.CacheManifest()
+        try:
+            manifest.get_manifest().clear()
+            ImageQuery('keep.jpg', storage=self.tmpstorage).grayscale().path()
+            self.assert_(ImageQuery('keep.jpg', storage=self.tmpstorage).grayscale()._exists())
+            Cleanup(self.tmpstorage, max_size=1, state_path=self.tmp('cleanup2.sqlite')).run()
+            self.assert_(not ImageQuery('keep.jpg', storage=self.tmpstorage).grayscale()._exists())
+        finally:
+            manifest._manifest = previous_manifest
+
+    def test_batch(self):
+        from django.core.management import call_command
+        from imagequery import batch
+
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+
+        class FlipFormat(formats.Format):
+            def execute(self, qs):
+                return qs.flip().query_name('test_flip')
+
+        formats.register('test_flip', FlipFormat)
+        source = self.sample('django_colors.jpg')
+        result = batch.render_formats(['test', 'test_flip'], [source], workers=0)
+        self.assertEqual((result.rendered, result.skipped, result.failed), (2, 0, []))
+        for format_cls in (TestFormat, FlipFormat):
+            self.assert_(os.path.exists(format_cls(ImageQuery(source))._execute()._path()))
+        result = batch.render_formats(['test', 'test_flip'], [source, self.sample('missing.jpg')], workers=0)
+        self.assertEqual((result.rendered, result.skipped, len(result.failed)), (0, 2, 1))
+        output = StringIO()
+        call_command('imagequery_render', 'test,test_flip', source, workers=0, stdout=output)
+        self.assert_('rendered: 0, skipped: 2, failed: 0' in output.getvalue())
+
+    def test_save_file(self):
+        from imagequery.utils import save_file
+
+        def writer(data):
+            def write(fh):
+                fh.write(data)
+            return write
+
+        def failing(fh):
+            fh.write(b'partial')
+            raise IOError('failed')
+
+        # local storages: temporary file renamed, existing files replaced
+        directory = os.path.join(self.tmpstorage_dir, 'saved')
+        save_file(self.tmpstorage, 'saved/image.png', writer(b'one'))
+        self.assertEqual(save_file(self.tmpstorage, 'saved/image.png', writer(b'two')), 'saved/image.png')
+        self.assertRaises(IOError, save_file, self.tmpstorage, 'saved/image.png', failing)
+        self.assertEqual(os.listdir(directory), ['image.png'])
+        with open(os.path.join(directory, 'image.png'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'two')
+
+        # storages without path(): no copies using other names
+        class RacingStorage(RemoteStorage):
+            ''' someone else saves the file right after it was deleted (once) '''
+            raced = False
+
+            def delete(self, name):
+                super(RacingStorage, self).delete(name)
+                if not self.raced:
+                    self.raced = True
+                    with open(self._local_path(name), 'wb') as fh:
+                        fh.write(b'other')
+
+        remote_dir = os.path.join(self.tmpstorage_save_dir, 'saved')
+        remote = RemoteStorage(location=self.tmpstorage_save_dir)
+        save_file(remote, 'saved/image.png', writer(b'one'))
+        save_file(remote, 'saved/image.png', writer(b'two'))
+        self.assertEqual(os.listdir(remote_dir), ['image.png'])
+        with open(os.path.join(remote_dir, 'image.png'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'two')
+        racing = RacingStorage(location=self.tmpstorage_save_dir)
+        self.assertEqual(save_file(racing, 'saved/image.png', writer(b'three')), 'saved/image.png')
+        self.assertEqual(os.listdir(remote_dir), ['image.png'])
+        with open(os.path.join(remote_dir, 'image.png'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'other')
+
+    def test_local_queue(self):
+        from imagequery.jobs import LocalQueue
+
+        queue = LocalQueue(workers=1)
+        iq = ImageQuery(self.sample('django_colors.jpg'))
+        key = queue.enqueue('test', iq)
+        # pending jobs for the same target are merged
+        self.assertEqual(queue.enqueue('test', ImageQuery(self.sample('django_colors.jpg'))), key)
+        queue.join()
+        self.assert_(not queue.is_pending(key))
+        self.assert_(TestFormat(ImageQuery(self.sample('django_colors.jpg')))._execute()._exists())
+
+    def test_render_lock(self):
+        from imagequery.locking import get_lock, render_locks
+
+        # paths passed twice are locked once (no waiting for ourselves)
+        targets = [(self.tmpstorage, 'b.jpg'), (self.tmpstorage, 'a.jpg'), (self.tmpstorage, 'b.jpg')]
+        with render_locks(targets, timeout=0) as results:
+            self.assertEqual(len(results), 3)
+            self.assert_(all(result.acquired for result in results))
+
+        lock = get_lock(self.tmpstorage, 'locked.jpg', backend='file')
+        other = get_lock(self.tmpstorage, 'locked.jpg', backend='file')
+        if not hasattr(lock, 'path'):  # no fcntl
+            return
+        self.assert_(lock.acquire())
+        self.assert_(not other.acquire())
+        lock.release()
+        # lock files are removed on release
+        self.assert_(not os.path.exists(lock.path))
+        self.assert_(other.acquire())
+        other.release()
+
+    def test_storage_alias(self):
+        from imagequery.jobs import get_job_key
+        from imagequery.utils import register_storage, get_storage, get_storage_alias
+
+        register_storage('test_tmp', self.tmpstorage)
+        self.assertEqual(get_storage('test_tmp'), self.tmpstorage)
+        self.assertEqual(get_storage_alias(FileSystemStorage(location=self.tmpstorage_dir)), 'test_tmp')
+        self.assertEqual(get_storage_alias(self.tmpstorage_save), None)
+        shutil.copyfile(self.sample('django_colors.jpg'), os.path.join(self.tmpstorage_dir, 'lazy.jpg'))
+        key = get_job_key('test', ImageQuery('lazy.jpg', storage=self.tmpstorage))
+        self.assertEqual(key, get_job_key('test', ImageQuery('lazy.jpg', storage=self.tmpstorage)))
+        self.assertNotEqual(key, get_job_key('other', ImageQuery('lazy.jpg', storage=self.tmpstorage)))
+
+    def test_lazy_source(self):
+        iq = ImageQuery(self.sample('django_colors.jpg'))
+        self.assert_('_fh' not in iq.__dict__)
+        gray = iq.grayscale()
+        gray.path()
+        self.assert_('_fh' not in gray.__dict__)
+        # existing images don't need the source file
+        os.rename(self.sample('django_colors.jpg'), self.sample('moved.jpg'))
+        try:
+            self.assertEqual(ImageQuery(self.sample('django_colors.jpg')).grayscale().path(), gray.path())
+        finally:
+            os.rename(self.sample('moved.jpg'), self.sample('django_colors.jpg'))
+        self.assertEqual(ImageQuery(self.sample('django_colors.jpg'))._probe()['size'], (800, 600))
+
+    def test_size_inference(self):
+        lynx = ImageQuery(self.sample('lynx_kitten.jpg'))
+        for query in (lynx.resize(400), lynx.scale(300, 100), lynx.fit(123, 45), lynx.crop(10, 10, 50, 60),
+                      lynx.padding(5, 10).blank(x=20), lynx.clip((10, 20), (100, 50)).grayscale(),
+                      lynx.scale(200, 200).padding(1, 2, 3, 4).invert()):
+            size = query.size()
+            self.assert_('_image' not in query.__dict__)
+            self.assertEqual(size, query.raw(allow_reopen=False).size)
+
+    def test_probe(self):
+        from imagequery import probe
+
+        probe.clear()
+        lynx = ImageQuery(self.sample('lynx_kitten.jpg'))
+        metadata = lynx.metadata()
+        self.assertEqual((metadata['format'], metadata['mode'], metadata['orientation'], metadata['frames']),
+                         ('JPEG', 'RGB', 1, 1))
+        self.assertEqual(probe.decode(probe.encode(metadata)), metadata)
+        self.assertEqual(lynx.grayscale().mimetype(), 'image/jpeg')
+        self.assertEqual(ImageQuery(self.sample('tux_transparent.png')).mimetype(), 'image/png')
+        self.assert_('_image' not in lynx.__dict__)
+        # probes are stored as metadata, not as image records
+        from imagequery import manifest
+
+        previous_manifest = manifest._manifest
+        manifest._manifest = manifest.SQLiteManifest(self.tmp('manifest.sqlite'))
+        try:
+            probe.clear()
+            ImageQuery(self.sample('lynx_kitten.jpg')).metadata()
+            rows = manifest.get_manifest().connection.execute('SELECT COUNT(*) FROM imagequery_manifest')
+            self.assertEqual(rows.fetchone()[0], 0)
+            rows = manifest.get_manifest().connection.execute('SELECT kind FROM imagequery_metadata')
+            self.assertEqual(rows.fetchall(), [('probe',)])
+        finally:
+            manifest._manifest = previous_manifest
+        # remote sources are probed once, too
+        remote = RemoteStorage(location=self.sample_dir)
+        size = ImageQuery('lynx_kitten.jpg', storage=remote).size()
+        self.assertEqual(ImageQuery('lynx_kitten.jpg', storage=remote).size(), size)
+        self.assertEqual(ImageQuery('lynx_kitten.jpg', storage=remote).mimetype(), 'image/jpeg')
+        self.assertEqual(remote.opened, 1)
+
+    def test_image_cache(self):
+        from imagequery.lru import image_cache
+
+        max_size, max_item_size = image_cache.max_size, image_cache.max_item_size
+        image_cache.max_size = image_cache.max_item_size = 16 * 1024 * 1024
+        image_cache.clear()
+        try:
+            lynx = ImageQuery(self.sample('lynx_kitten.jpg'))
+            scaled = lynx.scale(100, 100).raw(allow_reopen=False)
+            hits = image_cache.hits
+            lynx = ImageQuery(self.sample('lynx_kitten.jpg'))
+            gray = lynx.scale(100, 100).grayscale().raw(allow_reopen=False)
+            # source and scaled image are reused
+            self.assertEqual(image_cache.hits, hits + 2)
+            self.assertEqual(scaled.size, gray.size)
+            # modifying the result of raw() does not change cached images
+            original = scaled.copy()
+            scaled.paste((255, 0, 0), (0, 0) + scaled.size)
+            again = ImageQuery(self.sample('lynx_kitten.jpg')).scale(100, 100).raw(allow_reopen=False)
+            self.assertEqual(self.difference(again, original), 0)
+        finally:
+            image_cache.max_size, image_cache.max_item_size = max_size, max_item_size
+            image_cache.clear()
+
+    def test_stats(self):
+        from imagequery.stats import StatsCollector
+
+        stats = StatsCollector()
+        stats.connect()
+        try:
+            iq = ImageQuery(self.sample('django_colors.jpg'))
+            iq.grayscale().invert().save(self.tmp('test.jpg'))
+        finally:
+            stats.disconnect()
+        self.assertEqual(stats.operations['Grayscale']['count'], 1)
+        self.assertEqual(stats.operations['Invert']['count'], 1)
+        self.assertEqual(stats.formats['-']['saves'], 1)
+        self.assertEqual(stats.formats['-']['bytes'], os.path.getsize(self.tmp('test.jpg')))
+        self.assert_('imagequery_operations_total{operation="Invert"} 1' in stats.prometheus())
+
+    def test_encoder_profile(self):
+        from imagequery.encoding import Profile
+        from imagequery.stats import StatsCollector
+
+        iq = ImageQuery(self.sample('lynx_kitten.jpg'))
+        plain = iq.scale(400, 400)
+        small = plain.encoder_profile(Profile('small', progressive=True, max_kb=10))
+        self.assertNotEqual(plain._name(), small._name())
+        self.assertEqual(iq.grayscale().query_name('gray').encoder_profile(small.query.profile()).query.name(),
+            'gray-%s' % small.query.profile().digest())
+        stats = StatsCollector()
+        stats.connect()
+        try:
+            small.url()
+        finally:
+            stats.disconnect()
+        self.assert_(os.path.getsize(small.path()) <= 10 * 1024)
+        self.assertEqual(stats.profiles['small']['encodes'], 1)
+        self.assert_(stats.profiles['small']['attempts'] > 1)
+        self.assertEqual(stats.profiles['small']['bytes'], os.path.getsize(small.path()))
+        # errors of profiles are not hidden
+        broken = plain.encoder_profile(Profile('broken', subsampling='invalid'))
+        self.assertRaises((TypeError, ValueError), broken.url)
+
+    def test_vectorized_operations(self):
+        from imagequery import operations, vectorized
+
+        if vectorized.numpy is None:
+            return
+        tux = Image.open(self.sample('tux_transparent.png'))
+        lynx = Image.open(self.sample('lynx_kitten.jpg'))
+        available = vectorized.available
+        try:
+            for image in (tux, lynx):
+                for operation in (operations.Opacity(0.5), operations.Invert(True),
+                                  operations.GetChannel('alpha'), operations.ApplyAlpha(tux)):
+                    vectorized.available = True
+                    fast = operation.execute(image, None)
+                    vectorized.available = False
+                    slow = operation.execute(image, None)
+                    self.assertEqual(list(fast.getdata()), list(slow.getdata()))
+        finally:
+            vectorized.available = available
+
+    def test_blur(self):
+        from imagequery import operations
+
+        lynx = Image.open(self.sample('lynx_kitten.jpg'))
+        for amount in (1, 3, 10):
+            iterative = operations.Blur(amount, method='iterative').execute(lynx, None)
+            for method in ('gaussian', 'box'):
+                blurred = operations.Blur(amount, method=method).execute(lynx, None)
+                self.assert_(self.difference(iterative, blurred) < 5)
+        blurred = operations.Blur(radius=60).execute(lynx, None)
+        self.assertEqual(blurred.size, lynx.size)
+        self.assertNotEqual(unicode(operations.Blur(3)), unicode(operations.Blur(3, method='iterative')))
+
+    def test_paste_composite(self):
+        from imagequery import operations
+
+        tux = Image.open(self.sample('tux_transparent.png')).convert('RGBA')
+        dj = Image.open(self.sample('django_colors.jpg')).convert('RGBA')
+        dj.putalpha(128)
+        paste = operations.Paste(tux, 0, 0)
+        for x, y in ((0, 0), (-50, -30), (dj.size[0] - 20, dj.size[1] - 20), (-1000, 0)):
+            region = paste.composite(dj, tux, x, y)
+            channels = paste.composite_channels(dj, tux, x, y)
+            self.assertEqual(list(region.getdata()), list(channels.getdata()))
+
     def test_hash_calculation(self):
         dj = ImageQuery(self.sample('django_colors.jpg'))
         dj1 = dj.scale(100, 100)
@@ -158,6 +619,98 @@ class ImageQueryTest(TestCase):
         f = TestFormat(iq)
         self.assert_(self.compare(f.path(), self.sample('results/django_colors_gray.jpg')))
 
+    def test_render_many(self):
+        iq = ImageQuery(self.sample('django_colors.jpg'))
+        scaled = iq.scale(100, 100)
+        results = iq.render_many(['test', scaled.grayscale(), scaled.invert()])
+        self.assertEqual(len(results), 3)
+        self.assert_(self.compare(results[0].path(), self.sample('results/django_colors_gray.jpg')))
+        for result in results[1:]:
+            self.assert_(result._exists())
+            self.assertEqual(result.size(), (100, 75))
+        # the shared scaling is executed once for optimized plans, too
+        from imagequery import optimizer, query, signals
+
+        executed = []
+
+        def record(sender, operation, **kwargs):
+            if isinstance(operation, optimizer.GEOMETRIC):
+                executed.append(operation)
+
+        optimize_operations = query.OPTIMIZE_OPERATIONS
+        query.OPTIMIZE_OPERATIONS = True
+        signals.operation_executed.connect(record)
+        try:
+            scaled = iq.scale(80, 80)
+            iq.render_many([scaled.grayscale(), scaled.invert()], force=True)
+        finally:
+            signals.operation_executed.disconnect(record)
+            query.OPTIMIZE_OPERATIONS = optimize_operations
+        self.assertEqual(len(executed), 1)
+
+    def test_benchmark(self):
+        from imagequery import benchmark
+
+        results = benchmark.run(repeat=1, sizes=(64,), modes=('RGB',), images=2)
+        self.assert_(results['operation.Resize.RGB.64']['time'] >= 0)
+        for name in ('query.fit.cold', 'query.fit.warm', 'template.image_format.2.cold'):
+            self.assert_('error' not in results[name], results[name])
+        self.assertEqual(benchmark.compare(results, results), [])
+        self.assert_(formats._formats.get('imagequery_benchmark') is None)
+
+    def test_negotiation(self):
+        from imagequery import negotiation
+
+        if not negotiation.is_supported('WEBP'):
+            return
+        self.assertEqual(negotiation.best_format('image/webp,*/*;q=0.8', ['WEBP']), 'WEBP')
+        self.assertEqual(negotiation.best_format('image/*,*/*;q=0.8', ['WEBP']), None)
+        query = ImageQuery(self.sample('django_colors.jpg')).scale(100, 100)
+        self.assertEqual(negotiation.negotiate(query, 'image/png', ['WEBP']), query)
+        variant = negotiation.negotiate(query, 'image/webp', ['WEBP'])
+        self.assertEqual(variant._name(), query._name() + '.webp')
+        self.assertEqual(variant.mimetype(), 'image/webp')
+        # all variants are rendered at once
+        self.assert_(query._exists())
+
+    def test_serve(self):
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from imagequery import serving, views
+
+        source = self.sample('django_colors.jpg')
+        signature = serving.get_signature('test', 'default', source)
+        factory = RequestFactory()
+        self.assertRaises(Http404, views.serve, factory.get('/'), 'test', 'default', signature,
+            self.sample('lynx_kitten.jpg'))
+        response = views.serve(factory.get('/'), 'test', 'default', signature, source)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assert_(self.compare(ImageQuery(source).grayscale().query_name('test_format').path(),
+            self.sample('results/django_colors_gray.jpg')))
+        response = views.serve(factory.get('/', HTTP_IF_NONE_MATCH=response['ETag']),
+            'test', 'default', signature, source)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=%d' % serving.SERVE_UNVERSIONED_MAX_AGE)
+
+    def test_serve_url(self):
+        from django.core.urlresolvers import clear_url_caches
+        from django.test.utils import override_settings
+        from imagequery import serving
+
+        with override_settings(ROOT_URLCONF='imagequery.urls'):
+            clear_url_caches()
+            try:
+                # absolute paths are made relative to the storage
+                url = serving.get_url('test', self.sample('django_colors.jpg'))
+                self.assert_('//' not in url)
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Cache-Control'], 'public, max-age=%d' % serving.SERVE_MAX_AGE)
+                self.assertEqual(self.client.get(url.replace('/test/', '/other/', 1)).status_code, 404)
+            finally:
+                clear_url_caches()
+
     def test_template_format(self):
         from django import template
 
@@ -168,3 +721,46 @@ class ImageQueryTest(TestCase):
         result = tpl.render(ctx)
         self.assertEqual(result, 'cache/test_format/django_colors.jpg')
 
+        class UnknownProfileFormat(TestFormat):
+            profile = 'unknown'
+
+        formats.register('unknown_profile', UnknownProfileFormat)
+        tpl = template.Template('{% load imagequery_tags %}{% image_format "unknown_profile" image %}')
+        self.assertEqual(tpl.render(ctx), '')
+
+    def test_aio(self):
+        from imagequery import aio
+
+        if aio.ThreadPoolExecutor is None:
+            return
+        images = [self.sample('django_colors.jpg'), self.sample('missing.jpg')]
+        self.assertEqual(aio.image_formats('test', images), ['cache/test_format/django_colors.jpg', ''])
+        query = ImageQuery(self.sample('django_colors.jpg')).grayscale().query_name('test_format')
+        self.assertEqual(aio.exists(query).result(), True)
+        self.assertEqual(aio.url(query.invert()).result(), query.invert().url())
+        # a single worker used for I/O and rendering does not deadlock
+        from concurrent.futures import ThreadPoolExecutor
+
+        executors = dict(aio._executors)
+        executor = ThreadPoolExecutor(max_workers=1)
+        aio.configure(executor, executor)
+        try:
+            self.assertEqual(aio.url(query.flip()).result(timeout=30), query.flip().url())
+        finally:
+            aio._executors.clear()
+            aio._executors.update(executors)
+            executor.shutdown()
+
+    def test_template_prefetch(self):
+        from django import template
+        from imagequery.prefetch import prefetch_formats
+
+        tpl = template.Template(
+            '{% load imagequery_tags %}{% prefetch_image_formats images "test" %}'
+            '{% for image in images %}{% image_format "test" image %};{% endfor %}')
+        images = [self.sample('django_colors.jpg'), self.sample('lynx_kitten.jpg'), self.sample('missing.jpg')]
+        result = tpl.render(template.Context({'images': images}))
+        self.assertEqual(result, 'cache/test_format/django_colors.jpg;cache/test_format/lynx_kitten.jpg;;')
+        prefetched = prefetch_formats(images[:1], ['test'])
+        self.assertEqual(prefetched.get('test', ImageQuery(images[0])), 'cache/test_format/django_colors.jpg')
+        self.assertEqual(prefetched.get('test', images[1]), None)
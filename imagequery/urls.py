@@ -2,5 +2,7 @@
 from django.conf.urls import *
 
 urlpatterns = patterns('imagequery.views',
-    url(r'^generate/(?P<pk>[0-9]+)?$', 'generate_lazy', name='imagequery_generate_lazy'),
+    url(r'^generate/(?P<key>[0-9a-f]{40})$', 'generate_lazy', name='imagequery_generate_lazy'),
+    url(r'^serve/(?P<format_name>[\w-]+)/(?P<storage_alias>[\w-]+)/(?P<signature>[\w-]+)/(?P<source>.+)$',
+        'serve', name='imagequery_serve'),
 )
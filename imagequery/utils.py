@@ -1,3 +1,12 @@
+import calendar
+import os
+import tempfile
+import time
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
 try:
     from PIL import Image
     from PIL import ImageFile
@@ -6,9 +15,105 @@ except ImportError:
     import Image
     import ImageFile
     import ImageFont
-from django.core.cache import cache
+from django.conf import settings
 from django.core.files.base import File
-from imagequery.settings import default_storage
+from django.utils.functional import LazyObject
+from imagequery.settings import STORAGES, default_storage
+
+
+def resolve_lazy(obj):
+    if isinstance(obj, LazyObject):
+        obj._setup()
+        return obj._wrapped
+    return obj
+
+
+def get_cache(alias):
+    try:
+        from django.core.cache import caches
+    except ImportError:
+        from django.core.cache import get_cache as _get_cache
+
+        return _get_cache(alias)
+    return caches[alias]
+
+
+def get_storage_id(storage):
+    ''' returns a string identifying the storage (including its location) '''
+    storage = resolve_lazy(storage)
+    return '%s.%s:%s' % (
+        storage.__class__.__module__,
+        storage.__class__.__name__,
+        getattr(storage, 'location', ''),
+    )
+
+
+_storages = None
+
+
+def _get_storages():
+    global _storages
+    if _storages is None:
+        from django.utils.importlib import import_module
+
+        _storages = {'default': default_storage}
+        for alias, path in STORAGES.items():
+            module_name, attr = path.rsplit('.', 1)
+            storage = getattr(import_module(module_name), attr)
+            if isinstance(storage, type):
+                storage = storage()
+            _storages[alias] = storage
+    return _storages
+
+
+def register_storage(alias, storage):
+    ''' registers the storage, so it can be referenced by alias (see get_storage) '''
+    _get_storages()[alias] = storage
+
+
+def get_storage(alias):
+    try:
+        return _get_storages()[alias]
+    except KeyError:
+        raise ValueError('storage %s is not registered' % alias)
+
+
+def get_storage_alias(storage):
+    ''' returns the alias of the storage, None if it is not registered '''
+    storage_id = get_storage_id(storage)
+    for alias, registered in sorted(_get_storages().items()):
+        if registered is storage or get_storage_id(registered) == storage_id:
+            return alias
+    return None
+
+
+def get_modified_time(storage, name):
+    '''
+    Returns the modification time of name in storage (timestamp), None if
+    the storage does not provide it. Uses the local file if possible, the
+    modification time reported by the storage otherwise (remote storages).
+    '''
+    try:
+        return os.path.getmtime(storage.path(name))
+    except NotImplementedError:
+        pass
+    except OSError:
+        return None
+    for method in ('get_modified_time', 'modified_time'):
+        if not hasattr(storage, method):
+            continue
+        try:
+            value = getattr(storage, method)(name)
+        except NotImplementedError:
+            continue
+        except Exception:  # remote storages raise their own errors for missing files
+            return None
+        if value.tzinfo is not None:
+            timestamp = calendar.timegm(value.utctimetuple())
+        else:
+            timestamp = time.mktime(value.timetuple())
+        return timestamp + value.microsecond / 1000000.0
+    return None
 
 
 def get_imagequery(value):
@@ -34,6 +139,11 @@ def _get_image_object(value, storage=default_storage):
 
 
 def get_image_object(value, storage=default_storage):
+    from imagequery import signals  # late import to avoid circular import
+
+    # receivers may be connected by other threads meanwhile, check only once
+    timed = bool(signals.image_loaded.receivers)
+    started = time.time()
     image = _get_image_object(value, storage)
     # PIL Workaround:
     # We avoid lazy loading here as ImageQuery already is lazy enough.
@@ -44,9 +154,77 @@ def get_image_object(value, storage=default_storage):
             image.load()
         except AttributeError:
             pass
+    if timed:
+        signals.image_loaded.send(sender=None, image=image, duration=time.time() - started)
     return image
 
 
+# used for files written without using the storage, like FileSystemStorage does
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _file_permissions(storage):
+    permissions = getattr(storage, 'file_permissions_mode', None)
+    if permissions is None:
+        permissions = getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None)
+    if permissions is None:
+        permissions = 0o666 & ~_UMASK
+    return permissions
+
+
+def save_file(storage, name, write):
+    '''
+    Saves a file to the storage, write(fh) is called to write the contents
+    (it may seek/truncate the file handle). The file is written in one go,
+    readers will never see partly written files:
+     * local storages get a temporary file which is renamed afterwards
+       (atomic, existing files get replaced)
+     * other storages get the contents buffered in memory, followed by a
+       single save(). Storages overwriting files on save (like S3 with
+       file_overwrite) replace them right away, others need the existing
+       file deleted first, so readers may find no file in between.
+    Returns name.
+    '''
+    storage = resolve_lazy(storage)
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path is not None:
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # created concurrently
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                write(fh)
+            os.chmod(tmp_path, _file_permissions(storage))
+            # atomic on POSIX, replaces the existing file
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+    else:
+        buf = BytesIO()
+        write(buf)
+        buf.seek(0)
+        if storage.exists(name) and storage.get_available_name(name) != name:
+            # the storage would save the file using another name
+            storage.delete(name)
+        saved = storage.save(name, File(buf, name=name))
+        if saved != name:
+            # someone else saved the file after we deleted it. We don't
+            # want to leave an unused copy and the other file is complete
+            # (written using a single save())
+            storage.delete(saved)
+    return name
+
+
 def get_font_object(value, size=None):
     if isinstance(value, (ImageFont.ImageFont, ImageFont.FreeTypeFont)):
         return value
@@ -74,21 +252,17 @@ def equal_height(images, maxwidth=None):
     
     The maximum height is calculated by resizing every image to the maximum
     width and comparing all resulting heights. maxheight gets to be
-    min(heights). Because of the double-resize involved here the function
-    caches the heights. But there is room for improvement. """
+    min(heights). The heights are calculated from the source sizes without
+    resizing anything (see RawImageQuery.size()), the source sizes are cached
+    by imagequery.probe. """
     from imagequery import ImageQuery  # late import to avoid circular import
 
     minheight = None  # infinity
-    all_values = ':'.join(images.values())
     for i, value in images.items():
         if not value:
             continue
         try:
-            cache_key = 'imagequery_equal_height_%s_%s_%d' % (all_values, value, maxwidth)
-            height = cache.get(cache_key, None)
-            if height is None:
-                height = ImageQuery(value).resize(x=maxwidth).height()
-                cache.set(cache_key, height, 604800)  # 7 days
+            height = ImageQuery(value).resize(x=maxwidth).height()
             if minheight is None or height < minheight:
                 minheight = height
         except IOError:
@@ -0,0 +1,70 @@
+"""
+NumPy implementations of some operations
+
+These are used by the operations (Opacity, Invert, GetChannel, ApplyAlpha) if
+NumPy is installed and IMAGEQUERY_USE_NUMPY is enabled. Results are the same
+as with the PIL implementations, but the work is done on one array instead of
+splitting the image into channels and merging them again. The resulting
+arrays are passed back to PIL without copying (see Image.frombuffer()).
+"""
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from imagequery.settings import USE_NUMPY
+
+available = numpy is not None and USE_NUMPY
+
+
+def to_array(image, mode='RGBA'):
+    ''' returns a (read only) array of the image data, converted to mode '''
+    if image.mode != mode:
+        image = image.convert(mode)
+    return numpy.asarray(image)
+
+
+def to_image(array, mode='RGBA'):
+    ''' returns an image using the array data (not copied) '''
+    array = numpy.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    return Image.frombuffer(mode, (width, height), array, 'raw', mode, 0, 1)
+
+
+def opacity(image, opacity):
+    '''
+    Multiplies all channels by opacity (0-255), rounding like PIL does when
+    pasting using a mask
+    '''
+    data = to_array(image).astype(numpy.uint16)
+    data *= opacity
+    # PIL's DIV255: ((v + 128) + ((v + 128) >> 8)) >> 8
+    data += 128
+    data += data >> 8
+    data >>= 8
+    return to_image(data.astype(numpy.uint8))
+
+
+def invert(image):
+    ''' inverts the colors, keeping the alpha channel '''
+    data = numpy.array(to_array(image))
+    numpy.subtract(255, data[..., :3], out=data[..., :3])
+    return to_image(data)
+
+
+def get_channel(image, channel):
+    ''' returns an RGBA image with all channels set to the given channel '''
+    source = to_array(image)
+    data = numpy.empty(source.shape, dtype=numpy.uint8)
+    data[...] = source[..., channel:channel + 1]
+    return to_image(data)
+
+
+def apply_alpha(image, alpha):
+    ''' replaces the alpha channel of image by alpha (mode "L", same size) '''
+    data = numpy.array(to_array(image))
+    data[..., 3] = numpy.asarray(alpha)
+    return to_image(data)
@@ -1,16 +1,92 @@
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified, Http404
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_http_methods
 
 
-def generate_lazy(request, pk):
+def generate_lazy(request, key):
+    '''
+    Redirects to the image of the lazy format. Without render queue the image
+    is rendered right now, otherwise a job is enqueued and the view redirects
+    to the source (or IMAGEQUERY_LAZY_FORMAT_PLACEHOLDER) until it is done.
+
+    Old lazy formats are not removed here, run
+    "manage.py imagequery_cleanup --lazy-formats" (or the imagequery_worker
+    command) periodically.
+    '''
     try:
         from imagequery.models import LazyFormat
     except ImportError:
         raise ImproperlyConfigured('You have to set "IMAGEQUERY_ALLOW_LAZY_FORMAT = True" in order to use this view')
-    LazyFormat.objects.cleanup()
+    from imagequery import formats
+    from imagequery.jobs import get_queue
+    from imagequery.settings import LAZY_FORMAT_PLACEHOLDER
+
     try:
-        lazy_format = LazyFormat.objects.get(pk=pk)
+        lazy_format = LazyFormat.objects.get(key=key)
     except LazyFormat.DoesNotExist:
         raise Http404()
-    return HttpResponseRedirect(lazy_format.generate_image_url())
+    try:
+        format_cls = formats.get(lazy_format.format)
+        imagequery = lazy_format.query
+    except (formats.FormatDoesNotExist, ValueError):  # ValueError: storage not registered anymore
+        raise Http404()
+    queue = get_queue()
+    if queue is None:
+        return HttpResponseRedirect(format_cls(imagequery).url())
+    query = format_cls(imagequery)._execute()
+    if query._exists():
+        return HttpResponseRedirect(query.url())
+    queue.enqueue(lazy_format.format, imagequery)
+    if LAZY_FORMAT_PLACEHOLDER:
+        response = HttpResponseRedirect(LAZY_FORMAT_PLACEHOLDER)
+    else:
+        response = HttpResponseRedirect(query.storage.url(query.source))
+    # the browser has to ask again to get the rendered image
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_http_methods(['GET', 'HEAD'])
+def serve(request, format_name, storage_alias, signature, source):
+    '''
+    Sends the image of the format for the source, rendering it if necessary
+    (see imagequery.serving)
+    '''
+    from imagequery import formats, negotiation, serving
+    from imagequery.query import ImageQuery
+    from imagequery.settings import SERVE_NEGOTIATE
+    from imagequery.utils import get_storage
+
+    if not serving.check_signature(signature, format_name, storage_alias, source):
+        raise Http404()
+    try:
+        format_cls = formats.get(format_name)
+        storage = get_storage(storage_alias)
+    except (formats.FormatDoesNotExist, ValueError):
+        raise Http404()
+    try:
+        query = format_cls(ImageQuery(source, storage=storage))._execute()
+        if SERVE_NEGOTIATE:
+            query = negotiation.negotiate(query, request.META.get('HTTP_ACCEPT'))
+        query._evaluate()
+    except IOError:  # missing or broken source
+        raise Http404()
+    etag, last_modified = serving.get_validators(query)
+    if serving.not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = serving.file_response(query)
+    serving.set_validators(response, etag, last_modified, serving.is_current(request, query))
+    if SERVE_NEGOTIATE:
+        patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def metrics(request):
+    from imagequery.settings import COLLECT_STATS
+    from imagequery.stats import collector
 
+    if not COLLECT_STATS:
+        raise ImproperlyConfigured('You have to set "IMAGEQUERY_COLLECT_STATS = True" in order to use this view')
+    return HttpResponse(collector.prometheus(), content_type='text/plain; version=0.0.4')